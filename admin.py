@@ -0,0 +1,46 @@
+"""Operator-only endpoints.
+
+Views wrapped in `admin_required` only answer requests that carry
+ADMIN_TOKEN as a bearer token:
+
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" https://.../admin/profile
+
+With no ADMIN_TOKEN configured they 404, as if they weren't there.
+"""
+
+import functools
+import hmac
+import os
+
+from flask import abort, current_app, request
+
+
+def is_admin_request():
+    """Does this request carry the admin token?"""
+
+    token = current_app.config['ADMIN_TOKEN']
+    scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+
+    return (bool(token) and scheme.lower() == 'bearer'
+            and hmac.compare_digest(given.encode(), token.encode()))
+
+
+def admin_required(view):
+    """Only let requests with the admin token through to `view`."""
+
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        if not current_app.config['ADMIN_TOKEN']:
+            abort(404)
+        if not is_admin_request():
+            abort(401)
+
+        return view(*args, **kwargs)
+
+    return wrapped
+
+
+def init_app(app):
+    """Read `app`'s admin token."""
+
+    app.config.setdefault('ADMIN_TOKEN', os.environ.get('ADMIN_TOKEN'))
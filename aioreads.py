@@ -0,0 +1,215 @@
+"""The read queries of reads.py on asyncpg, for the ASGI entry point.
+
+Same columns, same order, same records as reads.py, so asgi.py can render
+the sync views' templates with them. Each function takes an asyncpg
+connection; asgi.py holds one only while a page's queries run.
+
+Unlike reads.profile(), the follow counts come straight from SQL: the
+follow graph (graph.py) is loaded per WSGI process and isn't consulted
+from the event loop.
+"""
+
+from datetime import datetime
+
+from reads import Profile, Record, Stats, UserCard, message_records
+
+
+class Viewer(Record):
+    """The logged-in user, with who they follow (and what they like, once
+    a page asks for it)."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'stats',
+                 'followed_ids', 'liked_message_ids')
+
+
+class FollowPage(Record):
+    """A profile with the users it follows, or is followed by."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                 'location', 'stats', 'following', 'followers', 'more')
+
+
+MESSAGE_SQL = """
+    SELECT m.id, m.text, m.timestamp, m.like_count, m.user_id,
+           u.username, u.image_url, u.header_image_url
+    FROM messages m JOIN users u ON u.id = m.user_id
+"""
+
+FEED_SQL = MESSAGE_SQL + """
+    WHERE m.user_id = ANY($1::int[]) {where}
+    ORDER BY m.timestamp DESC, m.id DESC
+    LIMIT $2
+"""
+
+STATS_COLUMNS = """
+    (SELECT count(*) FROM messages WHERE user_id = u.id),
+    (SELECT count(*) FROM likes WHERE user_id = u.id),
+    (SELECT count(*) FROM follows WHERE user_following_id = u.id),
+    (SELECT count(*) FROM follows WHERE user_being_followed_id = u.id)
+"""
+
+PROFILE_SQL = f"""
+    SELECT u.id, u.username, u.image_url, u.header_image_url, u.bio,
+           u.location, {STATS_COLUMNS}
+    FROM users u
+    WHERE u.id = $1 AND u.deleted_at IS NULL
+"""
+
+CARD_SQL = """
+    SELECT u.id, u.username, u.image_url, u.header_image_url, u.bio
+    FROM users u
+"""
+
+
+def dsn(database_uri):
+    """An asyncpg DSN for a Postgres SQLALCHEMY_DATABASE_URI, else None."""
+
+    scheme, sep, rest = database_uri.partition('://')
+
+    # postgresql+psycopg2:// and the like
+    if not sep or scheme.split('+')[0] not in ('postgres', 'postgresql'):
+        return None
+
+    return f"postgresql://{rest}"
+
+
+async def create_pool(app):
+    """An asyncpg pool for `app`'s database, or None if it isn't Postgres."""
+
+    url = dsn(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    if url is None:
+        return None
+
+    import asyncpg
+
+    return await asyncpg.create_pool(
+        url, min_size=app.config['ASYNC_DB_POOL_MIN'],
+        max_size=app.config['ASYNC_DB_POOL_SIZE'])
+
+
+async def feed(conn, user_ids, limit=100, window=None):
+    """`reads.feed()`, as MessageRecords with their authors."""
+
+    if not window:
+        rows = await conn.fetch(FEED_SQL.format(where=''), user_ids, limit)
+    else:
+        cutoff = datetime.utcnow() - window
+        rows = await conn.fetch(FEED_SQL.format(where="AND m.timestamp >= $3"),
+                                user_ids, limit, cutoff)
+
+        if len(rows) < limit:
+            rows += await conn.fetch(
+                FEED_SQL.format(where="AND m.timestamp < $3"),
+                user_ids, limit - len(rows), cutoff)
+
+    return message_records(rows)
+
+
+async def user_cards(conn, search=None):
+    """`reads.user_cards()`."""
+
+    if search:
+        rows = await conn.fetch(
+            CARD_SQL + "WHERE u.deleted_at IS NULL AND u.username LIKE $1",
+            f"%{search}%")
+    else:
+        rows = await conn.fetch(CARD_SQL + "WHERE u.deleted_at IS NULL")
+
+    return [UserCard(*row) for row in rows]
+
+
+async def followed_ids(conn, user_id):
+    """`reads.followed_ids()`."""
+
+    rows = await conn.fetch("""
+        SELECT f.user_being_followed_id
+        FROM follows f JOIN users u ON u.id = f.user_being_followed_id
+        WHERE f.user_following_id = $1 AND u.deleted_at IS NULL
+    """, user_id)
+
+    return [followed_id for (followed_id,) in rows]
+
+
+async def liked_message_ids(conn, user_id):
+    rows = await conn.fetch(
+        "SELECT message_id FROM likes WHERE user_id = $1", user_id)
+    return frozenset(message_id for (message_id,) in rows)
+
+
+async def viewer(conn, user_id):
+    """The active user `user_id` as a Viewer, or None."""
+
+    row = await conn.fetchrow(f"""
+        SELECT u.id, u.username, u.image_url, u.header_image_url,
+               {STATS_COLUMNS}
+        FROM users u
+        WHERE u.id = $1 AND u.deleted_at IS NULL
+    """, user_id)
+
+    if row is None:
+        return None
+
+    *fields, messages, likes, following, followers = row
+    return Viewer(*fields, Stats(messages, likes, following, followers),
+                  frozenset(await followed_ids(conn, user_id)))
+
+
+async def profile(conn, user_id, window=None):
+    """`reads.profile()`, follow counts included."""
+
+    row = await conn.fetchrow(PROFILE_SQL, user_id)
+
+    if row is None:
+        return None
+
+    *fields, messages, likes, following, followers = row
+    user = Profile(*fields)
+    user.stats = Stats(messages, likes, following, followers)
+    user.messages = await feed(conn, [user_id], window=window)
+
+    return user
+
+
+async def follow_page(conn, user_id, followers=False, page=1, size=48):
+    """A FollowPage of who active user `user_id` follows (or, with
+    `followers`, who follows them), page `page` of `size` users, or None."""
+
+    row = await conn.fetchrow(PROFILE_SQL, user_id)
+
+    if row is None:
+        return None
+
+    *fields, messages, likes, following_count, follower_count = row
+    user = FollowPage(*fields, Stats(messages, likes, following_count,
+                                     follower_count))
+
+    # The same rows as graph.followers_page() and graph.following_page()
+    if followers:
+        join = ("JOIN follows f ON f.user_following_id = u.id "
+                "WHERE f.user_being_followed_id = $1")
+    else:
+        join = ("JOIN follows f ON f.user_being_followed_id = u.id "
+                "WHERE f.user_following_id = $1")
+
+    # One past the page, to tell whether there's another
+    cards = [UserCard(*card) for card in await conn.fetch(
+        CARD_SQL + join + " ORDER BY u.id LIMIT $2 OFFSET $3",
+        user_id, size + 1, (page - 1) * size)]
+
+    user.more = len(cards) > size
+    if followers:
+        user.followers = cards[:size]
+    else:
+        user.following = cards[:size]
+
+    return user
+
+
+async def message(conn, message_id):
+    """Message `message_id` with its author, or None if either is gone."""
+
+    rows = await conn.fetch(
+        MESSAGE_SQL + "WHERE m.id = $1 AND u.deleted_at IS NULL", message_id)
+
+    return message_records(rows)[0] if rows else None
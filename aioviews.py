@@ -0,0 +1,305 @@
+"""The read routes as coroutines on asyncpg, for the ASGI entry point.
+
+GET requests for the read routes -- home, profiles, follower lists,
+message pages and the user search -- run on the event loop. Their
+queries (aioreads.py) go through an asyncpg pool of up to
+ASYNC_DB_POOL_SIZE connections per worker, and a connection is only held
+while a page's queries run, not while it renders or goes out to the
+client. They render the same templates as the sync views, with the same
+records; rendering and saving the session run in the loop's thread pool,
+off the loop.
+
+Everything else -- writes, logins, images, static files, /stream -- goes
+to the WSGI app, run in a thread pool by asgiref. So does a read that
+would end up anywhere but its page (a 404, a login redirect, a deleted
+account being logged out), and every request when the database isn't
+Postgres or messages are sharded (shards.py).
+
+Of the app's before_request hooks, the async routes run the session
+sweeper and request capture. They load the viewer themselves, instead of
+add_user_to_g's blocking query, and GETs aren't rate limited. The
+profiler and memory sampling follow a request on its thread, which a
+coroutine sharing the loop with others doesn't have: while either is
+enabled, the reads go to the WSGI app, to be measured there.
+"""
+
+import asyncio
+import re
+import sys
+import time
+from io import BytesIO
+
+from flask import g, render_template
+from flask.ctx import RequestContext
+
+import aioreads
+from app import CURR_USER_KEY
+import capture
+import sessions
+import writebuffer
+
+
+def build_environ(scope):
+    """The WSGI environ of a bodiless ASGI http `scope`."""
+
+    root = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    path = scope['path'].encode('utf-8').decode('latin-1')
+    server = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root,
+        'PATH_INFO': path[len(root):] if path.startswith(root) else path,
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            name = f'HTTP_{name}'
+
+        value = value.decode('latin-1')
+        environ[name] = (f"{environ[name]},{value}" if name in environ
+                         else value)
+
+    return environ
+
+
+class AsyncReads:
+    """An ASGI app serving the read routes of `flask_app` on asyncpg."""
+
+    routes = [
+        (re.compile(r'/'), 'home'),
+        (re.compile(r'/users'), 'users'),
+        (re.compile(r'/users/(\d+)'), 'profile'),
+        (re.compile(r'/users/(\d+)/following'), 'following'),
+        (re.compile(r'/users/(\d+)/followers'), 'followers'),
+        (re.compile(r'/messages/(\d+)'), 'message'),
+    ]
+
+    def __init__(self, flask_app):
+        from asgiref.wsgi import WsgiToAsgi
+
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.pool = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if (scope['type'] == 'http' and scope['method'] == 'GET'
+                and self.pool is not None and not self.sync_only()):
+            handler, args = self.match(scope['path'])
+
+            if handler is not None:
+                response = await self.read(scope, handler, args)
+
+                if response is not None:
+                    return await self.send_response(response, send)
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Open the pool in each worker as it starts; close it at exit."""
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.pool = await aioreads.create_pool(self.flask_app)
+                except Exception as exc:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(exc)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def sync_only(self):
+        """Must every request go to the WSGI app? The async routes only
+        read the main database, and can't be profiled."""
+
+        config = self.flask_app.config
+        return ('shards' in self.flask_app.extensions
+                or config['PROFILER_ENABLED']
+                or config['MEMORY_PROFILE_ENABLED'])
+
+    def match(self, path):
+        """The handler for `path` and its int arguments, or (None, None)."""
+
+        for pattern, name in self.routes:
+            found = pattern.fullmatch(path)
+            if found:
+                return getattr(self, name), [int(arg) for arg in found.groups()]
+
+        return None, None
+
+    async def read(self, scope, handler, args):
+        """The page `handler` makes, as a Flask response, or None to leave
+        the request to the WSGI app."""
+
+        started = time.perf_counter()
+        flask_app = self.flask_app
+        environ = build_environ(scope)
+        request = flask_app.request_class(environ)
+
+        # The sync views read through the user's unwritten likes/follows
+        if writebuffer.has_pending(request):
+            return None
+
+        # The session store is blocking I/O (SQLite, Redis, files)
+        session = await asyncio.get_running_loop().run_in_executor(
+            None, flask_app.session_interface.open_session, flask_app,
+            request)
+        user_id = session.get(CURR_USER_KEY)
+
+        async with self.pool.acquire() as conn:
+            viewer = None
+
+            if user_id is not None:
+                viewer = await aioreads.viewer(conn, user_id)
+                if viewer is None:
+                    return None
+
+            page = await handler(conn, viewer, request.args, *args)
+
+        if page is None:
+            return None
+
+        # The rest blocks -- saving the session is I/O, like opening it
+        # -- so it runs in the thread pool too, with rendering
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.respond, environ, request, session, viewer, page,
+            started)
+
+    def respond(self, environ, request, session, viewer, page, started):
+        """`page` (template, context) rendered as a Flask response in a
+        request context, through the after_request hooks."""
+
+        flask_app = self.flask_app
+        template, context = page
+
+        with RequestContext(flask_app, environ, request=request,
+                            session=session):
+            sessions.ensure_sweeper()
+            capture.start_capture(started)
+            g.user = viewer
+
+            if viewer is not None:
+                g.followed_ids = viewer.followed_ids
+
+                liked = getattr(viewer, 'liked_message_ids', None)
+                if liked is not None:
+                    g.liked_message_ids = liked
+
+            try:
+                response = flask_app.make_response(
+                    render_template(template, **context))
+            except Exception as exc:
+                response = flask_app.make_response(
+                    flask_app.handle_exception(exc))
+
+            return flask_app.process_response(response)
+
+    async def send_response(self, response, send):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in response.headers.items()],
+        })
+        await send({'type': 'http.response.body',
+                    'body': response.get_data()})
+
+    # The read routes. Each returns (template, context), or None to hand
+    # the request to the sync view.
+
+    async def home(self, conn, viewer, args):
+        if viewer is None:
+            return 'home-anon.html', {}
+
+        messages = await aioreads.feed(
+            conn, [*viewer.followed_ids, viewer.id],
+            window=self.flask_app.config['MESSAGES_FEED_WINDOW'])
+        viewer.liked_message_ids = await aioreads.liked_message_ids(
+            conn, viewer.id)
+
+        return 'home.html', {'messages': messages}
+
+    async def users(self, conn, viewer, args):
+        users = await aioreads.user_cards(conn, args.get('q'))
+        return 'users/index.html', {'users': users}
+
+    async def profile(self, conn, viewer, args, user_id):
+        user = await aioreads.profile(
+            conn, user_id,
+            window=self.flask_app.config['MESSAGES_FEED_WINDOW'])
+
+        if user is None:
+            return None
+
+        if viewer is not None:
+            viewer.liked_message_ids = await aioreads.liked_message_ids(
+                conn, viewer.id)
+
+        return 'users/show.html', {'user': user, 'messages': user.messages}
+
+    async def following(self, conn, viewer, args, user_id):
+        if viewer is None:
+            return None
+
+        page = max(args.get('page', 1, type=int), 1)
+        user = await aioreads.follow_page(
+            conn, user_id, page=page,
+            size=self.flask_app.config['FOLLOW_PAGE_SIZE'])
+
+        if user is None:
+            return None
+
+        return 'users/following.html', {'user': user, 'page': page,
+                                        'following': user.following,
+                                        'more': user.more}
+
+    async def followers(self, conn, viewer, args, user_id):
+        if viewer is None:
+            return None
+
+        page = max(args.get('page', 1, type=int), 1)
+        user = await aioreads.follow_page(
+            conn, user_id, followers=True, page=page,
+            size=self.flask_app.config['FOLLOW_PAGE_SIZE'])
+
+        if user is None:
+            return None
+
+        return 'users/followers.html', {'user': user, 'page': page,
+                                        'followers': user.followers,
+                                        'more': user.more}
+
+    async def message(self, conn, viewer, args, message_id):
+        message = await aioreads.message(conn, message_id)
+
+        if message is None:
+            return None
+
+        return 'messages/show.html', {'message': message}
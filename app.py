@@ -1,41 +1,123 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (
+    Blueprint, Flask, render_template, request, flash, redirect, session, g,
+    abort)
 from sqlalchemy.exc import IntegrityError
 
-from forms import UserAddForm, UserEditForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message, Likes
+import admin
+import assets
+import capture
+import export
+import feedcache
+import graph
+import images
+import likes
+import live
+import memory
+import partitions
+import profiler
+import ratelimit
+import reads
+import sessions
+import shards
+import tags
+import templating
+import writebuffer
+from models import db, connect_db, utcnow, User, Message, Likes, UserPurge
+from purge import purge_users_command
+
+# forms.py (and with it WTForms) is imported inside the views that use
+# it, so importing this module -- and booting a worker -- stays cheap.
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+def create_app(config=None):
+    """Create and configure a Warbler app.
 
-connect_db(app)
+    Settings come from the environment where noted; `config` is a mapping
+    that overrides any of them. The debug toolbar is only installed when
+    the app runs in debug mode.
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Serving profile, read by gunicorn.conf.py
+    app.config['WEB_BIND'] = os.environ.get('WEB_BIND', '127.0.0.1:8000')
+    app.config['WEB_CONCURRENCY'] = int(
+        os.environ.get('WEB_CONCURRENCY', 2 * os.cpu_count() + 1))
+    app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 1))
+    app.config['WEB_WORKER_CLASS'] = os.environ.get('WEB_WORKER_CLASS', 'sync')
+    app.config['WEB_WORKER_CONNECTIONS'] = int(
+        os.environ.get('WEB_WORKER_CONNECTIONS', 5000))
+
+    # asyncpg pool per worker when served through asgi.py
+    app.config['ASYNC_DB_POOL_MIN'] = int(
+        os.environ.get('ASYNC_DB_POOL_MIN', 1))
+    app.config['ASYNC_DB_POOL_SIZE'] = int(
+        os.environ.get('ASYNC_DB_POOL_SIZE', 10))
+
+    app.config.update(config or {})
+
+    # First: anything registering template globals builds app.jinja_env
+    templating.init_app(app)
+
+    if app.debug:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    admin.init_app(app)
+    assets.init_app(app)
+    capture.init_app(app)
+    export.init_app(app)
+    feedcache.init_app(app)
+    graph.init_app(app)
+    images.init_app(app)
+    live.init_app(app)
+    memory.init_app(app)
+    partitions.init_app(app)
+    profiler.init_app(app)
+    shards.init_app(app)
+    tags.init_app(app)
+    sessions.init_app(app)
+    app.cli.add_command(purge_users_command)
+    likes.init_app(app)
+    writebuffer.init_app(app)
+    app.register_blueprint(bp)
+    ratelimit.init_app(app)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
         g.user = User.query.get(session[CURR_USER_KEY])
 
+        if g.user and g.user.deleted_at:
+            do_logout()
+            g.user = None
+
     else:
         g.user = None
 
@@ -43,6 +125,7 @@ def add_user_to_g():
 def do_login(user):
     """Log in user."""
 
+    sessions.regenerate()
     session[CURR_USER_KEY] = user.id
 
 
@@ -51,9 +134,10 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+        sessions.regenerate()
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -65,6 +149,8 @@ def signup():
     and re-present form.
     """
 
+    from forms import UserAddForm
+
     form = UserAddForm()
 
     if form.validate_on_submit():
@@ -89,10 +175,12 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
+    from forms import LoginForm
+
     form = LoginForm()
 
     if form.validate_on_submit():
@@ -109,7 +197,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -121,40 +209,26 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
     Can take a 'q' param in querystring to search by that username.
     """
 
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
+    users = reads.user_cards(request.args.get('q'))
     return render_template('users/index.html', users=users)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    user = feedcache.profile(user_id)
+    return render_template('users/show.html', user=user,
+                           messages=user.messages)
 
-@app.route("/users/<int:user_id>/likes")
+@bp.route("/users/<int:user_id>/likes")
 def show_likes(user_id):
     """Show messages this user has liked."""
 
@@ -162,11 +236,15 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template("users/likes.html", user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    liked = (shards.liked_messages(user.id) if shards.enabled()
+             else user.likes)
+    if user.id == g.user.id:
+        liked = writebuffer.with_pending_rows('like', liked, Message)
+    return render_template("users/likes.html", user=user, likes=liked)
 
 
-@app.route('/users/<int:user_id>/following')
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -174,11 +252,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    page = max(request.args.get('page', 1, type=int), 1)
+    following, more = graph.following_page(user.id, page)
+    return render_template('users/following.html', user=user,
+                           following=following, page=page, more=more)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -186,11 +267,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    page = max(request.args.get('page', 1, type=int), 1)
+    followers, more = graph.followers_page(user.id, page)
+    return render_template('users/followers.html', user=user,
+                           followers=followers, page=page, more=more)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -198,14 +282,20 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    if writebuffer.enabled():
+        writebuffer.follow(g.user.id, follow_id)
+    else:
+        g.user.following.append(followed_user)
+        db.session.commit()
+        graph.record_follow(g.user.id, follow_id)
+    feedcache.invalidate_feed(g.user.id)
+    feedcache.invalidate_profile(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -213,14 +303,20 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if writebuffer.enabled():
+        writebuffer.follow(g.user.id, follow_id, on=False)
+    else:
+        followed_user = User.query.get(follow_id)
+        g.user.following.remove(followed_user)
+        db.session.commit()
+        graph.record_follow(g.user.id, follow_id, follow=False)
+    feedcache.invalidate_feed(g.user.id)
+    feedcache.invalidate_profile(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/<int:user_id>/update', methods=["GET", "POST"])
+@bp.route('/users/<int:user_id>/update', methods=["GET", "POST"])
 def profile(user_id):
     """Update profile for current user."""
 
@@ -228,6 +324,8 @@ def profile(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    from forms import UserEditForm
+
     form = UserEditForm(obj=g.user)
 
     if form.validate_on_submit():
@@ -242,9 +340,12 @@ def profile(user_id):
 
             db.session.add(user)
             db.session.commit()
+            # Followers' timelines catch up within FEEDCACHE_TTL
+            feedcache.invalidate_feed(user.id)
+            feedcache.invalidate_profile(user.id)
             # - On success, it should redirect to the user detail page.
             flash("Profile updated successfully.", "success")
-            return redirect(f"users/{user.id}")
+            return redirect(f"/users/{user.id}")
         else:
             flash("Invalid credentials.", 'danger')
             return redirect("/")
@@ -252,7 +353,7 @@ def profile(user_id):
     else:
         return render_template("/users/edit.html", form=form)
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -262,8 +363,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hide the account now; purge.py removes its rows in the background.
+    g.user.deleted_at = utcnow()
+    db.session.add(UserPurge(user_id=g.user.id))
     db.session.commit()
+    feedcache.invalidate_author(g.user.id)
 
     return redirect("/signup")
 
@@ -271,7 +375,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -282,27 +386,42 @@ def messages_add():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    from forms import MessageForm
+
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        if shards.enabled():
+            msg = shards.post_message(g.user, form.text.data)
+        else:
+            msg = Message.post(g.user.id, form.text.data)
+            tags.index_message(msg)
+            db.session.commit()
+        live.publish(msg)
+        feedcache.invalidate_feed(g.user.id)
+        feedcache.invalidate_profile(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    if shards.enabled():
+        msg = shards.get_message(message_id)
+    else:
+        msg = Message.query.get_or_404(message_id)
+
+        if msg.user.deleted_at:
+            abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -310,6 +429,13 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if shards.enabled():
+        if shards.delete_message(message_id, g.user.id):
+            feedcache.invalidate_author(g.user.id)
+        else:
+            flash("Access unauthorized.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
     msg = Message.query.get(message_id)
 
     if msg.user is not g.user:
@@ -317,38 +443,55 @@ def messages_destroy(message_id):
     else:
         db.session.delete(msg)
         db.session.commit()
+        feedcache.invalidate_author(g.user.id)
         
     return redirect(f"/users/{g.user.id}")
 
 
-@app.route('/messages/<int:message_id>/like', methods=["POST"])
+@bp.route('/messages/<int:message_id>/like', methods=["POST"])
 def like_message(message_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
-    g.user.likes.append(message)
-    db.session.commit()
+    if shards.enabled():
+        author_id = shards.like(message_id, g.user.id)
+    else:
+        author_id = Message.query.get_or_404(message_id).user_id
+        if writebuffer.enabled():
+            writebuffer.like(g.user.id, message_id)
+        else:
+            Message.like(message_id, g.user.id)
+            db.session.commit()
+    feedcache.invalidate_feed(g.user.id)
+    feedcache.invalidate_profile(g.user.id, author_id)
     return redirect(f"/users/{g.user.id}/likes")
 
 
-@app.route('/messages/<int:message_id>/unlike', methods=["POST"])
+@bp.route('/messages/<int:message_id>/unlike', methods=["POST"])
 def unlike_message(message_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    message = Message.query.get_or_404(message_id)
-    g.user.likes.remove(message)
-    db.session.commit()
+    if shards.enabled():
+        author_id = shards.unlike(message_id, g.user.id)
+    else:
+        author_id = Message.query.get_or_404(message_id).user_id
+        if writebuffer.enabled():
+            writebuffer.like(g.user.id, message_id, on=False)
+        else:
+            Message.unlike(message_id, g.user.id)
+            db.session.commit()
+    feedcache.invalidate_feed(g.user.id)
+    feedcache.invalidate_profile(g.user.id, author_id)
     return redirect(f"/users/{g.user.id}/likes")
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
@@ -357,16 +500,7 @@ def homepage():
     """
 
     if g.user:
-        # Grab followed user ids and append global user id
-        followed_user_ids = [user.id for user in g.user.following]
-        followed_user_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
+        messages = feedcache.home_feed(g.user.id)
         return render_template('home.html', messages=messages)
 
     else:
@@ -380,12 +514,24 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@bp.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Responses already marked immutable (fingerprinted, never-changing
+    URLs such as image thumbnails) keep their long-lived caching.
+    """
+
+    if 'immutable' in req.headers.get('Cache-Control', ''):
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+# App for the dev server, `flask` commands and tests; production serving
+# goes through wsgi.py.
+app = create_app()
@@ -0,0 +1,19 @@
+"""ASGI entry point for Warbler: read routes async, the rest through WSGI.
+
+Serve with an ASGI worker, using the settings in gunicorn.conf.py:
+
+    WEB_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn asgi:app
+
+A sync worker spends most of a page view holding its thread, and a pooled
+connection, while it waits on Postgres. Here the read routes run as
+coroutines on an asyncpg pool instead (see aioviews.py); everything else
+still runs on the WSGI app from wsgi.py, in a thread pool.
+
+Needs asgiref, asyncpg and an ASGI server such as uvicorn. See
+benchmarks/async_serving.py for how it compares with the sync workers.
+"""
+
+from aioviews import AsyncReads
+from wsgi import app as wsgi_app
+
+app = AsyncReads(wsgi_app)
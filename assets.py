@@ -0,0 +1,263 @@
+"""Build step and runtime helpers for fingerprinted static assets.
+
+`flask assets build` copies every file under static/ into static/dist/
+with a content hash in its name (style.css -> style.1a2b3c4d5e.css):
+
+- CSS is minified, and its url(/static/...) references are rewritten to
+  the fingerprinted names;
+- JPEGs and PNGs are re-encoded (and capped in size) when that makes
+  them smaller, and a WebP variant is written alongside;
+- text assets get precompressed .gz and, when the brotli package is
+  installed, .br variants.
+
+A manifest.json maps original paths to built ones. Templates link assets
+with `static_url('stylesheets/style.css')`; the /assets/ route serves the
+best variant the browser accepts, immutable for a year. Without a
+manifest (e.g. in development), `static_url` falls back to plain
+/static/ URLs.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from io import BytesIO
+
+import click
+from flask import Blueprint, abort, current_app, request, send_file
+from flask.cli import AppGroup
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Images wider or taller than this are scaled down when optimized
+MAX_IMAGE_SIZE = 1920
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json'}
+OPTIMIZABLE = {'.jpg', '.jpeg', '.png'}
+
+# Accept-Encoding token -> suffix of the precompressed file
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+assets = Blueprint('assets', __name__)
+assets_cli = AppGroup('assets', help='Build fingerprinted static assets.')
+
+
+def fingerprint(name, data):
+    """`name` with a hash of `data` inserted before its extension."""
+
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def minify_css(css):
+    """Strip comments and insignificant whitespace from a stylesheet."""
+
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def rewrite_css_urls(css, manifest):
+    """Point url(/static/...) references at their fingerprinted files."""
+
+    def replace(match):
+        built = manifest.get(match.group(2))
+        if built is None:
+            return match.group(0)
+        return f"url({match.group(1)}/assets/{built}{match.group(1)})"
+
+    return re.sub(r'''url\((["']?)/static/([^"')]+)\1\)''', replace, css)
+
+
+def optimize_image(data, ext):
+    """Re-encode image bytes; return (smallest bytes, WebP bytes or None)."""
+
+    from PIL import Image
+
+    image = Image.open(BytesIO(data))
+    image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE))
+
+    out = BytesIO()
+    if ext == '.png':
+        image.save(out, 'PNG', optimize=True)
+    else:
+        image.convert('RGB').save(out, 'JPEG', quality=82, optimize=True,
+                                  progressive=True)
+    optimized = min(data, out.getvalue(), key=len)
+
+    webp = BytesIO()
+    image.save(webp, 'WEBP', quality=80)
+    webp = webp.getvalue()
+
+    return optimized, webp if len(webp) < len(optimized) else None
+
+
+def compress(data):
+    """Precompressed variants of `data`, as {suffix: bytes}."""
+
+    variants = {'.gz': gzip.compress(data, compresslevel=9)}
+
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        variants['.br'] = brotli.compress(data)
+
+    # Only keep variants that are actually worth sending
+    return {suffix: packed for suffix, packed in variants.items()
+            if len(packed) < len(data)}
+
+
+def build(static_folder, dist):
+    """Build every asset in `static_folder` into `dist`; return the manifest.
+
+    Stylesheets are built last, so their url() references can be
+    rewritten to already fingerprinted files.
+    """
+
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_folder)
+            sources.append(path.replace(os.sep, '/'))
+
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+    manifest = {}
+
+    for path in sources:
+        ext = os.path.splitext(path)[1].lower()
+        variants = {}
+
+        with open(os.path.join(static_folder, path), 'rb') as source:
+            data = source.read()
+
+        if ext == '.css':
+            css = rewrite_css_urls(minify_css(data.decode('utf-8')), manifest)
+            data = css.encode('utf-8')
+        elif ext in OPTIMIZABLE:
+            data, webp = optimize_image(data, ext)
+            if webp:
+                variants['.webp'] = webp
+
+        if ext in COMPRESSIBLE:
+            variants.update(compress(data))
+
+        built = fingerprint(path, data)
+        manifest[path] = built
+
+        target = os.path.join(dist, built)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        for suffix, content in [('', data), *variants.items()]:
+            with open(target + suffix, 'wb') as out:
+                out.write(content)
+
+    with open(os.path.join(dist, 'manifest.json'), 'w') as out:
+        json.dump(manifest, out, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def get_manifest():
+    """The current app's asset manifest, loaded on first use ({} if unbuilt)."""
+
+    manifest = current_app.extensions.get('assets_manifest')
+
+    if manifest is None:
+        path = os.path.join(current_app.config['ASSETS_DIST_DIR'],
+                            'manifest.json')
+        try:
+            with open(path) as source:
+                manifest = json.load(source)
+        except FileNotFoundError:
+            manifest = {}
+
+        current_app.extensions['assets_manifest'] = manifest
+
+    return manifest
+
+
+def static_url(path):
+    """URL of the static file at `path` (relative to static/)."""
+
+    built = get_manifest().get(path)
+
+    if built is None:
+        return f"/static/{path}"
+
+    return f"/assets/{built}"
+
+
+def accepts(token, header):
+    """Does an Accept(-Encoding) header list `token` (with q > 0)?"""
+
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip() == token:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0')
+
+    return False
+
+
+@assets.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """Serve a fingerprinted asset, preferring precompressed variants."""
+
+    dist = current_app.config['ASSETS_DIST_DIR']
+    path = os.path.normpath(os.path.join(dist, filename))
+
+    if not path.startswith(dist + os.sep) or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    encoding = None
+
+    if (mimetype.startswith('image/')
+            and accepts('image/webp', request.headers.get('Accept', ''))
+            and os.path.isfile(path + '.webp')):
+        path, mimetype = path + '.webp', 'image/webp'
+    else:
+        for token, suffix in ENCODINGS:
+            if (accepts(token, request.headers.get('Accept-Encoding', ''))
+                    and os.path.isfile(path + suffix)):
+                path, encoding = path + suffix, token
+                break
+
+    resp = send_file(path, mimetype=mimetype, conditional=True)
+
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+
+    resp.headers['Vary'] = 'Accept, Accept-Encoding'
+    resp.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+    return resp
+
+
+@assets_cli.command('build')
+def build_command():
+    """Fingerprint, minify and precompress everything in static/."""
+
+    manifest = build(current_app.static_folder,
+                     current_app.config['ASSETS_DIST_DIR'])
+    click.echo(f"Built {len(manifest)} assets into "
+               f"{current_app.config['ASSETS_DIST_DIR']}")
+
+
+def init_app(app):
+    """Set up fingerprinted asset serving on `app`."""
+
+    app.config.setdefault('ASSETS_DIST_DIR',
+                          os.path.join(app.static_folder, 'dist'))
+
+    app.register_blueprint(assets)
+    app.cli.add_command(assets_cli)
+    app.add_template_global(static_url)
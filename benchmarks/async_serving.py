@@ -0,0 +1,126 @@
+"""Compare the ASGI entry point with sync workers at high concurrency.
+
+Starts gunicorn once per profile, drives the read routes with many
+keep-alive clients and prints, per profile and client count, throughput
+per worker process and the most Postgres connections the server held
+at once (sampled from pg_stat_activity). Run it from the project root
+against a seeded database (see seed.py):
+
+    DATABASE_URL=postgresql:///warbler python -m benchmarks.async_serving
+
+The profiles are
+
+    sync    `wsgi:app` on sync workers: one request, and one pooled
+            connection, per worker at a time
+    asgi    `asgi:app` on uvicorn workers: the read routes share an
+            asyncpg pool of ASYNC_DB_POOL_SIZE per worker, each request
+            holding a connection only while its queries run
+            (needs asgiref, asyncpg and uvicorn)
+
+Sync workers hold a connection for the whole request, so adding clients
+past the worker count only adds queueing. The async workers keep many
+requests in flight per process, so their throughput per process keeps
+growing until the pool or the CPU saturates, while connections held stay
+capped by the pool. See benchmarks/serving.py for gthread and gevent.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+
+from sqlalchemy import create_engine
+
+from benchmarks.serving import ROUTES, drive, session_cookie, wait_for
+
+PROFILES = {
+    'sync': ('wsgi:app', {'WEB_WORKER_CLASS': 'sync'}),
+    'asgi': ('asgi:app',
+             {'WEB_WORKER_CLASS': 'uvicorn.workers.UvicornWorker'}),
+}
+
+
+def watch_connections(engine, stop, peak, interval=0.1):
+    """Keep the most backends seen on this database in peak['held']."""
+
+    with engine.connect() as conn:
+        while not stop.wait(interval):
+            held = conn.execute(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE datname = current_database() "
+                "AND pid <> pg_backend_pid()").scalar()
+            peak['held'] = max(peak['held'], held)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES),
+                        choices=list(PROFILES))
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[64, 256, 512])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--message-id', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    host = '127.0.0.1'
+    paths = [route.format(user_id=args.user_id, message_id=args.message_id)
+             for route in ROUTES]
+    cookie = session_cookie(args.user_id)
+    engine = create_engine(os.environ.get('DATABASE_URL',
+                                          'postgresql:///warbler'))
+
+    print(f"{'profile':<8} {'clients':>7} {'req/s':>8} {'/worker':>8} "
+          f"{'p99 ms':>8} {'conns':>6} {'errors':>6}")
+
+    for name in args.profiles:
+        target, settings = PROFILES[name]
+        env = dict(os.environ, **settings,
+                   WEB_CONCURRENCY=str(args.workers),
+                   ASYNC_DB_POOL_SIZE=str(args.pool_size),
+                   WEB_BIND=f"{host}:{args.port}")
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', target], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        try:
+            wait_for(host, args.port)
+
+            for clients in args.clients:
+                stop = threading.Event()
+                peak = {'held': 0}
+                watcher = threading.Thread(target=watch_connections,
+                                           args=(engine, stop, peak))
+                watcher.start()
+
+                try:
+                    latencies, errors = drive(host, args.port, paths, cookie,
+                                              clients, args.duration)
+                finally:
+                    stop.set()
+                    watcher.join()
+
+                count = len(latencies)
+
+                if not count:
+                    print(f"{name:<8} {clients:>7} no successful requests")
+                    continue
+
+                rate = count / args.duration
+                print(f"{name:<8} {clients:>7} {rate:>8.0f} "
+                      f"{rate / args.workers:>8.0f} "
+                      f"{latencies[int(count * 0.99)] * 1000:>8.1f} "
+                      f"{peak['held']:>6} {len(errors):>6}")
+        finally:
+            server.terminate()
+            server.wait()
+
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
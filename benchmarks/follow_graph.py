@@ -0,0 +1,122 @@
+"""Benchmark the in-memory follow graph (graph.py) at scale.
+
+No database needed; the graph is built from a synthetic, skewed follow
+graph (a few accounts with huge followings, most with a handful):
+
+    python -m benchmarks.follow_graph --edges 10000000 --users 1000000
+
+Reports build time, bytes per edge for both directions together, and the
+cost of membership, degree and neighbour-slice queries. For comparison,
+the bytes per edge of the obvious dict-of-sets representation are
+measured on a smaller graph of --baseline-edges edges.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from graph import Adjacency, FollowGraph
+
+
+def degrees(users, edges, rng):
+    """Out-degrees for `users` users summing to about `edges`, heavy-tailed."""
+
+    weights = [rng.paretovariate(1.2) for _ in range(users)]
+    scale = edges / sum(weights)
+    return [min(users // 10, int(weight * scale + rng.random()))
+            for weight in weights]
+
+
+def sorted_edges(users, edges, seed):
+    """(follower, followed) pairs, sorted, for a random graph.
+
+    Low user ids are followed far more than high ones.
+    """
+
+    rng = random.Random(seed)
+
+    for follower, degree in enumerate(degrees(users, edges, rng)):
+        followed = set()
+        while len(followed) < degree:
+            followed.add(int(users * rng.random() ** 3))
+
+        for followed_id in sorted(followed):
+            yield follower, followed_id
+
+
+def per_op(function, args):
+    """Microseconds per call of `function` over `args`."""
+
+    began = time.perf_counter()
+    for arg in args:
+        function(*arg)
+    return (time.perf_counter() - began) / len(args) * 1e6
+
+
+def baseline_bytes_per_edge(users, edges, seed):
+    """Bytes per edge of a {follower: set(followed)} dict, both ways."""
+
+    tracemalloc.start()
+    following, followers = {}, {}
+
+    for follower, followed in sorted_edges(users, edges, seed):
+        following.setdefault(follower, set()).add(followed)
+        followers.setdefault(followed, set()).add(follower)
+
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = sum(map(len, following.values()))
+    return size / max(count, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--edges", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200_000)
+    parser.add_argument("--baseline-edges", type=int, default=1_000_000,
+                        help="edges to measure dict-of-sets on (0 to skip)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    began = time.perf_counter()
+    graph = FollowGraph(Adjacency.from_sorted(
+        sorted_edges(args.users, args.edges, args.seed), args.users))
+    built = time.perf_counter() - began
+
+    edges = graph.edges
+    print(f"{edges} edges, {args.users} users: built in {built:.1f}s, "
+          f"{graph.nbytes / 2 ** 20:.0f} MiB, "
+          f"{graph.nbytes / edges:.1f} bytes/edge (both directions)")
+
+    if args.baseline_edges:
+        scale = args.baseline_edges / args.edges
+        users = max(2, int(args.users * scale))
+        print(f"dict of sets ({args.baseline_edges} edges): "
+              f"{baseline_bytes_per_edge(users, args.baseline_edges, args.seed):.1f}"
+              f" bytes/edge (both directions)")
+
+    rng = random.Random(args.seed + 1)
+    pairs = [(rng.randrange(args.users), rng.randrange(args.users))
+             for _ in range(args.queries)]
+    nodes = [(follower,) for follower, _ in pairs]
+    busiest = max(range(args.users), key=graph.follower_count)
+
+    print(f"is_following     {per_op(graph.is_following, pairs):6.2f} us")
+    print(f"following_count  {per_op(graph.following_count, nodes):6.2f} us")
+    print(f"following_ids    {per_op(graph.following_ids, nodes):6.2f} us")
+    print(f"follower_ids[:100] of the busiest "
+          f"({graph.follower_count(busiest)} followers) "
+          f"{per_op(graph.follower_ids, [(busiest, 0, 100)] * 10000):6.2f} us")
+
+    began = time.perf_counter()
+    for follower, followed in pairs[:10000]:
+        graph.update(True, follower, followed)
+    print(f"update           "
+          f"{(time.perf_counter() - began) / 10000 * 1e6:6.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+"""Micro-benchmarks for the models layer (models.py), with a history.
+
+Run from the project root against a scratch database; `run` drops and
+recreates every table in it, so it has to be named with --database, and
+refuses one whose name doesn't say it's for benchmarks or tests (has
+none of SCRATCH_WORDS in it) unless given --yes-drop:
+
+    python -m benchmarks.models run --database postgresql:///warbler-bench \\
+        --sizes 1000 10000 100000 1000000
+
+At each size (in users) it times, per call:
+
+    signup          User.signup() and the INSERT it flushes
+    authenticate    User.authenticate() of a random user
+    is_following    User.is_following() / is_followed_by() of a random
+    is_followed_by  pair (each loads the whole collection)
+    following       loading a random user's following, followers and
+    followers       likes relationships
+    likes
+    post            Message.post() and the INSERT it flushes
+    post_many       Message.post_many() of POST_MANY_ROWS messages
+
+The data is the generator's (generator/*.csv) scaled up: its users are
+cloned with numbered usernames, and each new user gets about as many
+messages and follows as the generator's users have, plus LIKES_PER_USER
+likes. Sizes are grown into one after another, so list them smallest
+first; 1M users is about 25M rows, several minutes of COPY on Postgres.
+Writes are rolled back, so they don't grow the data.
+
+Each run is appended to the history (one JSON object per line, in
+instance/benchmarks/ unless --history says otherwise) with the commit and
+settings it ran with. `compare` checks the
+latest run against the one before it, or any two runs by id, commit or
+index, and exits non-zero if any median got slower by over --threshold
+percent:
+
+    python -m benchmarks.models compare
+    python -m benchmarks.models compare 3f2c1ab -1 --threshold 20
+
+Medians of a few hundred calls still move by several percent from run to
+run; compare runs from the same machine, database and --bcrypt-rounds.
+"""
+
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+
+from app import app
+from models import db, get_bcrypt, Follows, Likes, Message, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY = os.path.join(ROOT, 'instance', 'benchmarks', 'models.jsonl')
+
+PASSWORD = 'password'
+LIKES_PER_USER = 5
+POST_MANY_ROWS = 100
+CHUNK_USERS = 10000
+
+# Words in the name of a database that's fine to drop
+SCRATCH_WORDS = ('bench', 'scratch', 'test', 'tmp')
+
+# Benchmarks dominated by bcrypt, run --slow-repeat times instead
+SLOW = {'signup', 'authenticate'}
+
+
+def read_generated(name):
+    with open(os.path.join(ROOT, 'generator', f'{name}.csv')) as source:
+        return list(csv.DictReader(source))
+
+
+def insert(conn, table, rows):
+    """Insert `rows` (dicts) into `table`, with COPY on Postgres."""
+
+    if conn.dialect.name != 'postgresql':
+        conn.execute(table.insert(), rows)
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if row[column] is None else row[column]
+                         for column in columns])
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) "
+                       f"FROM STDIN WITH CSV", buffer)
+
+
+class Dataset:
+    """Generator-shaped data, grown a chunk of users at a time."""
+
+    def __init__(self, seed=1):
+        self.rng = random.Random(seed)
+        self.users = read_generated('users')
+        self.messages = read_generated('messages')
+
+        self.messages_per_user = len(self.messages) / len(self.users)
+        self.follows_per_user = (len(read_generated('follows'))
+                                 / len(self.users))
+
+        self.user_ids = []
+        self.message_ids = []
+
+    def grow(self, size):
+        """Add users (and their rows) until there are `size` of them."""
+
+        password = get_bcrypt().generate_password_hash(
+            PASSWORD).decode('UTF-8')
+
+        while len(self.user_ids) < size:
+            self._add_users(min(CHUNK_USERS, size - len(self.user_ids)),
+                            password)
+
+    def _new_ids(self, conn, table, after):
+        return [row_id for (row_id,) in conn.execute(
+            db.select([table.c.id]).where(table.c.id > after)
+            .order_by(table.c.id))]
+
+    def _degree(self, mean, limit):
+        return min(limit, self.rng.randint(0, round(2 * mean)))
+
+    def _add_users(self, count, password):
+        conn = db.session.connection()
+        rng = self.rng
+        first = len(self.user_ids)
+        last_user, last_message = (conn.execute(
+            db.select([db.func.coalesce(db.func.max(model.id), 0)]))
+            .scalar() for model in (User, Message))
+
+        users = []
+        for n in range(first, first + count):
+            row = self.users[n % len(self.users)]
+            users.append({
+                'username': f"{row['username']}-{n}",
+                'email': f"{n}.{row['email']}",
+                'image_url': row['image_url'],
+                'header_image_url': row['header_image_url'],
+                'bio': row['bio'],
+                'location': row['location'],
+                'password': password})
+        insert(conn, User.__table__, users)
+        new_users = self._new_ids(conn, User.__table__, last_user)
+        self.user_ids += new_users
+
+        messages = []
+        for user_id in new_users:
+            for _ in range(self._degree(self.messages_per_user, 100)):
+                row = rng.choice(self.messages)
+                messages.append({
+                    'text': row['text'], 'user_id': user_id,
+                    'timestamp': datetime.fromisoformat(row['timestamp'])})
+        if messages:
+            insert(conn, Message.__table__, messages)
+            self.message_ids += self._new_ids(conn, Message.__table__,
+                                              last_message)
+
+        # Everyone follows (and likes) among those there so far, so the
+        # earliest users end up with the most followers
+        follows, likes = [], []
+        for user_id in new_users:
+            degree = self._degree(self.follows_per_user,
+                                  len(self.user_ids) - 1)
+            followed = set(rng.sample(self.user_ids, degree + 1))
+            followed.discard(user_id)
+            follows += [{'user_being_followed_id': followed_id,
+                         'user_following_id': user_id}
+                        for followed_id in list(followed)[:degree]]
+
+            if self.message_ids:
+                liked = rng.sample(self.message_ids, min(
+                    LIKES_PER_USER, len(self.message_ids)))
+                likes += [{'user_id': user_id, 'message_id': message_id}
+                          for message_id in liked]
+
+        for model, rows in ((Follows, follows), (Likes, likes)):
+            if rows:
+                insert(conn, model.__table__, rows)
+
+        db.session.commit()
+
+
+def benchmarks(data):
+    """{name: (setup, call, writes)}: `call(*setup())` is timed; the
+    writes of those that make any are rolled back."""
+
+    rng = random.Random(len(data.user_ids))
+    serial = itertools.count()
+
+    def user():
+        return (User.query.get(rng.choice(data.user_ids)),)
+
+    def pair():
+        return user() + user()
+
+    def signup(n):
+        User.signup(f"signup-{n}", f"signup-{n}@bench.test", PASSWORD, None)
+        db.session.flush()
+
+    def authenticate(username):
+        assert User.authenticate(username, PASSWORD)
+
+    def post(user_id):
+        Message.post(user_id, "benchmark warble")
+        db.session.flush()
+
+    def post_many(user_id):
+        Message.post_many({'user_id': user_id, 'text': f"benchmark {n}"}
+                          for n in range(POST_MANY_ROWS))
+
+    return {
+        'signup': (lambda: (next(serial),), signup, True),
+        'authenticate': (lambda: (user()[0].username,), authenticate,
+                         False),
+        'is_following': (pair, User.is_following, False),
+        'is_followed_by': (pair, User.is_followed_by, False),
+        'following': (user, lambda user: len(user.following), False),
+        'followers': (user, lambda user: len(user.followers), False),
+        'likes': (user, lambda user: len(user.likes), False),
+        'post': (lambda: (rng.choice(data.user_ids),), post, True),
+        'post_many': (lambda: (rng.choice(data.user_ids),), post_many,
+                      True),
+    }
+
+
+def time_calls(setup, call, samples):
+    """Median, 95th percentile and mean microseconds of `call(*setup())`.
+
+    The session is emptied after every call, so each one loads afresh.
+    """
+
+    call(*setup())
+    db.session.expunge_all()
+
+    times = []
+    for _ in range(samples):
+        args = setup()
+        began = time.perf_counter()
+        call(*args)
+        times.append((time.perf_counter() - began) * 1e6)
+        db.session.expunge_all()
+
+    times.sort()
+    return {'median_us': round(statistics.median(times), 1),
+            'p95_us': round(times[min(len(times) - 1,
+                                      int(len(times) * 0.95))], 1),
+            'mean_us': round(statistics.fmean(times), 1),
+            'samples': samples}
+
+
+def run_size(data, repeat, slow_repeat, only=None):
+    """Time every benchmark (or those in `only`) on `data`; yield
+    results."""
+
+    for name, (setup, call, writes) in benchmarks(data).items():
+        if only and name not in only:
+            continue
+
+        samples = slow_repeat if name in SLOW else repeat
+        savepoint = db.session.begin_nested() if writes else None
+        try:
+            result = time_calls(setup, call, samples)
+        finally:
+            if savepoint is not None:
+                savepoint.rollback()
+
+        yield dict(size=len(data.user_ids), benchmark=name, **result)
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(path, run):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+def find_run(history, ref):
+    """The run `ref` names: its id, an index (-1 is the latest) or a
+    commit (its latest run)."""
+
+    for run in history:
+        if run['id'] == ref:
+            return run
+
+    try:
+        return history[int(ref)]
+    except ValueError:
+        pass
+    except IndexError:
+        raise LookupError(f"no run {ref} in a history of {len(history)}")
+
+    for run in reversed(history):
+        if run['commit'] and (run['commit'].startswith(ref)
+                              or ref.startswith(run['commit'])):
+            return run
+
+    raise LookupError(f"no run with id or commit {ref}")
+
+
+def compare(baseline, candidate, threshold):
+    """Rows of (size, benchmark, baseline us, candidate us, change %,
+    regressed) for every result both runs have."""
+
+    before = {(r['size'], r['benchmark']): r['median_us']
+              for r in baseline['results']}
+    rows = []
+
+    for result in candidate['results']:
+        key = (result['size'], result['benchmark'])
+        if key not in before:
+            continue
+
+        old, new = before[key], result['median_us']
+        change = (new - old) / old * 100 if old else 0.0
+        rows.append(key + (old, new, change, change > threshold))
+
+    return rows
+
+
+def settings(run):
+    return {key: run.get(key) for key in
+            ('database', 'bcrypt_rounds', 'python', 'sqlalchemy')}
+
+
+def is_scratch(url):
+    """Does the name of database `url` say it holds throwaway data?"""
+
+    name = os.path.basename(make_url(url).database or '').lower()
+    return any(word in name for word in SCRATCH_WORDS)
+
+
+def run_command(args):
+    if not (args.yes_drop or is_scratch(args.database)):
+        sys.exit(f"{args.database} doesn't look like a scratch database "
+                 f"(its name has none of {', '.join(SCRATCH_WORDS)}), and "
+                 f"`run` drops every table in it; pass --yes-drop to "
+                 f"run anyway")
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+
+    if args.bcrypt_rounds:
+        app.config['BCRYPT_LOG_ROUNDS'] = args.bcrypt_rounds
+
+    run = {'id': datetime.utcnow().strftime('%Y%m%dT%H%M%S'),
+           'commit': current_commit(),
+           'database': None,
+           'bcrypt_rounds': app.config.get('BCRYPT_LOG_ROUNDS', 12),
+           'python': platform.python_version(),
+           'sqlalchemy': sqlalchemy.__version__,
+           'repeat': args.repeat, 'slow_repeat': args.slow_repeat,
+           'results': []}
+
+    with app.app_context():
+        run['database'] = db.engine.dialect.name
+        db.drop_all()
+        db.create_all()
+
+        data = Dataset(args.seed)
+        for size in sorted(args.sizes):
+            began = time.perf_counter()
+            data.grow(size)
+            print(f"{size} users, {len(data.message_ids)} messages: "
+                  f"grown in {time.perf_counter() - began:.1f}s")
+
+            for result in run_size(data, args.repeat, args.slow_repeat,
+                                   args.only):
+                run['results'].append(result)
+                print(f"  {result['benchmark']:<15} "
+                      f"median {result['median_us']:>10.1f}us  "
+                      f"p95 {result['p95_us']:>10.1f}us")
+
+            db.session.rollback()
+
+    append_history(args.history, run)
+    print(f"run {run['id']} (commit {run['commit']}) added to "
+          f"{args.history}")
+
+
+def compare_command(args):
+    history = load_history(args.history)
+
+    try:
+        baseline = find_run(history, args.baseline)
+        candidate = find_run(history, args.candidate)
+    except LookupError as e:
+        sys.exit(str(e))
+
+    if settings(baseline) != settings(candidate):
+        print(f"warning: runs differ in settings: {settings(baseline)} "
+              f"vs {settings(candidate)}")
+
+    rows = compare(baseline, candidate, args.threshold)
+    print(f"{baseline['id']} ({baseline['commit']}) -> "
+          f"{candidate['id']} ({candidate['commit']}), "
+          f"threshold {args.threshold:g}%")
+
+    for size, name, old, new, change, regressed in rows:
+        print(f"{size:>8} {name:<15} {old:>10.1f}us {new:>10.1f}us "
+              f"{change:>+7.1f}%{'  REGRESSION' if regressed else ''}")
+
+    regressions = sum(row[-1] for row in rows)
+    if regressions:
+        sys.exit(f"{regressions} regression(s) over {args.threshold:g}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--history', default=HISTORY)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="benchmark and add to history")
+    run.add_argument('--database', required=True,
+                     help="URL of the scratch database to fill")
+    run.add_argument('--yes-drop', action='store_true',
+                     help="drop its tables even if its name doesn't say "
+                          "it's a scratch database")
+    run.add_argument('--sizes', type=int, nargs='+',
+                     default=[1000, 10000, 100000, 1000000])
+    run.add_argument('--repeat', type=int, default=200)
+    run.add_argument('--slow-repeat', type=int, default=10,
+                     help="calls of the bcrypt-bound benchmarks")
+    run.add_argument('--bcrypt-rounds', type=int,
+                     help="default: the app's BCRYPT_LOG_ROUNDS")
+    run.add_argument('--only', nargs='+', help="benchmarks to run")
+    run.add_argument('--seed', type=int, default=1)
+    run.set_defaults(func=run_command)
+
+    diff = commands.add_parser('compare', help="flag regressions")
+    diff.add_argument('baseline', nargs='?', default='-2')
+    diff.add_argument('candidate', nargs='?', default='-1')
+    diff.add_argument('--threshold', type=float, default=10,
+                      help="percent slowdown of a median to flag")
+    diff.set_defaults(func=compare_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
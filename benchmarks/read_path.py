@@ -0,0 +1,129 @@
+"""Benchmark the Core read path (reads.py) against loading ORM objects.
+
+Run from the project root against a scratch database:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.read_path
+
+For each size, it makes that many users and messages, then times reading
+a timeline and the user list both ways, the way a request does: a fresh
+session, the query, and every field the template prints. Reports CPU
+time and peak Python memory per request.
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app  # noqa: E402
+from models import db, Message, User  # noqa: E402
+import reads  # noqa: E402
+
+AUTHORS = 10
+
+
+def make_data(size):
+    """`size` users, the first AUTHORS of them with `size` messages in all."""
+
+    prefix = f"readbench{size}-"
+    users = [User(username=f"{prefix}{i}", email=f"{prefix}{i}@bench.test",
+                  password="x", bio="A bio of some length. " * 10)
+             for i in range(size)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    author_ids = [user.id for user in users[:AUTHORS]]
+    Message.post_many({'user_id': author_ids[i % AUTHORS],
+                       'text': f"benchmark warble {i}"}
+                      for i in range(size))
+    db.session.commit()
+
+    return prefix, author_ids, [user.id for user in users]
+
+
+def orm_timeline(author_ids, size):
+    return [(m.id, m.text, m.timestamp, m.like_count, m.user.id,
+             m.user.username, m.user.image_url)
+            for m in Message.feed(author_ids, limit=size)]
+
+
+def core_timeline(author_ids, size):
+    return [(m.id, m.text, m.timestamp, m.like_count, m.user.id,
+             m.user.username, m.user.image_url)
+            for m in reads.feed(author_ids, limit=size)]
+
+
+def orm_users(prefix):
+    return [(u.id, u.username, u.image_url, u.header_image_url, u.bio)
+            for u in User.active().filter(User.username.like(f"%{prefix}%"))]
+
+
+def core_users(prefix):
+    return [(u.id, u.username, u.image_url, u.header_image_url, u.bio)
+            for u in reads.user_cards(prefix)]
+
+
+def measure(function, args, repeat):
+    """(CPU ms, peak KiB) per call of `function(*args)`."""
+
+    # Warm up connections, statement caches and imports
+    function(*args)
+    db.session.remove()
+
+    began = time.process_time()
+    for _ in range(repeat):
+        function(*args)
+        db.session.remove()
+    cpu = (time.process_time() - began) / repeat
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+
+    return cpu * 1000, peak / 1024
+
+
+def run(size, repeat):
+    with app.app_context():
+        prefix, author_ids, user_ids = make_data(size)
+
+        try:
+            for name, orm, core, args in [
+                    ('timeline', orm_timeline, core_timeline,
+                     (author_ids, size)),
+                    ('user list', orm_users, core_users, (prefix,))]:
+                assert orm(*args) == core(*args)
+
+                orm_cpu, orm_peak = measure(orm, args, repeat)
+                core_cpu, core_peak = measure(core, args, repeat)
+
+                print(f"{name:<9} rows={size:<5} "
+                      f"ORM {orm_cpu:7.2f}ms {orm_peak:7.0f}KiB   "
+                      f"Core {core_cpu:7.2f}ms {core_peak:7.0f}KiB   "
+                      f"CPU x{orm_cpu / core_cpu:.1f}, "
+                      f"memory x{orm_peak / core_peak:.1f}")
+        finally:
+            User.query.filter(User.id.in_(user_ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+
+    for size in args.sizes:
+        run(size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""Replay a captured trace against a running Warbler.
+
+Re-drives a trace written by capture.py (see CAPTURE_PATH) against a
+seeded instance, keeping the trace's own timing sped up by --speed, with
+up to --concurrency requests in flight, then prints per route the count,
+error rate and latency percentiles, next to the latency captured live.
+Run it from the project root against the database the server uses:
+
+    DATABASE_URL=postgresql:///warbler python -m benchmarks.replay \\
+        trace.jsonl --base-url http://127.0.0.1:8000 --speed 4
+
+The trace's pseudonymous users and messages are mapped onto this
+database's, the same pseudonym always onto the same row, so a captured
+user's requests all come from one seeded user, logged in with a session
+minted straight into the session store. Logins and signups post their
+form as a browser would, fetching the page first for a CSRF token, with
+--password as every seeded user's password. Search terms and message
+text are made up at their captured lengths.
+
+"errors" are failed requests and 5xx answers. "mismatch" counts answers
+whose status isn't the captured one (a 302 where the trace had a 200,
+say); check those before trusting a route's latencies. "late" is how far
+behind schedule requests started, at p99: if it grows, the replayer
+needs more --concurrency, or the server is saturated.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import queue
+import re
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlencode, urlsplit
+
+# <int:user_id>, <tag>
+PARAM = re.compile(r'<(?:[^:<>]+:)?([^<>]+)>')
+
+CSRF_INPUT = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+FILLER = "warbling away about nothing in particular, "
+
+# Endpoints that aren't replayed, by prefix or as "METHOD endpoint":
+# streams that never finish, and changes that would break the mapping
+SKIP = ['live.', 'warbler.delete_user', 'POST warbler.profile']
+
+# Posted without the user's session, which they log in to (or create)
+ANONYMOUS = {'warbler.login', 'warbler.signup'}
+
+Result = namedtuple('Result', 'route status captured_status captured_ms '
+                              'seconds late')
+
+
+def filler(length):
+    return (FILLER * (length // len(FILLER) + 1))[:length]
+
+
+def load_trace(path):
+    """The records of a capture file, oldest first."""
+
+    with open(path) as f:
+        return sorted((json.loads(line) for line in f if line.strip()),
+                      key=lambda record: record['ts'])
+
+
+class World:
+    """Where a trace's pseudonyms land in the database replayed against."""
+
+    def __init__(self, users, message_ids, mint_cookie,
+                 password='password'):
+        self.users = users
+        self.message_ids = message_ids
+        self.mint_cookie = mint_cookie
+        self.password = password
+        self._cookies = {}
+        self._tokens = {}
+        self._serial = itertools.count()
+        self._lock = threading.Lock()
+
+    def pick(self, pseudonym, rows):
+        return rows[int(pseudonym[2:], 16) % len(rows)]
+
+    def user(self, pseudonym):
+        """(id, username) of the user standing in for `pseudonym`."""
+
+        return self.pick(pseudonym, self.users)
+
+    def value(self, value):
+        """A concrete value for recorded parameter `value`."""
+
+        kind, _, rest = value.partition(':')
+
+        if kind == 'u':
+            return self.user(value)[0]
+        if kind == 'm':
+            return self.pick(value, self.message_ids)
+        if kind == 'i':
+            return int(rest)
+        if kind == 's':
+            return filler(int(rest))
+
+        return value
+
+    def cookie(self, pseudonym):
+        """The session cookie of `pseudonym`'s user, minted once."""
+
+        with self._lock:
+            if pseudonym not in self._cookies:
+                self._cookies[pseudonym] = self.mint_cookie(
+                    self.user(pseudonym)[0])
+
+            return self._cookies[pseudonym]
+
+    def form(self, record):
+        endpoint = record['endpoint']
+        fields = {}
+
+        for name, value in record['form'].items():
+            if name == 'csrf_token':
+                continue
+            elif name == 'password':
+                fields[name] = self.password
+            elif (name == 'username' and endpoint == 'warbler.login'
+                  and record['user']):
+                fields[name] = self.user(record['user'])[1]
+            elif endpoint == 'warbler.signup' and name in ('username',
+                                                           'email'):
+                serial = next(self._serial)
+                fields[name] = (f"replay{serial}" if name == 'username'
+                                else f"replay{serial}@replay.test")
+            else:
+                fields[name] = str(self.value(value))
+
+        return fields
+
+    def request(self, record):
+        """(method, path, form fields, cookie) to replay `record` with."""
+
+        path = PARAM.sub(
+            lambda match: str(self.value(record['args'][match.group(1)])),
+            record['rule'])
+
+        if record['query']:
+            path += '?' + urlencode({name: self.value(value)
+                                     for name, value
+                                     in record['query'].items()})
+
+        cookie = None
+        if record['user'] and record['endpoint'] not in ANONYMOUS:
+            cookie = self.cookie(record['user'])
+
+        return record['method'], path, self.form(record), cookie
+
+    def csrf_token(self, send, path, cookie):
+        """(cookie, token) for posting the form at `path`.
+
+        A logged-in session's token is fetched once; an anonymous post
+        gets a fresh session from the form page, as a browser would.
+        """
+
+        if cookie in self._tokens:
+            return cookie, self._tokens[cookie]
+
+        _, headers, body = send('GET', path, None,
+                                {'Cookie': cookie} if cookie else {})
+        token = CSRF_INPUT.search(body.decode()).group(1)
+
+        if cookie is None:
+            return headers.get('Set-Cookie', '').split(';')[0], token
+
+        self._tokens[cookie] = token
+        return cookie, token
+
+
+class HTTPTarget:
+    """Sends requests to a server, on a keep-alive connection per thread."""
+
+    def __init__(self, base_url, timeout=30):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self, method, path, body, headers):
+        """(status, headers, body) of one request."""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            return resp.status, resp.headers, resp.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+def skipped(record, skip):
+    endpoint = record['endpoint']
+
+    return any(endpoint.startswith(entry)
+               or f"{record['method']} {endpoint}" == entry
+               for entry in skip)
+
+
+def execute(send, world, record):
+    """Replay one record; returns the status answered."""
+
+    method, path, fields, cookie = world.request(record)
+
+    if 'csrf_token' in record['form']:
+        cookie, fields['csrf_token'] = world.csrf_token(send, path, cookie)
+
+    headers = {'Cookie': cookie} if cookie else {}
+    body = None
+
+    if method == 'POST':
+        body = urlencode(fields).encode()
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    status, _, _ = send(method, path, body, headers)
+    return status
+
+
+def replay(records, send, world, speed=1.0, concurrency=16, skip=SKIP):
+    """Replay `records` through `send` on the trace's schedule, `speed`
+    times faster; returns a Result per request sent."""
+
+    jobs = queue.Queue()
+    results = []
+
+    def worker():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+
+            due, record = job
+            began = time.perf_counter()
+
+            try:
+                status = execute(send, world, record)
+            except Exception:
+                # Counted as an error: a failed connection, a form page
+                # without a CSRF token, nothing here to map an id onto
+                status = None
+
+            results.append(Result(
+                f"{record['method']} {record['rule']}", status,
+                record['status'], record['ms'],
+                time.perf_counter() - began, max(began - due, 0)))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    records = [record for record in records if not skipped(record, skip)]
+    start = time.perf_counter()
+
+    for record in records:
+        due = start + (record['ts'] - records[0]['ts']) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        jobs.put((due, record))
+
+    for _ in threads:
+        jobs.put(None)
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(results):
+    """A row of counts and millisecond percentiles per route, busiest
+    first, then one for everything."""
+
+    if not results:
+        return []
+
+    routes = {}
+    for result in results:
+        routes.setdefault(result.route, []).append(result)
+    routes['all'] = results
+
+    rows = []
+    for route, group in routes.items():
+        seconds = sorted(result.seconds * 1000 for result in group)
+        captured = sorted(result.captured_ms for result in group)
+        rows.append({
+            'route': route,
+            'count': len(group),
+            'errors': sum(result.status is None or result.status >= 500
+                          for result in group),
+            'mismatch': sum(result.status != result.captured_status
+                            for result in group),
+            'p50': percentile(seconds, 0.5),
+            'p90': percentile(seconds, 0.9),
+            'p99': percentile(seconds, 0.99),
+            'max': seconds[-1],
+            'captured_p50': percentile(captured, 0.5),
+            'late_p99': percentile(sorted(result.late * 1000
+                                          for result in group), 0.99),
+        })
+
+    return sorted(rows, key=lambda row: (row['route'] == 'all',
+                                         -row['count']))
+
+
+def seeded_world(password):
+    """A World over the users and messages in the configured database."""
+
+    from wsgi import app
+    from benchmarks.serving import session_cookie
+    from models import db, Message, User
+
+    with app.app_context():
+        users = db.session.query(User.id, User.username).filter(
+            User.deleted_at.is_(None)).order_by(User.id).all()
+        message_ids = [message_id for (message_id,) in
+                       db.session.query(Message.id).order_by(Message.id)]
+        db.session.remove()
+
+    if not users:
+        raise SystemExit("No users to replay as: seed the database first")
+
+    return World(users, message_ids, session_cookie, password)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='How many times faster than captured.')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--skip', nargs='*', default=SKIP)
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    if not records:
+        parser.error("the trace is empty")
+
+    began = time.perf_counter()
+    results = replay(records, HTTPTarget(args.base_url),
+                     seeded_world(args.password), args.speed,
+                     args.concurrency, args.skip)
+    elapsed = time.perf_counter() - began
+
+    print(f"{len(results)} requests in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.0f} req/s), "
+          f"trace span {records[-1]['ts'] - records[0]['ts']:.1f}s "
+          f"at {args.speed}x")
+    print(f"{'route':<40} {'count':>6} {'err %':>6} {'mismatch':>8} "
+          f"{'p50 ms':>7} {'p90 ms':>7} {'p99 ms':>7} {'max ms':>7} "
+          f"{'live p50':>8} {'late p99':>8}")
+
+    for row in summarize(results):
+        print(f"{row['route'][:40]:<40} {row['count']:>6} "
+              f"{100 * row['errors'] / row['count']:>6.1f} "
+              f"{row['mismatch']:>8} {row['p50']:>7.1f} {row['p90']:>7.1f} "
+              f"{row['p99']:>7.1f} {row['max']:>7.1f} "
+              f"{row['captured_p50']:>8.1f} {row['late_p99']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
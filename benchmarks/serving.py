@@ -0,0 +1,184 @@
+"""Compare gunicorn worker classes on the Warbler read routes.
+
+Starts `gunicorn wsgi:app` once per worker class, drives it with a fixed
+number of keep-alive HTTP clients for a fixed time and prints throughput
+and latency percentiles. Run it from the project root against a seeded
+database (see seed.py):
+
+    DATABASE_URL=postgresql:///warbler python -m benchmarks.serving
+
+The compared profiles are
+
+    sync     WEB_CONCURRENCY workers, one request at a time each
+    gthread  the same workers with WEB_THREADS threads each
+    gevent   the same workers with cooperative greenlets
+             (needs the gevent and psycogreen packages)
+
+All Warbler routes wait on Postgres, so sync workers top out at roughly
+`workers / query latency` requests per second; once the client count
+exceeds the worker count, extra clients only queue. gthread and gevent
+overlap those waits, so they keep scaling with clients until the CPU or
+the database pool saturates; gevent does it with less memory per
+in-flight request. Compare the p99 columns as well as req/s: a sync
+profile that is close on throughput but far worse on p99 is queueing.
+"""
+
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+
+PROFILES = {
+    'sync': {'WEB_WORKER_CLASS': 'sync'},
+    'gthread': {'WEB_WORKER_CLASS': 'gthread', 'WEB_THREADS': '8'},
+    'gevent': {'WEB_WORKER_CLASS': 'gevent'},
+}
+
+ROUTES = [
+    '/',
+    '/users',
+    '/users?q=a',
+    '/users/{user_id}',
+    '/users/{user_id}/following',
+    '/messages/{message_id}',
+]
+
+
+def session_cookie(user_id):
+    """Return a session cookie logging in `user_id`."""
+
+    from wsgi import app
+    from app import CURR_USER_KEY
+    from sessions import create_session
+
+    with app.app_context():
+        sid = create_session({CURR_USER_KEY: user_id})
+
+    return f"{app.session_cookie_name}={sid}"
+
+
+def wait_for(host, port, timeout=30):
+    """Block until the server accepts connections."""
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=1)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    raise RuntimeError("gunicorn didn't start")
+
+
+def client(host, port, paths, cookie, stop, latencies, errors):
+    """Request `paths` round-robin on one keep-alive connection."""
+
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    headers = {'Cookie': cookie}
+    i = 0
+
+    while not stop.is_set():
+        path = paths[i % len(paths)]
+        i += 1
+        began = time.perf_counter()
+
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status >= 400:
+                errors.append(path)
+        except (OSError, http.client.HTTPException):
+            errors.append(path)
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            continue
+
+        latencies.append(time.perf_counter() - began)
+
+
+def drive(host, port, paths, cookie, clients, duration):
+    """Run `clients` clients for `duration` seconds; return the samples."""
+
+    stop = threading.Event()
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(target=client,
+                         args=(host, port, paths, cookie, stop, latencies,
+                               errors))
+        for _ in range(clients)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(duration)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    return sorted(latencies), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES),
+                        choices=list(PROFILES))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[4, 16, 64])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--user-id', type=int, default=1)
+    parser.add_argument('--message-id', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    host = '127.0.0.1'
+    paths = [route.format(user_id=args.user_id, message_id=args.message_id)
+             for route in ROUTES]
+    cookie = session_cookie(args.user_id)
+
+    print(f"{'profile':<8} {'clients':>7} {'req/s':>8} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>6}")
+
+    for name in args.profiles:
+        env = dict(os.environ, **PROFILES[name],
+                   WEB_CONCURRENCY=str(args.workers),
+                   WEB_BIND=f"{host}:{args.port}")
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'wsgi:app'], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        try:
+            wait_for(host, args.port)
+
+            for clients in args.clients:
+                latencies, errors = drive(host, args.port, paths, cookie,
+                                          clients, args.duration)
+                count = len(latencies)
+
+                if not count:
+                    print(f"{name:<8} {clients:>7} no successful requests")
+                    continue
+
+                print(f"{name:<8} {clients:>7} "
+                      f"{len(latencies) / args.duration:>8.0f} "
+                      f"{latencies[count // 2] * 1000:>8.1f} "
+                      f"{latencies[int(count * 0.99)] * 1000:>8.1f} "
+                      f"{len(errors):>6}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
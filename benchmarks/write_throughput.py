@@ -0,0 +1,129 @@
+"""Benchmark the message write path with many concurrent posters.
+
+Run from the project root against a scratch database:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.write_throughput
+
+Each poster thread writes messages for its own user, either one INSERT
+and COMMIT per message (what `messages_add()` does) or in batches through
+`Message.post_many()`. For every mode we report throughput, commit latency
+percentiles and whether the server-side timestamps kept messages apart.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+os.environ.setdefault('DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app  # noqa: E402
+from models import db, User, Message  # noqa: E402
+
+
+def percentile(samples, pct):
+    """Return the `pct` percentile of a list of samples."""
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def make_posters(count):
+    """Create `count` users to post with; return their ids."""
+
+    users = [
+        User(username=f"poster{i}", email=f"poster{i}@bench.test",
+             password="x")
+        for i in range(count)
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def poster(user_id, messages, batch_size, latencies, start):
+    """Post `messages` warbles as `user_id`, recording commit latency."""
+
+    with app.app_context():
+        start.wait()
+
+        for offset in range(0, messages, batch_size):
+            rows = [
+                {"user_id": user_id, "text": f"warble {offset + i}"}
+                for i in range(min(batch_size, messages - offset))
+            ]
+            began = time.perf_counter()
+
+            if batch_size == 1:
+                Message.post(user_id, rows[0]["text"])
+            else:
+                Message.post_many(rows)
+
+            db.session.commit()
+            latencies.append(time.perf_counter() - began)
+
+        db.session.remove()
+
+
+def run(posters, messages, batch_size):
+    """Run one round and print its results."""
+
+    with app.app_context():
+        Message.query.delete()
+        db.session.commit()
+        user_ids = make_posters(posters)
+
+    latencies = []
+    start = threading.Barrier(posters + 1)
+    threads = [
+        threading.Thread(target=poster,
+                         args=(user_id, messages, batch_size, latencies, start))
+        for user_id in user_ids
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    start.wait()
+    began = time.perf_counter()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - began
+
+    with app.app_context():
+        total = Message.query.count()
+        distinct = db.session.query(
+            db.func.count(db.distinct(Message.timestamp))).scalar()
+        User.query.filter(User.id.in_(user_ids)).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+    print(f"batch={batch_size:<4} posters={posters:<3} "
+          f"{total / elapsed:>9.0f} msg/s  "
+          f"commit p50={percentile(latencies, 50) * 1000:.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.2f}ms  "
+          f"distinct timestamps {distinct}/{total}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posters", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--messages", type=int, default=500,
+                        help="messages written by each poster")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 50])
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+
+    for batch_size in args.batch_sizes:
+        for posters in args.posters:
+            run(posters, args.messages, batch_size)
+
+
+if __name__ == "__main__":
+    main()
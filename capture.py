@@ -0,0 +1,180 @@
+"""Opt-in capture of live traffic, for replaying as a load test.
+
+With CAPTURE_PATH set, every request (but those to endpoints starting
+with one of CAPTURE_SKIP) appends a line of JSON to that file:
+
+    {"ts": 1700000000.25, "method": "POST",
+     "endpoint": "warbler.like_message",
+     "rule": "/messages/<int:message_id>/like",
+     "args": {"message_id": "m:3fa2c0d19e7b4a61"}, "query": {},
+     "form": {}, "user": "u:81be0c2f5d9a6e13",
+     "status": 302, "ms": 4.1}
+
+Nothing identifying is kept. User and message ids become pseudonyms, an
+HMAC of the id under SECRET_KEY, so the same user is the same pseudonym
+throughout a trace (and across workers) but can't be turned back into an
+id without the key. Other strings -- search terms, message text, tags --
+are kept only as their length ("s:42"), and passwords and CSRF tokens
+only as "secret". "user" is whoever is logged in once the request is done, so
+a login is recorded as the user it logged in.
+
+Lines are buffered per process and appended CAPTURE_BUFFER at a time (or
+at least once a second) in a single write, so workers sharing the file
+don't interleave. Replay a trace with benchmarks/replay.py.
+"""
+
+import atexit
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import current_app, g, request, session
+
+# View args and query parameters holding ids, and what they're ids of
+ID_KINDS = {'user_id': 'u', 'follow_id': 'u', 'message_id': 'm',
+            'before': 'm'}
+
+# Form fields recorded only as being there, not even their length
+SECRET_FIELDS = {'password', 'csrf_token'}
+
+
+class CaptureLog:
+    """Buffered appends of trace lines to one file."""
+
+    def __init__(self, path, buffer_size=100, flush_interval=1.0):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._lines = []
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # First use in this process (gunicorn forks after import):
+                # lines buffered by the parent aren't ours to write
+                self._pid = os.getpid()
+                self._lines = []
+                atexit.register(self.flush)
+
+            self._lines.append(line)
+
+            if (len(self._lines) >= self.buffer_size
+                    or time.monotonic() - self._flushed
+                    >= self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._flushed = time.monotonic()
+
+        if not self._lines:
+            return
+
+        data = ''.join(self._lines).encode()
+        self._lines = []
+
+        # O_APPEND and one write per batch: batches from different
+        # processes land whole
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+def pseudonym(kind, value):
+    """A stable, keyed stand-in for id `value` of a `kind` ('u' or 'm')."""
+
+    key = current_app.config['SECRET_KEY'].encode()
+    digest = hmac.new(key, f"{kind}:{value}".encode(), hashlib.sha256)
+
+    return f"{kind}:{digest.hexdigest()[:16]}"
+
+
+def anonymize(name, value):
+    """What's recorded of parameter `name`'s `value`."""
+
+    kind = ID_KINDS.get(name)
+
+    if kind and str(value).isdigit():
+        return pseudonym(kind, value)
+    if isinstance(value, int):
+        return f"i:{value}"
+
+    return f"s:{len(value)}"
+
+
+def get_capture_log():
+    return current_app.extensions.get('capture_log')
+
+
+def start_capture(started=None):
+    if get_capture_log() is not None:
+        g.capture_started = started or time.perf_counter()
+
+
+def record_status(response):
+    g.capture_status = response.status_code
+    return response
+
+
+def finish_capture(exc):
+    """Append a line for this request (even one that raised)."""
+
+    if 'capture_started' not in g or request.url_rule is None:
+        return
+
+    endpoint = request.endpoint or ''
+    if endpoint.startswith(tuple(current_app.config['CAPTURE_SKIP'])):
+        return
+
+    # Imported here: app.py imports this module
+    from app import CURR_USER_KEY
+
+    user_id = session.get(CURR_USER_KEY)
+
+    get_capture_log().write({
+        'ts': round(time.time(), 3),
+        'method': request.method,
+        'endpoint': endpoint,
+        'rule': request.url_rule.rule,
+        'args': {name: anonymize(name, value)
+                 for name, value in (request.view_args or {}).items()},
+        'query': {name: anonymize(name, value)
+                  for name, value in request.args.items()},
+        'form': {name: ('secret' if name in SECRET_FIELDS
+                        else anonymize(name, value))
+                 for name, value in request.form.items()},
+        'user': pseudonym('u', user_id) if user_id is not None else None,
+        'status': g.get('capture_status', 500),
+        'ms': round((time.perf_counter() - g.capture_started) * 1000, 2),
+    })
+
+
+def init_app(app):
+    """Capture `app`'s requests when CAPTURE_PATH is set."""
+
+    app.config.setdefault('CAPTURE_PATH', os.environ.get('CAPTURE_PATH'))
+    app.config.setdefault('CAPTURE_BUFFER', 100)
+    app.config.setdefault('CAPTURE_SKIP',
+                          ['static', 'assets.', 'profiler.', 'export.'])
+
+    if app.config['CAPTURE_PATH']:
+        app.extensions['capture_log'] = CaptureLog(
+            app.config['CAPTURE_PATH'], app.config['CAPTURE_BUFFER'])
+
+    app.before_request(start_capture)
+    app.after_request(record_status)
+    app.teardown_request(finish_capture)
@@ -0,0 +1,345 @@
+"""Streaming exports of a user's messages, likes and follows.
+
+A logged-in user downloads their own data from
+
+    /users/<user_id>/export?format=ndjson    (or format=csv)
+
+One record per line: their messages, the messages they like, who they
+follow and who follows them. Rows come off server-side cursors
+(`stream_results`) EXPORT_CHUNK_ROWS at a time and go out as a chunked
+response as they're read, so an export holds a chunk in memory however
+big the account is.
+
+The same from the command line, for one user or (in parallel worker
+processes, one file per user) for everyone:
+
+    FLASK_APP=app.py flask export user 42 --format csv > 42.csv
+    FLASK_APP=app.py flask export all --directory exports/ --workers 4
+
+Operators can start `export all` in the background, into
+EXPORT_DIRECTORY, and watch for it to finish:
+
+    curl -X POST -H "Authorization: Bearer $ADMIN_TOKEN" .../admin/exports
+    curl -H "Authorization: Bearer $ADMIN_TOKEN" .../admin/exports
+"""
+
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+from multiprocessing import Pool
+
+import click
+from flask import (
+    Blueprint, Response, abort, current_app, flash, g, jsonify, redirect,
+    request, stream_with_context,
+)
+from flask.cli import AppGroup
+
+import shards
+from admin import admin_required
+from models import db, Follows, Likes, Message, User
+
+export = Blueprint('export', __name__)
+
+export_cli = AppGroup('export', help='Export user data.')
+
+FIELDS = ['type', 'id', 'timestamp', 'text', 'like_count', 'message_id',
+          'user_id', 'username']
+
+CHUNK_BYTES = 64 * 1024
+
+MANIFEST = 'MANIFEST.json'
+
+
+def _rows(conn, query, chunk_rows):
+    """The rows of `query`, fetched `chunk_rows` at a time from a
+    server-side cursor."""
+
+    result = conn.execution_options(stream_results=True).execute(query)
+
+    try:
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        result.close()
+
+
+def _follows(conn, user_id, chunk_rows, followers=False):
+    if followers:
+        kind, theirs, mine = ('follower', Follows.user_following_id,
+                              Follows.user_being_followed_id)
+    else:
+        kind, theirs, mine = ('following', Follows.user_being_followed_id,
+                              Follows.user_following_id)
+
+    query = (db.select([User.id, User.username])
+             .select_from(Follows.__table__.join(User.__table__,
+                                                 User.id == theirs))
+             .where(mine == user_id)
+             .order_by(User.id))
+
+    for other_id, username in _rows(conn, query, chunk_rows):
+        yield {'type': kind, 'user_id': other_id, 'username': username}
+
+
+def records(user_id, chunk_rows=None):
+    """Everything of `user_id`'s, as a dict per message, like and follow."""
+
+    if chunk_rows is None:
+        chunk_rows = current_app.config['EXPORT_CHUNK_ROWS']
+
+    # Messages and likes are on the user's shard when sharding is on
+    if shards.enabled():
+        _, engine = shards.get_shards().for_user(user_id)
+        messages, likes = shards.messages, shards.likes
+        conn = engine.connect()
+    else:
+        messages, likes = Message.__table__, Likes.__table__
+        conn = None
+
+    main = db.session.connection()
+
+    try:
+        for message_id, text, timestamp, like_count in _rows(
+                conn or main,
+                db.select([messages.c.id, messages.c.text,
+                           messages.c.timestamp, messages.c.like_count])
+                .where(messages.c.user_id == user_id)
+                .order_by(messages.c.id),
+                chunk_rows):
+            yield {'type': 'message', 'id': message_id,
+                   'timestamp': timestamp.isoformat(), 'text': text,
+                   'like_count': like_count}
+
+        for (message_id,) in _rows(
+                conn or main,
+                db.select([likes.c.message_id])
+                .where(likes.c.user_id == user_id)
+                .order_by(likes.c.message_id),
+                chunk_rows):
+            yield {'type': 'like', 'message_id': message_id}
+    finally:
+        if conn is not None:
+            conn.close()
+
+    yield from _follows(main, user_id, chunk_rows)
+    yield from _follows(main, user_id, chunk_rows, followers=True)
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def csv_lines(records):
+    """A header, then a row per record; fields a record doesn't have are
+    left empty."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, FIELDS)
+    writer.writeheader()
+
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+
+def chunked(lines, size=CHUNK_BYTES):
+    """`lines`, joined and encoded into chunks of about `size` bytes."""
+
+    chunk, length = [], 0
+
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+
+        if length >= size:
+            yield ''.join(chunk).encode()
+            chunk, length = [], 0
+
+    if chunk:
+        yield ''.join(chunk).encode()
+
+
+def stream(user_id, fmt='ndjson'):
+    """`user_id`'s export in format `fmt`, as chunks of bytes."""
+
+    lines, _ = FORMATS[fmt]
+    return chunked(lines(records(user_id)))
+
+
+@export.route('/users/<int:user_id>/export')
+def export_user(user_id):
+    """Download the logged-in user's own data."""
+
+    if not g.user or g.user.id != user_id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+
+    return Response(
+        stream_with_context(stream(user_id, fmt)),
+        mimetype=FORMATS[fmt][1],
+        headers={'Content-Disposition':
+                 f'attachment; filename=warbler-{user_id}.{fmt}'})
+
+
+@export.route('/admin/exports', methods=['POST'])
+@admin_required
+def start_export():
+    """Export every user in the background, with `flask export all`."""
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        abort(400)
+
+    name = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    directory = os.path.join(current_app.config['EXPORT_DIRECTORY'], name)
+    os.makedirs(directory)
+
+    subprocess.Popen(
+        [sys.executable, '-m', 'flask', 'export', 'all',
+         '--directory', directory, '--format', fmt,
+         '--workers', str(current_app.config['EXPORT_WORKERS'])],
+        cwd=current_app.root_path, start_new_session=True,
+        env={**os.environ, 'FLASK_APP': 'app.py'},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return jsonify(name=name, directory=directory), 202
+
+
+@export.route('/admin/exports')
+@admin_required
+def list_exports():
+    """Export runs, and the manifest of each one that has finished."""
+
+    root = current_app.config['EXPORT_DIRECTORY']
+    runs = []
+
+    for name in sorted(os.listdir(root) if os.path.isdir(root) else []):
+        try:
+            with open(os.path.join(root, name, MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = None
+
+        runs.append({'name': name, 'finished': manifest is not None,
+                     'manifest': manifest})
+
+    return jsonify(exports=runs)
+
+
+def write_export(user_id, path, fmt):
+    """Write `user_id`'s export to `path`; returns the bytes written."""
+
+    written = 0
+    partial = f"{path}.partial"
+
+    with open(partial, 'wb') as f:
+        for chunk in stream(user_id, fmt):
+            f.write(chunk)
+            written += len(chunk)
+
+    os.replace(partial, path)
+    return written
+
+
+def _export_worker(job):
+    try:
+        return write_export(*job)
+    finally:
+        db.session.remove()
+
+
+def _init_worker(app):
+    # Each process needs its own connections, and an app context to
+    # find the engine through
+    app.app_context().push()
+    db.engine.dispose()
+
+
+@export_cli.command('user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)),
+              default='ndjson', show_default=True)
+@click.option('--output', type=click.File('wb'), default='-',
+              help='File to write (default: stdout).')
+def export_user_command(user_id, fmt, output):
+    """Export one user's messages, likes and follows."""
+
+    for chunk in stream(user_id, fmt):
+        output.write(chunk)
+
+
+@export_cli.command('all')
+@click.option('--directory', required=True,
+              type=click.Path(file_okay=False),
+              help='Where to write a file per user, and MANIFEST.json.')
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)),
+              default='ndjson', show_default=True)
+@click.option('--workers', default=4, show_default=True,
+              help='Processes exporting users in parallel.')
+def export_all_command(directory, fmt, workers):
+    """Export every user, a file each."""
+
+    os.makedirs(directory, exist_ok=True)
+
+    user_ids = [user_id for (user_id,) in
+                db.session.query(User.id).order_by(User.id)]
+    db.session.remove()
+
+    jobs = [(user_id, os.path.join(directory, f"{user_id}.{fmt}"), fmt)
+            for user_id in user_ids]
+
+    app = current_app._get_current_object()
+    db.engine.dispose()
+
+    started = datetime.utcnow()
+    written = 0
+
+    with Pool(workers, initializer=_init_worker, initargs=(app,)) as pool:
+        for done, size in enumerate(
+                pool.imap_unordered(_export_worker, jobs, chunksize=16), 1):
+            written += size
+            if done % 100 == 0:
+                click.echo(f"Exported {done} users", err=True)
+
+    # Written last, so its presence means the export is complete
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump({'format': fmt, 'users': len(jobs), 'bytes': written,
+                   'started_at': started.isoformat(),
+                   'finished_at': datetime.utcnow().isoformat()}, f)
+
+    click.echo(f"Exported {len(jobs)} users ({written} bytes) to {directory}")
+
+
+def init_app(app):
+    """Serve exports from `app`, and add the `flask export` commands."""
+
+    app.config.setdefault('EXPORT_CHUNK_ROWS', 1000)
+    app.config.setdefault('EXPORT_WORKERS', 4)
+    app.config.setdefault('EXPORT_DIRECTORY',
+                          os.path.join(app.instance_path, 'exports'))
+
+    app.register_blueprint(export)
+    app.cli.add_command(export_cli)
@@ -0,0 +1,460 @@
+"""Read-through cache for timelines and profiles, stale-while-revalidate.
+
+`homepage()` and `users_show()` read their data through here instead of
+straight from the database:
+
+    feed:<viewer id>:<cursor>   the viewer's home timeline (cursor "" for
+                                the first page)
+    profile:<user id>           a user's profile, counts and messages
+
+Entries are the plain records of reads.py, not ORM objects, so they
+outlive the session that loaded them and can be kept in Redis.
+
+An entry younger than FEEDCACHE_TTL is served as is. An older one is
+still served, for up to FEEDCACHE_MAX_STALE seconds, while a single
+background refresh replaces it: the refresh claims the key first, so one
+hot key gets one recompute, not one per request (or per worker, with a
+shared store). Misses are computed inline, with concurrent misses for
+the same key in a process waiting on the one computing it.
+
+A circuit breaker watches those recomputes. After FEEDCACHE_BREAKER_
+FAILURES in a row that fail or take over FEEDCACHE_SLOW_SECONDS, it opens
+for FEEDCACHE_BREAKER_COOLDOWN seconds: no refreshes are started, and
+entries of any age are served rather than asking the struggling database
+again. Then a single refresh is let through to test the water. So that
+there's something to serve, a shared store keeps entries for
+FEEDCACHE_KEEP seconds, well past FEEDCACHE_MAX_STALE.
+
+Writes invalidate what they change (`invalidate_feed()`,
+`invalidate_profile()`). A new message or profile edit only invalidates
+its author's own pages; followers' timelines pick it up within
+FEEDCACHE_TTL, and open ones get new messages pushed by live.py straight
+away. Deleting a message or an account also drops the followers'
+timelines (`invalidate_author()`), so it's gone from them at once.
+
+FEEDCACHE_URL picks the store: memory:// (per process) or redis://...,
+shared by every worker and node (needs `redis`). Invalidating a memory
+store only reaches the worker that made the write, and the next request
+may well land on another, so the cache is only on by default with a
+shared store, and refuses to start on memory:// with more than one
+worker (WEB_CONCURRENCY). FEEDCACHE_ENABLED=1 turns it on with memory://
+for a single worker.
+"""
+
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from flask import abort, current_app
+from werkzeug.exceptions import HTTPException
+
+import graph
+import reads
+import shards
+from models import db, Follows
+
+# Followers' timelines dropped per store call by invalidate_author()
+INVALIDATE_BATCH = 1000
+
+
+class MemoryStore:
+    """Entries in an LRU dict, shared by this process's threads."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._claims = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def claim(self, key, ttl):
+        """Take the right to refresh `key` for `ttl` seconds, if it's free."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            if self._claims.get(key, 0) > now:
+                return False
+            self._claims[key] = now + ttl
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._claims.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._claims.clear()
+
+
+class RedisStore:
+    """Entries in Redis, shared by every process using it."""
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        data = self.redis.get(f"feedcache:{key}")
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, entry, ttl):
+        self.redis.set(f"feedcache:{key}", pickle.dumps(entry), ex=ttl)
+
+    def delete(self, *keys):
+        self.redis.delete(*(f"feedcache:{key}" for key in keys))
+
+    def claim(self, key, ttl):
+        return bool(self.redis.set(f"feedcache-claim:{key}", 1,
+                                   nx=True, ex=ttl))
+
+    def release(self, key):
+        self.redis.delete(f"feedcache-claim:{key}")
+
+    def clear(self):
+        for key in self.redis.scan_iter('feedcache*'):
+            self.redis.delete(key)
+
+
+def open_store(url, max_entries=10000):
+    """The cache store for FEEDCACHE_URL `url`."""
+
+    if url.startswith('memory:'):
+        return MemoryStore(max_entries)
+    if url.startswith(('redis:', 'rediss:')):
+        return RedisStore(url)
+
+    raise ValueError(f"Unknown feed cache store: {url}")
+
+
+class CircuitBreaker:
+    """Stop calling something that keeps failing or being slow."""
+
+    def __init__(self, failures=3, cooldown=30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failed = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        """May a call go ahead? Once cooled down, lets one probe through."""
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if (not self._probing
+                    and time.monotonic() - self._opened_at >= self.cooldown):
+                self._probing = True
+                return True
+
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+
+            if ok:
+                self._failed = 0
+                self._opened_at = None
+                return
+
+            self._failed += 1
+
+            if self._opened_at is not None or self._failed >= self.failures:
+                self._opened_at = time.monotonic()
+
+
+class FeedCache:
+    """Stale-while-revalidate reads through a store, with a breaker."""
+
+    def __init__(self, app, store):
+        self.app = app
+        self.store = store
+        self.breaker = CircuitBreaker(app.config['FEEDCACHE_BREAKER_FAILURES'],
+                                      app.config['FEEDCACHE_BREAKER_COOLDOWN'])
+        self._computing = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        if self._pid != os.getpid():
+            # Threads don't survive gunicorn's fork
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(
+                self.app.config['FEEDCACHE_REFRESH_THREADS'],
+                thread_name_prefix='feedcache')
+        return self._executor
+
+    def _compute(self, compute):
+        """Run `compute`, telling the breaker how it went."""
+
+        started = time.monotonic()
+
+        try:
+            value = compute()
+        except HTTPException:
+            raise
+        except Exception:
+            self.breaker.record(False)
+            raise
+
+        self.breaker.record(time.monotonic() - started
+                            < self.app.config['FEEDCACHE_SLOW_SECONDS'])
+        return value
+
+    def _store(self, key, value):
+        self.store.set(key, (value, time.time()),
+                       self.app.config['FEEDCACHE_KEEP'])
+
+    def _refresh(self, key, compute):
+        try:
+            with self.app.app_context():
+                try:
+                    self._store(key, self._compute(compute))
+                finally:
+                    db.session.remove()
+        except HTTPException:
+            # Gone (say, a deleted user); the next read will 404 properly
+            self.store.delete(key)
+        except Exception:
+            self.app.logger.exception("Refreshing %s failed", key)
+        finally:
+            self.store.release(key)
+
+    def _compute_once(self, key, compute):
+        """Compute a missing entry, sharing the work with other threads."""
+
+        with self._lock:
+            waiting = self._computing.get(key)
+            if waiting is None:
+                self._computing[key] = waiting = SimpleNamespace(
+                    done=threading.Event(), value=None, error=None)
+                mine = True
+            else:
+                mine = False
+
+        if not mine:
+            waiting.done.wait()
+            if waiting.error is not None:
+                raise waiting.error
+            return waiting.value
+
+        try:
+            waiting.value = self._compute(compute)
+            self._store(key, waiting.value)
+            return waiting.value
+        except Exception as exc:
+            waiting.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._computing[key]
+            waiting.done.set()
+
+    def get(self, key, compute):
+        """The value for `key`, from the cache or from `compute()`.
+
+        `compute` runs in an app context, possibly on another thread.
+        """
+
+        config = self.app.config
+        entry = self.store.get(key)
+
+        if entry is not None:
+            value, stored_at = entry
+            age = time.time() - stored_at
+
+            if age < config['FEEDCACHE_TTL']:
+                return value
+
+            if age < config['FEEDCACHE_MAX_STALE'] or self.breaker.open:
+                if self.store.claim(key, config['FEEDCACHE_TTL']):
+                    if self.breaker.allow():
+                        self.executor.submit(self._refresh, key, compute)
+                    else:
+                        self.store.release(key)
+                return value
+
+        try:
+            return self._compute_once(key, compute)
+        except HTTPException:
+            raise
+        except Exception:
+            if entry is None:
+                raise
+
+            # Better old than nothing while the database is in trouble
+            self.app.logger.exception("Serving stale %s", key)
+            return entry[0]
+
+    def invalidate(self, *keys):
+        if keys:
+            self.store.delete(*keys)
+
+    def clear(self):
+        self.store.clear()
+
+
+def get_feed_cache():
+    """The current app's feed cache."""
+
+    return current_app.extensions['feed_cache']
+
+
+def cached(key, compute):
+    """`compute()`, through the feed cache when it's enabled."""
+
+    if not current_app.config['FEEDCACHE_ENABLED']:
+        return compute()
+    return get_feed_cache().get(key, compute)
+
+
+def feed_key(viewer_id, cursor=None):
+    return f"feed:{viewer_id}:{cursor or ''}"
+
+
+def profile_key(user_id):
+    return f"profile:{user_id}"
+
+
+def invalidate_feed(viewer_id):
+    """Drop the cached timeline of `viewer_id`."""
+
+    if current_app.config['FEEDCACHE_ENABLED']:
+        get_feed_cache().invalidate(feed_key(viewer_id))
+
+
+def invalidate_profile(*user_ids):
+    """Drop the cached profiles of `user_ids`."""
+
+    if current_app.config['FEEDCACHE_ENABLED']:
+        get_feed_cache().invalidate(*map(profile_key, user_ids))
+
+
+def invalidate_author(user_id):
+    """Drop `user_id`'s profile and timeline and their followers'
+    timelines, after something of theirs is deleted."""
+
+    if not current_app.config['FEEDCACHE_ENABLED']:
+        return
+
+    cache = get_feed_cache()
+    cache.invalidate(profile_key(user_id), feed_key(user_id))
+
+    followers = (db.session.query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .yield_per(INVALIDATE_BATCH))
+    batch = []
+
+    for (follower_id,) in followers:
+        batch.append(feed_key(follower_id))
+
+        if len(batch) == INVALIDATE_BATCH:
+            cache.invalidate(*batch)
+            batch = []
+
+    cache.invalidate(*batch)
+
+
+def load_home_feed(viewer_id):
+    """The messages on `viewer_id`'s home timeline."""
+
+    feed = shards.feed if shards.enabled() else reads.feed
+    return feed(graph.followed_ids(viewer_id) + [viewer_id],
+                window=current_app.config['MESSAGES_FEED_WINDOW'])
+
+
+def load_profile(user_id):
+    """An active user's profile: details, counts, messages."""
+
+    profile = shards.profile if shards.enabled() else reads.profile
+    user = profile(user_id, window=current_app.config['MESSAGES_FEED_WINDOW'])
+
+    if user is None:
+        abort(404)
+
+    user.stats.following = graph.following_count(user)
+    user.stats.followers = graph.follower_count(user)
+    return user
+
+
+def home_feed(viewer_id):
+    """`viewer_id`'s home timeline, through the cache."""
+
+    return cached(feed_key(viewer_id), lambda: load_home_feed(viewer_id))
+
+
+def profile(user_id):
+    """`user_id`'s profile record, through the cache; 404s if there's none."""
+
+    return cached(profile_key(user_id), lambda: load_profile(user_id))
+
+
+def profile_stats(user):
+    """Message, like, following and follower counts of `user`."""
+
+    stats = getattr(user, 'stats', None)
+    return stats if stats is not None else profile(user.id).stats
+
+
+def init_app(app):
+    """Cache `app`'s timelines and profiles."""
+
+    app.config.setdefault('FEEDCACHE_URL',
+                          os.environ.get('FEEDCACHE_URL', 'memory://'))
+    shared = not app.config['FEEDCACHE_URL'].startswith('memory:')
+    app.config.setdefault('FEEDCACHE_ENABLED', os.environ.get(
+        'FEEDCACHE_ENABLED', '1' if shared else '0') == '1')
+    app.config.setdefault('FEEDCACHE_TTL', 10)
+    app.config.setdefault('FEEDCACHE_MAX_STALE', 10 * 60)
+    app.config.setdefault('FEEDCACHE_KEEP',
+                          6 * app.config['FEEDCACHE_MAX_STALE'])
+    app.config.setdefault('FEEDCACHE_MAX_ENTRIES', 10000)
+    app.config.setdefault('FEEDCACHE_REFRESH_THREADS', 2)
+    app.config.setdefault('FEEDCACHE_SLOW_SECONDS', 0.5)
+    app.config.setdefault('FEEDCACHE_BREAKER_FAILURES', 3)
+    app.config.setdefault('FEEDCACHE_BREAKER_COOLDOWN', 30)
+
+    if (app.config['FEEDCACHE_ENABLED'] and not shared
+            and app.config['WEB_CONCURRENCY'] > 1):
+        raise ValueError("The feed cache needs a shared FEEDCACHE_URL "
+                         "(redis://...) with more than one worker")
+
+    app.extensions['feed_cache'] = FeedCache(app, open_store(
+        app.config['FEEDCACHE_URL'], app.config['FEEDCACHE_MAX_ENTRIES']))
+
+    app.add_template_global(profile_stats)
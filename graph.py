@@ -0,0 +1,456 @@
+"""The follow graph, held in memory as packed adjacency arrays.
+
+Reading who a user follows through `User.following` loads a User row for
+every followed account. With GRAPH_INDEX_ENABLED, each process instead
+keeps the whole `follows` table as two CSR ("compressed sparse row")
+adjacency structures, one per direction: an `offsets` array indexed by
+user id and a `targets` array holding every user's neighbours, sorted,
+back to back. That's 4 bytes per edge per direction plus 8 bytes per user
+id per direction, and a membership test is a binary search over one
+user's slice.
+
+The arrays are immutable. Follows and unfollows made by this process
+(`add_follow()`, `stop_following()`) go into small per-user overlays on
+top. Every GRAPH_RELOAD_INTERVAL seconds the graph is reloaded from the
+database in the background, which folds the overlays in and picks up
+follows made by other processes.
+
+So the graph can be minutes behind on follows made through other
+workers. That's fine for counts and for other people's follows, but not
+for the logged-in user's own, which they expect to see at once wherever
+their next request lands: their home timeline, follow buttons and own
+following page read the ids they follow from the database.
+
+The following and followers pages show FOLLOW_PAGE_SIZE users at a time,
+in id order: a page's ids are a slice of a neighbour list, and only that
+page's users are loaded.
+
+See benchmarks/follow_graph.py for memory and query costs at 10M edges.
+"""
+
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+from flask import current_app, g
+
+import reads
+import writebuffer
+from models import db, Follows, User
+
+# Guards loading and starting reloads, per process
+_lock = threading.Lock()
+
+
+def _zeros(typecode, length):
+    return array(typecode, bytes(array(typecode).itemsize * length))
+
+
+class Adjacency:
+    """Sorted neighbour lists of integer nodes, packed CSR-style.
+
+    Nodes are the ints 0..size-1; `targets[offsets[n]:offsets[n + 1]]`
+    are node n's neighbours in ascending order. Changes go into the
+    `added` and `removed` overlays.
+    """
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+        self.added = {}
+        self.removed = {}
+
+    @classmethod
+    def from_sorted(cls, pairs, size):
+        """Build from (node, neighbour) pairs sorted by node, then neighbour.
+
+        `size` is a hint; nodes past it grow the arrays.
+        """
+
+        counts = _zeros('q', size + 1)
+        targets = array('i')
+
+        for node, neighbour in pairs:
+            if node >= size:
+                counts.extend(_zeros('q', node + 1 - size))
+                size = node + 1
+
+            counts[node + 1] += 1
+            targets.append(neighbour)
+
+        return cls(array('q', accumulate(counts)), targets)
+
+    @property
+    def size(self):
+        return len(self.offsets) - 1
+
+    def transpose(self):
+        """The same edges, pointing the other way (ignores the overlays)."""
+
+        offsets, targets = self.offsets, self.targets
+        size = max(self.size, max(targets, default=-1) + 1)
+
+        counts = _zeros('q', size + 1)
+        for target in targets:
+            counts[target + 1] += 1
+
+        reverse = array('q', accumulate(counts))
+        position = array('q', reverse)
+        sources = _zeros('i', len(targets))
+
+        # Walking sources in order leaves every reversed list sorted
+        for node in range(self.size):
+            for index in range(offsets[node], offsets[node + 1]):
+                target = targets[index]
+                sources[position[target]] = node
+                position[target] += 1
+
+        return Adjacency(reverse, sources)
+
+    def _base(self, node):
+        if 0 <= node < self.size:
+            return self.offsets[node], self.offsets[node + 1]
+        return 0, 0
+
+    def _base_contains(self, node, neighbour):
+        low, high = self._base(node)
+        index = bisect_left(self.targets, neighbour, low, high)
+        return index < high and self.targets[index] == neighbour
+
+    def contains(self, node, neighbour):
+        """Is there an edge from `node` to `neighbour`?"""
+
+        if neighbour in self.added.get(node, ()):
+            return True
+        if neighbour in self.removed.get(node, ()):
+            return False
+        return self._base_contains(node, neighbour)
+
+    def degree(self, node):
+        low, high = self._base(node)
+        return (high - low + len(self.added.get(node, ()))
+                - len(self.removed.get(node, ())))
+
+    def neighbours(self, node, start=0, stop=None):
+        """`node`'s neighbours (ascending) from index `start` to `stop`."""
+
+        low, high = self._base(node)
+
+        if node not in self.added and node not in self.removed:
+            stop = high if stop is None else min(high, low + stop)
+            return self.targets[low + start:stop].tolist()
+
+        removed = self.removed.get(node, ())
+        merged = sorted(
+            [n for n in self.targets[low:high] if n not in removed]
+            + list(self.added.get(node, ())))
+        return merged[start:stop]
+
+    def add(self, node, neighbour):
+        if neighbour in self.removed.get(node, ()):
+            self.removed[node].discard(neighbour)
+            if not self.removed[node]:
+                del self.removed[node]
+        elif not self._base_contains(node, neighbour):
+            self.added.setdefault(node, set()).add(neighbour)
+
+    def remove(self, node, neighbour):
+        if neighbour in self.added.get(node, ()):
+            self.added[node].discard(neighbour)
+            if not self.added[node]:
+                del self.added[node]
+        elif self._base_contains(node, neighbour):
+            self.removed.setdefault(node, set()).add(neighbour)
+
+    @property
+    def nbytes(self):
+        return (self.offsets.itemsize * len(self.offsets)
+                + self.targets.itemsize * len(self.targets))
+
+
+class FollowGraph:
+    """Who follows whom, both ways round."""
+
+    def __init__(self, following):
+        self.following = following
+        self.followers = following.transpose()
+        self.loaded_at = time.monotonic()
+        self._lock = threading.Lock()
+        # (follow?, follower, followed) since a reload began, if one is on
+        self._journal = None
+        self._successor = None
+
+    @classmethod
+    def load(cls, conn):
+        """Read the whole follows table over `conn`."""
+
+        size = conn.execute(db.select([db.func.max(Follows.user_following_id)])
+                            ).scalar()
+
+        rows = conn.execution_options(stream_results=True).execute(
+            db.select([Follows.user_following_id,
+                       Follows.user_being_followed_id])
+            .order_by(Follows.user_following_id,
+                      Follows.user_being_followed_id))
+
+        return cls(Adjacency.from_sorted(rows, (size or 0) + 1))
+
+    def is_following(self, follower_id, followed_id):
+        return self.following.contains(follower_id, followed_id)
+
+    def following_ids(self, user_id, start=0, stop=None):
+        with self._lock:
+            return self.following.neighbours(user_id, start, stop)
+
+    def follower_ids(self, user_id, start=0, stop=None):
+        with self._lock:
+            return self.followers.neighbours(user_id, start, stop)
+
+    def following_count(self, user_id):
+        return self.following.degree(user_id)
+
+    def follower_count(self, user_id):
+        return self.followers.degree(user_id)
+
+    def _apply(self, follow, follower_id, followed_id):
+        if follow:
+            self.following.add(follower_id, followed_id)
+            self.followers.add(followed_id, follower_id)
+        else:
+            self.following.remove(follower_id, followed_id)
+            self.followers.remove(followed_id, follower_id)
+
+    def update(self, follow, follower_id, followed_id):
+        """Record a committed follow (or, `follow` false, unfollow)."""
+
+        with self._lock:
+            self._apply(follow, follower_id, followed_id)
+
+            if self._journal is not None:
+                self._journal.append((follow, follower_id, followed_id))
+
+            successor = self._successor
+
+        if successor is not None:
+            # A request that fetched this graph just before it was replaced
+            successor.update(follow, follower_id, followed_id)
+
+    def start_journal(self):
+        """Start recording updates, for a graph being loaded to replace this."""
+
+        with self._lock:
+            self._journal = []
+
+    def end_journal(self):
+        with self._lock:
+            self._journal = None
+
+    def retire(self, successor):
+        """Hand over to `successor`, loaded since `start_journal()`.
+
+        The journal is replayed onto it, and later updates forwarded. An
+        edge both loaded and journaled is fine: replaying is idempotent.
+        """
+
+        with self._lock:
+            for change in self._journal:
+                successor._apply(*change)
+
+            self._journal = None
+            self._successor = successor
+
+    @property
+    def edges(self):
+        return (len(self.following.targets)
+                + sum(map(len, self.following.added.values()))
+                - sum(map(len, self.following.removed.values())))
+
+    @property
+    def nbytes(self):
+        return self.following.nbytes + self.followers.nbytes
+
+
+def reload_graph(app, state):
+    """Replace the graph in `state` with a fresh load from the database."""
+
+    old = state['graph']
+    old.start_journal()
+
+    try:
+        with app.app_context(), db.engine.connect() as conn:
+            new = FollowGraph.load(conn)
+    except Exception:
+        app.logger.exception("Reloading the follow graph failed")
+        old.end_journal()
+        old.loaded_at = time.monotonic()
+    else:
+        old.retire(new)
+        state['graph'] = new
+    finally:
+        state['reloading'] = False
+
+
+def get_graph():
+    """This process's follow graph, loaded on first use and kept fresh."""
+
+    app = current_app._get_current_object()
+    state = app.extensions['follow_graph']
+
+    if state['pid'] != os.getpid():
+        # First use in this process; gunicorn forks after the app is built
+        with _lock:
+            if state['pid'] != os.getpid():
+                with db.engine.connect() as conn:
+                    state['graph'] = FollowGraph.load(conn)
+                state['reloading'] = False
+                state['pid'] = os.getpid()
+
+    graph = state['graph']
+
+    if (time.monotonic() - graph.loaded_at
+            > app.config['GRAPH_RELOAD_INTERVAL']):
+        with _lock:
+            start, state['reloading'] = not state['reloading'], True
+
+        if start:
+            threading.Thread(target=reload_graph, args=(app, state),
+                             name='follow-graph-reload', daemon=True).start()
+
+    return graph
+
+
+def graph_enabled():
+    return current_app.config['GRAPH_INDEX_ENABLED']
+
+
+def followed_ids(user_id):
+    """Ids of the users `user_id` follows, leaving out deleted accounts.
+
+    Read from the database, not the graph: this is the logged-in user's
+    own follows (see the module docstring).
+    """
+
+    return list(writebuffer.with_pending(
+        'follow', reads.followed_ids(user_id), user_id))
+
+
+def is_following(user):
+    """Does the logged-in user follow `user`?"""
+
+    if writebuffer.enabled():
+        pending = writebuffer.pending('follow').get(user.id)
+        if pending is not None:
+            return pending
+
+    # Loaded up front by the async read routes (asgi.py), or by the first
+    # follow button of the request. By id: `user` may be a cached record
+    # rather than a User.
+    if g.get('followed_ids') is None:
+        g.followed_ids = frozenset(reads.followed_ids(g.user.id))
+
+    return user.id in g.followed_ids
+
+
+def following_count(user):
+    if graph_enabled():
+        return get_graph().following_count(user.id)
+    return Follows.query.filter_by(user_following_id=user.id).count()
+
+
+def follower_count(user):
+    if graph_enabled():
+        return get_graph().follower_count(user.id)
+    return Follows.query.filter_by(user_being_followed_id=user.id).count()
+
+
+def following_page(user_id, page):
+    """Page `page` (from 1) of the users `user_id` follows, and whether
+    there's a page after it."""
+
+    start, stop = page_bounds(page)
+
+    if g.get('user') and g.user.id == user_id:
+        ids = sorted(writebuffer.with_pending(
+            'follow', neighbour_ids(user_id), user_id))[start:stop]
+    elif graph_enabled():
+        ids = get_graph().following_ids(user_id, start, stop)
+    else:
+        ids = neighbour_ids(user_id, bounds=(start, stop))
+
+    return users_page(ids)
+
+
+def followers_page(user_id, page):
+    """Page `page` (from 1) of the users following `user_id`, and whether
+    there's a page after it."""
+
+    start, stop = page_bounds(page)
+
+    if graph_enabled():
+        ids = get_graph().follower_ids(user_id, start, stop)
+    else:
+        ids = neighbour_ids(user_id, followers=True, bounds=(start, stop))
+
+    return users_page(ids)
+
+
+def page_bounds(page):
+    """Where page `page` starts and stops, one past its end: that one
+    tells whether there's another page."""
+
+    size = current_app.config['FOLLOW_PAGE_SIZE']
+    return (page - 1) * size, page * size + 1
+
+
+def neighbour_ids(user_id, followers=False, bounds=None):
+    """Ids `user_id` follows (or who follow them), ascending, from the
+    database; sliced by `bounds` (start, stop) if given."""
+
+    if followers:
+        node, neighbour = (Follows.user_being_followed_id,
+                           Follows.user_following_id)
+    else:
+        node, neighbour = (Follows.user_following_id,
+                           Follows.user_being_followed_id)
+
+    query = db.session.query(neighbour).filter(node == user_id).order_by(
+        neighbour)
+    if bounds is not None:
+        query = query.slice(*bounds)
+
+    return [neighbour_id for (neighbour_id,) in query]
+
+
+def users_page(ids):
+    """The users with `ids` (one past a page, from `page_bounds()`), in id
+    order, and whether there were more of them than fit."""
+
+    size = current_app.config['FOLLOW_PAGE_SIZE']
+    users = (User.query.filter(User.id.in_(ids[:size])).order_by(User.id)
+             .all() if ids else [])
+
+    return users, len(ids) > size
+
+
+def record_follow(follower_id, followed_id, follow=True):
+    """Tell this process's graph about a committed (un)follow."""
+
+    if graph_enabled():
+        get_graph().update(follow, follower_id, followed_id)
+
+
+def init_app(app):
+    """Serve follow-graph reads for `app` from memory, when enabled."""
+
+    app.config.setdefault('GRAPH_INDEX_ENABLED',
+                          os.environ.get('GRAPH_INDEX_ENABLED') == '1')
+    app.config.setdefault('GRAPH_RELOAD_INTERVAL', 300)
+    app.config.setdefault('FOLLOW_PAGE_SIZE', 48)
+
+    app.extensions['follow_graph'] = {'pid': None, 'graph': None,
+                                      'reloading': False}
+
+    app.add_template_global(is_following)
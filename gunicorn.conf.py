@@ -0,0 +1,41 @@
+"""Gunicorn settings for serving Warbler in production.
+
+Worker count, threads per worker and worker class come from the app
+config, which reads WEB_CONCURRENCY, WEB_THREADS, WEB_WORKER_CLASS and
+WEB_BIND from the environment. For example:
+
+    WEB_CONCURRENCY=4 WEB_THREADS=8 WEB_WORKER_CLASS=gthread gunicorn wsgi:app
+
+Live timelines (/stream) hold a connection open per browser tab, so
+they're only on with WEB_WORKER_CLASS=gevent (or LIVE_ENABLED=1).
+
+The ASGI entry point (asgi.py) runs under the same settings with an
+ASGI worker class:
+
+    WEB_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn asgi:app
+
+See benchmarks/serving.py for how the worker classes compare.
+"""
+
+from wsgi import app, dispose_engine
+
+preload_app = True
+
+bind = app.config['WEB_BIND']
+workers = app.config['WEB_CONCURRENCY']
+threads = app.config['WEB_THREADS']
+worker_class = app.config['WEB_WORKER_CLASS']
+
+# Simultaneous clients per gevent worker, mostly idle /stream connections
+worker_connections = app.config['WEB_WORKER_CONNECTIONS']
+
+
+def post_fork(server, worker):
+    """Give each worker its own DB connection pool."""
+
+    if worker_class == 'gevent':
+        # psycopg2 would otherwise block the whole worker on every query
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    dispose_engine()
@@ -0,0 +1,420 @@
+"""Resized, locally cached copies of users' profile and header images.
+
+`User.image_url` and `User.header_image_url` point at arbitrary (often
+remote, often large) images. Templates ask for them through
+`thumbnail_url(user, kind, slot)`, which points at our own
+/images/<kind>/<slot>/<user_id> route instead. That route fetches the
+original once, crops and scales it to the slot's fixed size, and keeps
+the result in a content-addressed, size-bounded cache on disk.
+
+The URL carries a hash of the original image URL, so a profile edit
+yields a new URL and the thumbnails can be cached by browsers forever.
+
+The URLs are user-supplied, so the proxy only fetches from public
+addresses: each host is resolved first, the connection goes to the
+address that was checked (so a second DNS answer can't swap it), and
+redirects are followed by hand, checking every hop. Loopback, private,
+link-local and reserved addresses are refused unless they're in
+IMAGE_PROXY_ALLOWED_NETWORKS.
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+from io import BytesIO
+
+from flask import Blueprint, abort, current_app, send_file
+
+from models import User
+
+# (kind, slot) -> (width, height), at twice the CSS size for hi-dpi screens
+SIZES = {
+    ('avatar', 'timeline'): (96, 96),
+    ('avatar', 'card'): (140, 140),
+    ('avatar', 'hero'): (400, 400),
+    ('header', 'card'): (600, 200),
+    ('header', 'hero'): (1600, 360),
+}
+
+DEFAULTS = {
+    'avatar': '/static/images/default-pic.png',
+    'header': '/static/images/warbler-hero.jpg',
+}
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+images = Blueprint('images', __name__)
+
+
+def source_url(user, kind):
+    """The original image URL of `kind` ('avatar' or 'header') for `user`."""
+
+    url = user.image_url if kind == 'avatar' else user.header_image_url
+    return url or DEFAULTS[kind]
+
+
+def version(url):
+    """Short fingerprint of an image URL, used to bust caches on change."""
+
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+
+
+def thumbnail_url(user, kind, slot):
+    """URL of the thumbnail of `user`'s `kind` image for `slot`."""
+
+    return (f"/images/{kind}/{slot}/{user.id}"
+            f"?v={version(source_url(user, kind))}")
+
+
+class ImageCache:
+    """Content-addressed files on disk, evicting least recently used.
+
+    Files live at <directory>/<key[:2]>/<key>. Reading a file bumps its
+    mtime; once the total size passes `max_bytes`, the oldest files are
+    removed until the cache is back under 90% of the limit.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Path of the cached file for `key`, or None."""
+
+        path = self.path(key)
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def is_fresh(self, key, max_age):
+        """Was `key` stored less than `max_age` seconds ago?"""
+
+        try:
+            stored = os.stat(self.path(key)).st_mtime
+        except FileNotFoundError:
+            return False
+
+        return time.time() - stored < max_age
+
+    def put(self, key, data):
+        """Store `data` under `key`; return its path."""
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write aside and rename, so readers never see a partial file
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(partial, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+        return path
+
+    def _entries(self):
+        """(path, size, mtime) of every cached file."""
+
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        """Remove least recently used files down to 90% of the limit."""
+
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self._size -= size
+
+
+def get_image_cache():
+    """The current app's ImageCache, created from its config on first use."""
+
+    cache = current_app.extensions.get('image_cache')
+
+    if cache is None:
+        cache = current_app.extensions['image_cache'] = ImageCache(
+            current_app.config['IMAGE_CACHE_DIR'],
+            current_app.config['IMAGE_CACHE_MAX_BYTES'])
+
+    return cache
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection to `host` that connects to `address` instead."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection to `host` (SNI and certificate checked against
+    it) that connects to `address` instead."""
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port),
+                                        self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def public_address(host, port):
+    """An address `host` resolves to, if every one of them may be
+    fetched from; raises ValueError otherwise."""
+
+    allowed = [ipaddress.ip_network(network) for network
+               in current_app.config['IMAGE_PROXY_ALLOWED_NETWORKS']]
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as exc:
+        raise ValueError(f"Can't resolve {host}: {exc}")
+
+    addresses = []
+    for *_, sockaddr in infos:
+        ip = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        if (not any(ip in network for network in allowed)
+                and (not ip.is_global or ip.is_multicast)):
+            raise ValueError(f"Not a public address: {host} ({ip})")
+        addresses.append(str(ip))
+
+    if not addresses:
+        raise ValueError(f"Can't resolve {host}")
+
+    return addresses[0]
+
+
+def fetch_remote(url, max_bytes):
+    """Bytes at a http(s) `url`, from public addresses only."""
+
+    config = current_app.config
+
+    for _ in range(config['IMAGE_PROXY_MAX_REDIRECTS'] + 1):
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme not in config['IMAGE_PROXY_SCHEMES']:
+            raise ValueError(
+                f"Can't fetch images over {parts.scheme or 'no scheme'}")
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Can't fetch {url}")
+
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+        except ValueError:
+            raise ValueError(f"Bad port in {url}")
+
+        connection = (_PinnedHTTPSConnection if parts.scheme == 'https'
+                      else _PinnedHTTPConnection)(
+            parts.hostname, public_address(parts.hostname, port),
+            port=port, timeout=config['IMAGE_PROXY_TIMEOUT'])
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        try:
+            connection.request('GET', path,
+                               headers={'User-Agent': 'Warbler images'})
+            resp = connection.getresponse()
+
+            if resp.status in (301, 302, 303, 307, 308):
+                location = resp.getheader('Location')
+                if not location:
+                    raise ValueError(f"Redirect without a location: {url}")
+                url = urllib.parse.urljoin(url, location)
+                continue
+
+            if resp.status != 200:
+                raise ValueError(f"Can't fetch {url}: {resp.status}")
+
+            return resp.read(max_bytes + 1)
+        except (OSError, http.client.HTTPException) as exc:
+            raise ValueError(f"Can't fetch {url}: {exc}")
+        finally:
+            connection.close()
+
+    raise ValueError(f"Too many redirects: {url}")
+
+
+def fetch(url):
+    """Bytes of the original image at `url`.
+
+    /static/ paths are read from the app's static folder; other URLs must
+    use one of IMAGE_PROXY_SCHEMES, and http(s) ones a public address.
+    Raises ValueError for anything that can't (or may not) be fetched.
+    """
+
+    max_bytes = current_app.config['IMAGE_PROXY_MAX_BYTES']
+
+    if url.startswith('/static/'):
+        folder = current_app.static_folder
+        path = os.path.normpath(os.path.join(folder, url[len('/static/'):]))
+
+        if not path.startswith(folder + os.sep):
+            raise ValueError(f"Not a static file: {url}")
+
+        try:
+            with open(path, 'rb') as source:
+                return source.read(max_bytes + 1)
+        except OSError as exc:
+            raise ValueError(f"Can't read {url}: {exc}")
+
+    scheme = urllib.parse.urlsplit(url).scheme
+
+    if scheme not in current_app.config['IMAGE_PROXY_SCHEMES']:
+        raise ValueError(f"Can't fetch images over {scheme or 'no scheme'}")
+
+    if scheme == 'file':
+        # Only ever enabled for tests and local development
+        try:
+            with open(urllib.parse.urlsplit(url).path, 'rb') as source:
+                data = source.read(max_bytes + 1)
+        except OSError as exc:
+            raise ValueError(f"Can't read {url}: {exc}")
+    else:
+        data = fetch_remote(url, max_bytes)
+
+    if len(data) > max_bytes:
+        raise ValueError(f"Image too large: {url}")
+
+    return data
+
+
+def resize(data, size):
+    """Crop and scale image bytes to fill `size`; return JPEG bytes."""
+
+    from PIL import Image, ImageOps
+
+    # DecompressionBombError: headers claiming more than twice
+    # Image.MAX_IMAGE_PIXELS, which would take gigabytes to decode
+    try:
+        image = Image.open(BytesIO(data))
+        image = ImageOps.fit(image.convert('RGB'), size, Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ValueError(f"Not an image: {exc}")
+
+    out = BytesIO()
+    image.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def cached_thumbnail(url, size):
+    """Path of the thumbnail of `url` at `size`, making it if needed.
+
+    Raises ValueError if the original can't be fetched or decoded, or
+    couldn't be in the last IMAGE_PROXY_FAILURE_TTL seconds: failures are
+    remembered (as empty marker files in the cache, so by every worker),
+    rather than tying up a worker on every request for a dead image.
+    """
+
+    cache = get_image_cache()
+    key = hashlib.sha256(f"{url}|{size[0]}x{size[1]}".encode('utf-8'))
+    key = key.hexdigest()
+    path = cache.get(key)
+
+    if path:
+        return path
+
+    failed = hashlib.sha256(url.encode('utf-8')).hexdigest() + '.failed'
+
+    if cache.is_fresh(failed, current_app.config['IMAGE_PROXY_FAILURE_TTL']):
+        raise ValueError(f"Failed recently: {url}")
+
+    try:
+        data = resize(fetch(url), size)
+    except ValueError:
+        cache.put(failed, b'')
+        raise
+
+    return cache.put(key, data)
+
+
+@images.route('/images/<kind>/<slot>/<int:user_id>')
+def thumbnail(kind, slot, user_id):
+    """Serve a user's resized profile or header image."""
+
+    size = SIZES.get((kind, slot))
+
+    if not size:
+        abort(404)
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    url = source_url(user, kind)
+
+    try:
+        path = cached_thumbnail(url, size)
+    except ValueError:
+        current_app.logger.warning("Image proxy can't use %s", url)
+
+        # Show the default for now, without letting browsers keep it:
+        # the original may well be reachable later
+        return send_file(cached_thumbnail(DEFAULTS[kind], size),
+                         mimetype='image/jpeg')
+
+    resp = send_file(path, mimetype='image/jpeg', conditional=True)
+    resp.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+    return resp
+
+
+def init_app(app):
+    """Set up the image proxy on `app`."""
+
+    app.config.setdefault('IMAGE_CACHE_DIR',
+                          os.path.join(app.instance_path, 'image-cache'))
+    app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+    app.config.setdefault('IMAGE_PROXY_MAX_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('IMAGE_PROXY_SCHEMES', ('http', 'https'))
+    app.config.setdefault('IMAGE_PROXY_ALLOWED_NETWORKS', ())
+    app.config.setdefault('IMAGE_PROXY_MAX_REDIRECTS', 3)
+    app.config.setdefault('IMAGE_PROXY_TIMEOUT', 10)
+    app.config.setdefault('IMAGE_PROXY_FAILURE_TTL', 60)
+
+    app.register_blueprint(images)
+    app.add_template_global(thumbnail_url)
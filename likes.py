@@ -0,0 +1,93 @@
+"""Repair `Message.like_count` from the likes table.
+
+like_count is maintained in the same transaction as every like and
+unlike, so it only drifts if rows change behind the app's back (manual
+SQL, a restore of one table but not the other). This recounts messages
+in id order, one batch per transaction, and fixes the ones that differ:
+
+    FLASK_APP=app.py flask likes reconcile
+
+With sharding on (shards.py), use `flask shards reconcile-likes`.
+"""
+
+import time
+
+import click
+from flask import g
+from flask.cli import AppGroup
+
+import shards
+import writebuffer
+from models import db, Likes, Message
+
+likes_cli = AppGroup('likes', help='Maintain message like counts.')
+
+
+def liked_message_ids():
+    """Ids of the messages the logged-in user likes, read once a request."""
+
+    if 'liked_message_ids' not in g:
+        if not g.get('user'):
+            g.liked_message_ids = frozenset()
+        elif shards.enabled():
+            g.liked_message_ids = shards.liked_message_ids(g.user.id)
+        else:
+            g.liked_message_ids = frozenset(writebuffer.with_pending(
+                'like', [message_id for (message_id,) in
+                         db.session.query(Likes.message_id).filter(
+                             Likes.user_id == g.user.id)],
+                g.user.id))
+
+    return g.liked_message_ids
+
+
+def reconcile_batch(first_id, last_id):
+    """Fix like counts of messages with ids in [first_id, last_id].
+
+    Doesn't commit. Returns the number of messages corrected.
+    """
+
+    actual = (db.session.query(db.func.count(Likes.id))
+              .filter(Likes.message_id == Message.id)
+              .correlate(Message)
+              .as_scalar())
+
+    return (Message.query
+            .filter(Message.id.between(first_id, last_id),
+                    Message.like_count != actual)
+            .update({Message.like_count: actual}, synchronize_session=False))
+
+
+def reconcile(batch_size=10000, pause=0):
+    """Fix every message's like count; return how many were wrong."""
+
+    low, high = db.session.query(db.func.min(Message.id),
+                                 db.func.max(Message.id)).one()
+    fixed = 0
+
+    for first in range(low or 0, (high or -1) + 1, batch_size):
+        fixed += reconcile_batch(first, first + batch_size - 1)
+        db.session.commit()
+
+        if pause:
+            time.sleep(pause)
+
+    return fixed
+
+
+@likes_cli.command('reconcile')
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Messages (by id range) recounted per transaction.')
+@click.option('--pause', default=0.0, show_default=True,
+              help='Seconds to sleep between batches.')
+def reconcile_command(batch_size, pause):
+    """Recount likes and fix messages whose like_count is off."""
+
+    click.echo(f"Fixed {reconcile(batch_size, pause)} like counts")
+
+
+def init_app(app):
+    """Add like counting commands and helpers to `app`."""
+
+    app.cli.add_command(likes_cli)
+    app.add_template_global(liked_message_ids)
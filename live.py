@@ -0,0 +1,309 @@
+"""Live timeline updates over Server-Sent Events.
+
+The logged-in homepage opens an EventSource on /stream. The stream is
+subscribed to the authors the user follows (and the user), and
+`messages_add()` publishes each new message once it's committed, so the
+message shows up on open timelines without anyone refreshing.
+
+Every process has a `Broker` that fans events out to its own
+subscribers. LIVE_BACKEND decides how events reach the brokers:
+
+    memory     publish straight to this process's broker; only for a
+               single worker (the app won't start on it with more)
+    postgres   NOTIFY on the app's database; every process LISTENs and
+               feeds its broker, so events reach all workers and nodes
+
+Each open stream is an idle connection, so serve the app with the gevent
+worker class (WEB_WORKER_CLASS=gevent), where one costs a greenlet and a
+small queue; WEB_WORKER_CONNECTIONS caps them per worker. A stream holds
+no database connection while it waits. Under sync or gthread workers a
+stream would hold a whole worker (or thread) for as long as the tab is
+open, so live updates are off unless the worker class is one of
+ASYNC_WORKER_CLASSES or LIVE_ENABLED=1 says otherwise: the homepage then
+leaves out live.js, and /stream answers 204, which stops an EventSource.
+
+Streams don't notice follows made after they open; the browser picks
+them up on its next reconnect, when Last-Event-ID also backfills any
+messages it missed. A stream that falls too far behind is ended, so the
+browser reconnects and catches up the same way.
+"""
+
+import json
+import os
+import queue
+import select
+import threading
+
+from flask import Blueprint, Response, current_app, g, request
+
+import graph
+from images import thumbnail_url
+from models import db, Message
+import shards
+
+CHANNEL = 'warbler_messages'
+
+# Worker classes that hold an idle stream without tying up a worker
+ASYNC_WORKER_CLASSES = ('gevent', 'eventlet')
+
+live = Blueprint('live', __name__)
+
+
+class Subscription:
+    """One stream's queue of events from a set of authors."""
+
+    def __init__(self, broker, author_ids, maxsize=100):
+        self.broker = broker
+        self.author_ids = frozenset(author_ids)
+        self.events = queue.Queue(maxsize)
+        self.closed = False
+
+    def get(self, timeout):
+        """The next event, or None after `timeout` seconds without one
+        (at once, once closed and drained)."""
+
+        try:
+            return self.events.get(timeout=0 if self.closed else timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Fan events out to this process's subscriptions by author."""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, author_ids):
+        subscription = Subscription(self, author_ids)
+
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._subscriptions.setdefault(author_id, set()).add(
+                    subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscribers = self._subscriptions.get(author_id, set())
+                subscribers.discard(subscription)
+
+                if not subscribers:
+                    self._subscriptions.pop(author_id, None)
+
+    def publish(self, event):
+        """Queue `event` for everyone subscribed to its author."""
+
+        with self._lock:
+            subscribers = list(self._subscriptions.get(event['user_id'], ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.events.put_nowait(event)
+            except queue.Full:
+                # A client this far behind will catch up on reconnect
+                subscription.close()
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._subscriptions.values()))
+
+
+class MemoryBackend:
+    """Deliver events within this process only."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def start(self, app):
+        pass
+
+    def publish(self, event):
+        self.broker.publish(event)
+
+
+class PostgresBackend:
+    """Deliver events to every process through LISTEN/NOTIFY."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._pid = None
+
+    def start(self, app):
+        """Listen in a background thread, once per (forked) process."""
+
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+
+        with app.app_context():
+            conn = db.engine.raw_connection()
+
+        # Keep the connection out of the pool; it's ours for good
+        conn.detach()
+        conn.connection.set_session(autocommit=True)
+
+        cursor = conn.cursor()
+        cursor.execute(f"LISTEN {CHANNEL}")
+        cursor.close()
+
+        threading.Thread(target=self._listen, args=(app, conn.connection),
+                         name='live-listener', daemon=True).start()
+
+    def _listen(self, app, conn):
+        while True:
+            try:
+                select.select([conn], [], [], 60)
+                conn.poll()
+            except Exception:
+                app.logger.exception("Live listener lost its connection")
+                self._pid = None
+                return
+
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.broker.publish(json.loads(notify.payload))
+
+    def publish(self, event):
+        db.session.execute("SELECT pg_notify(:channel, :payload)",
+                           {'channel': CHANNEL,
+                            'payload': json.dumps(event)})
+        db.session.commit()
+
+
+BACKENDS = {'memory': MemoryBackend, 'postgres': PostgresBackend}
+
+
+def get_backend():
+    """The current app's live backend, created from its config on first use."""
+
+    backend = current_app.extensions.get('live_backend')
+
+    if backend is None:
+        backend = current_app.extensions['live_backend'] = BACKENDS[
+            current_app.config['LIVE_BACKEND']](Broker())
+
+    return backend
+
+
+def message_event(message):
+    """What a stream sends about a new `message`."""
+
+    return {
+        'id': message.id,
+        'user_id': message.user_id,
+        'username': message.user.username,
+        'image_url': thumbnail_url(message.user, 'avatar', 'timeline'),
+        'text': message.text,
+        'timestamp': message.timestamp.strftime('%d %B %Y'),
+    }
+
+
+def enabled():
+    return current_app.config['LIVE_ENABLED']
+
+
+def publish(message):
+    """Push a committed `message` to the streams following its author."""
+
+    if not enabled():
+        return
+
+    try:
+        get_backend().publish(message_event(message))
+    except Exception:
+        # Live updates are a nicety; the post itself has succeeded
+        current_app.logger.exception("Couldn't publish message %s",
+                                     message.id)
+
+
+def format_event(event):
+    return f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+
+
+def events(subscription, backlog, keepalive):
+    """The SSE stream: missed messages, then live ones as they arrive."""
+
+    try:
+        yield "retry: 5000\n\n"
+
+        for event in backlog:
+            yield format_event(event)
+
+        while True:
+            event = subscription.get(timeout=keepalive)
+
+            # Dropped for falling behind: end the stream, so the browser
+            # reconnects and backfills from its Last-Event-ID
+            if event is None and subscription.closed:
+                return
+
+            # Comments keep proxies from timing out idle streams
+            yield ": keepalive\n\n" if event is None else format_event(event)
+    finally:
+        subscription.close()
+
+
+@live.route('/stream')
+def stream():
+    """Stream new messages from the people the user follows."""
+
+    if not g.user or not enabled():
+        return Response(status=204)
+
+    author_ids = graph.followed_ids(g.user.id)
+    author_ids.append(g.user.id)
+
+    backend = get_backend()
+    backend.start(current_app._get_current_object())
+    subscription = backend.broker.subscribe(author_ids)
+
+    # A reconnecting browser sends the last id it saw; catch it up
+    backlog = []
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    # Shard ids aren't in posting order (shards.py): no catching up there
+    if last_id and not shards.enabled():
+        missed = (Message.query
+                  .filter(Message.user_id.in_(author_ids),
+                          Message.id > last_id)
+                  .order_by(Message.id)
+                  .limit(100))
+        backlog = [message_event(message) for message in missed]
+
+    resp = Response(events(subscription, backlog,
+                           current_app.config['LIVE_KEEPALIVE']),
+                    mimetype='text/event-stream')
+
+    # Tell nginx to pass events through as they're written
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+def init_app(app):
+    """Serve live timeline updates from `app`."""
+
+    app.config.setdefault('LIVE_BACKEND',
+                          os.environ.get('LIVE_BACKEND', 'memory'))
+    app.config.setdefault('LIVE_KEEPALIVE', 20)
+    app.config.setdefault('LIVE_ENABLED', os.environ.get(
+        'LIVE_ENABLED',
+        '1' if app.config['WEB_WORKER_CLASS'] in ASYNC_WORKER_CLASSES
+        else '0') == '1')
+
+    if (app.config['LIVE_ENABLED'] and app.config['LIVE_BACKEND'] == 'memory'
+            and app.config['WEB_CONCURRENCY'] > 1):
+        raise ValueError("Live updates need LIVE_BACKEND=postgres with more "
+                         "than one worker: the memory backend only reaches "
+                         "streams on the worker that posted")
+
+    app.register_blueprint(live)
+    app.add_template_global(enabled, 'live_enabled')
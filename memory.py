@@ -0,0 +1,208 @@
+"""Per-request memory accounting, for pages that load too much.
+
+With MEMORY_PROFILE_ENABLED, a fraction (MEMORY_SAMPLE_RATE) of requests
+is measured:
+
+    peak        the most memory Python had allocated at any point in the
+                request (per tracemalloc), over what it had at the start
+    objects     ORM instances loaded from the database, by model
+    identity    instances in the session's identity map at the end
+
+The figures are kept per endpoint and served to admins (see admin.py):
+
+    GET    /admin/memory    per endpoint: requests, peak max and mean,
+                            most objects loaded and identity map size
+    DELETE /admin/memory    start over
+
+A request peaking over MEMORY_SNAPSHOT_BYTES also gets a tracemalloc
+snapshot at its end; the biggest allocation sites still alive then
+(mostly what it loaded and rendered) are kept for its endpoint, from its
+worst request.
+
+tracemalloc only traces while a measured request runs, but it slows
+Python down severalfold while it does, and its peak is per process: use
+sync workers (one request at a time each), or read the figures of
+overlapping requests as shared.
+
+`measure()` does the same for any block of code; the memory budget tests
+use it (see testing.py).
+"""
+
+import os
+import random
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import Blueprint, current_app, g, jsonify, request
+from sqlalchemy import event
+
+from admin import admin_required
+from models import db
+
+memory = Blueprint('memory', __name__, url_prefix='/admin/memory')
+
+# Guards starting and stopping tracemalloc, and the report
+_lock = threading.Lock()
+_tracers = 0
+_local = threading.local()
+
+
+class Usage:
+    """What one measured block of code allocated and loaded."""
+
+    def __init__(self):
+        self.peak = 0
+        self.objects = Counter()
+        self.identity = 0
+        self.sites = []
+        self._base = 0
+
+    def __repr__(self):
+        return (f"<Usage peak={self.peak} objects={dict(self.objects)} "
+                f"identity={self.identity}>")
+
+
+def count_load(target, context):
+    objects = getattr(_local, 'objects', None)
+    if objects is not None:
+        objects[type(target).__name__] += 1
+
+
+def begin():
+    """Start measuring; returns the Usage to pass to `end()`."""
+
+    global _tracers
+
+    with _lock:
+        if not event.contains(db.Model, 'load', count_load):
+            event.listen(db.Model, 'load', count_load, propagate=True)
+
+        if _tracers == 0:
+            tracemalloc.start()
+        _tracers += 1
+
+    usage = Usage()
+    tracemalloc.reset_peak()
+    usage._base = tracemalloc.get_traced_memory()[0]
+    _local.objects = usage.objects
+
+    return usage
+
+
+def end(usage, snapshot_bytes=None, sites=10):
+    """Fill in `usage`, with allocation sites if it peaked over
+    `snapshot_bytes`."""
+
+    global _tracers
+
+    usage.peak = max(tracemalloc.get_traced_memory()[1] - usage._base, 0)
+    usage.identity = (len(db.session.identity_map)
+                      if db.session.registry.has() else 0)
+    _local.objects = None
+
+    if snapshot_bytes is not None and usage.peak > snapshot_bytes:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        usage.sites = [(str(stat.traceback[0]), stat.size)
+                       for stat in snapshot.statistics('lineno')[:sites]]
+
+    with _lock:
+        _tracers -= 1
+        if _tracers == 0:
+            tracemalloc.stop()
+
+    return usage
+
+
+@contextmanager
+def measure(snapshot_bytes=None):
+    """Measure the block's memory use into the Usage it's given."""
+
+    usage = begin()
+    try:
+        yield usage
+    finally:
+        end(usage, snapshot_bytes)
+
+
+def record(report, endpoint, usage):
+    """Add a measured request of `endpoint` to `report`."""
+
+    objects = sum(usage.objects.values())
+
+    with _lock:
+        stats = report.setdefault(endpoint, {
+            'requests': 0, 'peak_max': 0, 'peak_total': 0,
+            'objects_max': 0, 'identity_max': 0, 'worst': None})
+
+        stats['requests'] += 1
+        stats['peak_total'] += usage.peak
+        stats['objects_max'] = max(stats['objects_max'], objects)
+        stats['identity_max'] = max(stats['identity_max'], usage.identity)
+
+        if usage.peak >= stats['peak_max']:
+            stats['peak_max'] = usage.peak
+            stats['worst'] = {'path': request.path,
+                              'objects': dict(usage.objects),
+                              'sites': usage.sites}
+
+
+def start_measuring():
+    config = current_app.config
+
+    if (config['MEMORY_PROFILE_ENABLED']
+            and random.random() < config['MEMORY_SAMPLE_RATE']):
+        g.memory_usage = begin()
+
+
+def stop_measuring(exc):
+    usage = g.pop('memory_usage', None)
+
+    if usage is not None:
+        end(usage, current_app.config['MEMORY_SNAPSHOT_BYTES'])
+        record(current_app.extensions['memory_report'],
+               request.endpoint or '(unrouted)', usage)
+
+
+@memory.route('', methods=['GET'])
+@admin_required
+def show_memory():
+    """This worker's memory figures, by endpoint, hungriest first."""
+
+    with _lock:
+        report = {endpoint: dict(stats, peak_mean=(stats['peak_total']
+                                                   // stats['requests']))
+                  for endpoint, stats
+                  in current_app.extensions['memory_report'].items()}
+
+    return jsonify(pid=os.getpid(),
+                   enabled=current_app.config['MEMORY_PROFILE_ENABLED'],
+                   endpoints=dict(sorted(report.items(),
+                                         key=lambda item:
+                                         -item[1]['peak_max'])))
+
+
+@memory.route('', methods=['DELETE'])
+@admin_required
+def reset_memory():
+    with _lock:
+        current_app.extensions['memory_report'].clear()
+    return ('', 204)
+
+
+def init_app(app):
+    """Measure `app`'s requests, when enabled."""
+
+    app.config.setdefault('MEMORY_PROFILE_ENABLED',
+                          os.environ.get('MEMORY_PROFILE_ENABLED') == '1')
+    app.config.setdefault('MEMORY_SAMPLE_RATE', float(
+        os.environ.get('MEMORY_SAMPLE_RATE', 1.0)))
+    app.config.setdefault('MEMORY_SNAPSHOT_BYTES', 10 * 1024 * 1024)
+
+    app.extensions['memory_report'] = {}
+
+    app.register_blueprint(memory)
+    app.before_request(start_measuring)
+    app.teardown_request(stop_measuring)
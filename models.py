@@ -2,13 +2,55 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+def get_bcrypt():
+    """Return the password hasher for the current app.
+
+    flask_bcrypt is imported, and set up from the app's BCRYPT_LOG_ROUNDS,
+    the first time a password is hashed or checked rather than at import.
+    """
+
+    app = db.get_app()
+    bcrypt = app.extensions.get('bcrypt')
+
+    if bcrypt is None:
+        from flask_bcrypt import Bcrypt
+        bcrypt = app.extensions['bcrypt'] = Bcrypt(app)
+
+    return bcrypt
+
+
+class utcnow(FunctionElement):
+    """Current UTC time, as computed by the database server."""
+
+    type = db.DateTime()
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    # clock_timestamp() keeps advancing inside a transaction, unlike now(),
+    # so a batch of messages doesn't collapse onto a single instant.
+    return "TIMEZONE('utc', CLOCK_TIMESTAMP())"
+
+
+@compiles(utcnow, 'sqlite')
+def _utcnow_sqlite(element, compiler, **kw):
+    # %f is 'SS.SSS'; pad it to the microseconds SQLAlchemy expects
+    return "(STRFTIME('%Y-%m-%d %H:%M:%f000', 'now'))"
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -47,6 +89,10 @@ class Likes(db.Model):
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    # A user likes a message at most once, so like counts can't drift
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
 
 class User(db.Model):
@@ -94,6 +140,12 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; the rows themselves are removed
+    # later, in batches, by purge.py.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -118,6 +170,12 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def active(cls):
+        """Query for users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
@@ -137,6 +195,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
+        bcrypt = get_bcrypt()
         hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
@@ -160,10 +219,10 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = get_bcrypt().check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -188,7 +247,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -197,8 +256,232 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept in step with `likes` by like() and unlike(); repaired by
+    # `flask likes reconcile` if it ever isn't
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # Feeds read "newest first" per author; `id` breaks timestamp ties.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    @classmethod
+    def post(cls, user_id, text):
+        """Add a new message written by `user_id`.
+
+        The row is added directly rather than through `User.messages`, so
+        the author's (possibly huge) message collection is never loaded.
+        The timestamp is filled in by the database on insert.
+        """
+
+        msg = cls(user_id=user_id, text=text)
+        db.session.add(msg)
+        return msg
+
+    @classmethod
+    def like(cls, message_id, user_id):
+        """Record that `user_id` likes a message; bump its like count.
+
+        Returns False (changing nothing) if the user already liked it.
+        The count is incremented in the database, so concurrent likes
+        never overwrite each other.
+        """
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(Likes(user_id=user_id, message_id=message_id))
+        except IntegrityError:
+            return False
+
+        (cls.query
+         .filter_by(id=message_id)
+         .update({cls.like_count: cls.like_count + 1},
+                 synchronize_session=False))
+        return True
+
+    @classmethod
+    def unlike(cls, message_id, user_id):
+        """Remove `user_id`'s like of a message; drop its like count.
+
+        Returns False (changing nothing) if the user didn't like it.
+        """
+
+        deleted = (Likes.query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False))
+
+        if not deleted:
+            return False
+
+        (cls.query
+         .filter_by(id=message_id)
+         .update({cls.like_count: cls.like_count - 1},
+                 synchronize_session=False))
+        return True
+
+    @classmethod
+    def feed(cls, user_ids, limit=100, window=None):
+        """The newest `limit` messages by any of `user_ids`, newest first.
+
+        With a `window` (a timedelta), messages newer than that are read
+        first, which lets Postgres skip all but the latest monthly
+        partitions (see partitions.py); older ones are only read when the
+        window holds fewer than `limit`.
+        """
+
+        query = (cls.query
+                 .filter(cls.user_id.in_(user_ids))
+                 .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+        if not window:
+            return query.limit(limit).all()
+
+        cutoff = datetime.utcnow() - window
+        messages = query.filter(cls.timestamp >= cutoff).limit(limit).all()
+
+        if len(messages) < limit:
+            messages += (query
+                         .filter(cls.timestamp < cutoff)
+                         .limit(limit - len(messages))
+                         .all())
+
+        return messages
+
+    @classmethod
+    def post_many(cls, rows):
+        """Insert many messages in one batched INSERT.
+
+        `rows` is an iterable of dicts with `user_id` and `text` keys.
+        Returns the number of rows inserted.
+        """
+
+        rows = list(rows)
+
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+        return len(rows)
+
+
+class MessageTag(db.Model):
+    """A #tag used in a message."""
+
+    __tablename__ = 'message_tags'
+
+    # (tag, message_id) is also the index for paging through a tag
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message."""
+
+    __tablename__ = 'mentions'
+
+    # (user_id, message_id) is also the index for paging through mentions
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class UserPurge(db.Model):
+    """Progress of removing a deleted user's rows.
+
+    One row per deleted user. `stage` names the table currently being
+    emptied, so an interrupted purge picks up where it stopped.
+    """
+
+    __tablename__ = 'user_purges'
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+        default='likes',
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=utcnow(),
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return (f"<UserPurge user #{self.user_id}: {self.stage}, "
+                f"{self.rows_deleted} rows>")
+
+
+class BufferedWrite(db.Model):
+    """When the last written toggle of a like or follow was made.
+
+    writebuffer.py skips changes made before it, so a toggle reaching the
+    database late (from another worker, or a dead worker's journal)
+    doesn't undo a newer one.
+    """
+
+    __tablename__ = 'buffered_writes'
+
+    kind = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    target_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # Seconds since the epoch, as the toggling worker's clock had it
+    toggled_at = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
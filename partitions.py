@@ -0,0 +1,335 @@
+"""Monthly partitions of the messages table, and archiving old ones.
+
+Feeds only ever read the newest messages, but an unpartitioned messages
+table keeps growing: its indexes get deeper and every vacuum walks all of
+history. On Postgres (11+), `flask messages partition` turns it into a
+table range-partitioned by month of `timestamp`:
+
+    messages                 partitioned parent, PK (id, timestamp)
+      messages_y2024m01      one partition per month
+      ...
+      messages_default       catches rows no partition covers
+
+`flask messages maintain` (run it from cron, say daily) creates the
+partitions for the next few months and archives months older than
+--keep-months, either by moving the whole partition under the
+messages_archive table (no rows are copied) or by exporting it to
+gzipped CSV files and dropping it. Likes of archived messages go with
+them (to likes_archive, or a .likes.csv.gz file). Archived messages are
+no longer shown by the app.
+
+Partitioned tables can't be the target of a foreign key on `id` alone,
+so partitioning replaces the message_id foreign keys of likes,
+message_tags and mentions with triggers: deleting a message deletes
+their rows, and pointing one at a message that doesn't exist raises
+foreign_key_violation as before. Tags and mentions of archived messages
+are deleted; `flask tags backfill` can rebuild them.
+
+Feeds (`Message.feed`, `reads.feed`) read the last MESSAGES_FEED_WINDOW
+first, so Postgres only touches the newest one or two partitions.
+"""
+
+import gzip
+import os
+import re
+from datetime import date, datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db
+import shards
+
+PARTITION_NAME = re.compile(r'^messages_y(\d{4})m(\d{2})$')
+
+# Tables whose message_id referenced messages.id before partitioning
+MESSAGE_CHILDREN = ('likes', 'message_tags', 'mentions')
+
+FOREIGN_KEY_TRIGGERS = text("""
+CREATE OR REPLACE FUNCTION messages_delete_children() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM likes WHERE message_id = OLD.id;
+    DELETE FROM message_tags WHERE message_id = OLD.id;
+    DELETE FROM mentions WHERE message_id = OLD.id;
+    RETURN OLD;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER messages_delete_children AFTER DELETE ON messages
+    FOR EACH ROW EXECUTE PROCEDURE messages_delete_children();
+
+CREATE OR REPLACE FUNCTION check_message_exists() RETURNS trigger AS $$
+BEGIN
+    IF NEW.message_id IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM messages WHERE id = NEW.message_id) THEN
+        RAISE foreign_key_violation
+            USING MESSAGE = format('message %s does not exist',
+                                   NEW.message_id);
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+""" + "".join(f"""
+CREATE TRIGGER {table}_check_message BEFORE INSERT OR UPDATE OF message_id
+    ON {table} FOR EACH ROW EXECUTE PROCEDURE check_message_exists();
+""" for table in MESSAGE_CHILDREN))
+
+messages_cli = AppGroup('messages', help='Partition and archive messages.')
+
+
+def month_start(day):
+    """First day of `day`'s month."""
+
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, months):
+    """The first of the month `months` after `month` (a first of month)."""
+
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_y{month.year}m{month.month:02d}"
+
+
+def check_unsharded():
+    if shards.enabled():
+        raise click.ClickException(
+            "Messages are on the shards (SHARD_URLS), not in this "
+            "database's messages table.")
+
+
+def check_postgres(conn):
+    if conn.dialect.name != 'postgresql':
+        raise click.ClickException(
+            "Partitioning needs Postgres; this database is "
+            f"{conn.dialect.name}.")
+
+
+def is_partitioned(conn, table='messages'):
+    return bool(conn.execute(
+        "SELECT count(*) FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass(%s)", table).scalar())
+
+
+def partitions(conn, table='messages'):
+    """{month: partition name} of `table`'s monthly partitions."""
+
+    names = conn.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s)", table)
+
+    months = {}
+
+    for (name,) in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+
+    return months
+
+
+def create_partition(conn, month):
+    """Add the partition for `month`, taking its rows out of the default."""
+
+    name = partition_name(month)
+    bounds = (month, add_months(month, 1))
+
+    # Built aside and attached, so rows that landed in the default
+    # partition (maintenance ran late) can be moved in first
+    conn.execute(f"CREATE TABLE {name} "
+                 "(LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    conn.execute(
+        "WITH moved AS (DELETE FROM messages_default "
+        "WHERE timestamp >= %s AND timestamp < %s RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved", *bounds)
+    conn.execute(f"ALTER TABLE messages ATTACH PARTITION {name} "
+                 "FOR VALUES FROM (%s) TO (%s)", *bounds)
+
+    return name
+
+
+def ensure_partitions(conn, ahead, today=None):
+    """Create any missing partitions from this month to `ahead` months on.
+
+    Returns the names of the partitions created.
+    """
+
+    this_month = month_start(today or datetime.utcnow())
+    existing = partitions(conn)
+
+    return [create_partition(conn, month)
+            for month in (add_months(this_month, n) for n in range(ahead + 1))
+            if month not in existing]
+
+
+def partition(conn, ahead=3):
+    """Turn an unpartitioned messages table into a partitioned one.
+
+    Copies every row, so it takes a while on a big table; it holds an
+    exclusive lock on messages throughout.
+    """
+
+    conn.execute("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE")
+    conn.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    conn.execute("ALTER INDEX ix_messages_user_id_timestamp "
+                 "RENAME TO ix_messages_unpartitioned_user_id_timestamp")
+    conn.execute("ALTER TABLE messages_unpartitioned "
+                 "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+
+    for table in MESSAGE_CHILDREN:
+        conn.execute(f"ALTER TABLE {table} "
+                     f"DROP CONSTRAINT IF EXISTS {table}_message_id_fkey")
+
+    conn.execute("CREATE TABLE messages (LIKE messages_unpartitioned "
+                 "INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+                 "PARTITION BY RANGE (timestamp)")
+    conn.execute("ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)")
+    conn.execute("ALTER TABLE messages ADD FOREIGN KEY (user_id) "
+                 "REFERENCES users (id) ON DELETE CASCADE")
+    conn.execute("CREATE INDEX ix_messages_user_id_timestamp "
+                 "ON messages (user_id, timestamp, id)")
+    conn.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    conn.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+
+    oldest = conn.execute(
+        "SELECT min(timestamp) FROM messages_unpartitioned").scalar()
+    this_month = month_start(datetime.utcnow())
+    month = month_start(oldest) if oldest else this_month
+
+    while month < this_month:
+        conn.execute(f"CREATE TABLE {partition_name(month)} "
+                     "PARTITION OF messages FOR VALUES FROM (%s) TO (%s)",
+                     month, add_months(month, 1))
+        month = add_months(month, 1)
+
+    ensure_partitions(conn, ahead)
+
+    # Same columns in the same order (LIKE above): every one is copied
+    conn.execute("INSERT INTO messages SELECT * FROM messages_unpartitioned")
+    conn.execute("DROP TABLE messages_unpartitioned")
+    conn.execute(FOREIGN_KEY_TRIGGERS)
+
+
+def export(conn, query, path):
+    """Write `query`'s rows to `path` as gzipped CSV, all or nothing."""
+
+    partial = f"{path}.partial"
+    cursor = conn.connection.cursor()
+
+    with gzip.open(partial, 'wt') as out:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", out)
+
+    os.replace(partial, path)
+
+
+def archive_partition(conn, month, export_dir=None):
+    """Take `month`'s partition out of messages, with its messages' likes.
+
+    Without `export_dir` the partition is attached to messages_archive;
+    with it, the rows are written to <export_dir>/<partition>.csv.gz (and
+    .likes.csv.gz) and the partition is dropped.
+    """
+
+    name = partition_name(month)
+    likes = f"SELECT likes.* FROM likes JOIN {name} ON likes.message_id = {name}.id"
+
+    conn.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+        export(conn, f"SELECT * FROM {name} ORDER BY id",
+               os.path.join(export_dir, f"{name}.csv.gz"))
+        export(conn, likes, os.path.join(export_dir, f"{name}.likes.csv.gz"))
+    else:
+        conn.execute("CREATE TABLE IF NOT EXISTS messages_archive "
+                     "(LIKE messages) PARTITION BY RANGE (timestamp)")
+        conn.execute("CREATE TABLE IF NOT EXISTS likes_archive (LIKE likes)")
+        conn.execute(f"INSERT INTO likes_archive {likes}")
+
+    for table in MESSAGE_CHILDREN:
+        conn.execute(f"DELETE FROM {table} USING {name} "
+                     f"WHERE {table}.message_id = {name}.id")
+
+    if export_dir:
+        conn.execute(f"DROP TABLE {name}")
+    else:
+        conn.execute(f"ALTER TABLE messages_archive ATTACH PARTITION {name} "
+                     "FOR VALUES FROM (%s) TO (%s)",
+                     month, add_months(month, 1))
+
+    return name
+
+
+def old_partitions(conn, keep_months, today=None):
+    """Months, oldest first, of partitions over `keep_months` months old."""
+
+    cutoff = add_months(month_start(today or datetime.utcnow()), -keep_months)
+    return sorted(month for month in partitions(conn) if month < cutoff)
+
+
+@messages_cli.command('partition')
+@click.option('--ahead', default=3, show_default=True,
+              help='Months of empty partitions to create in advance.')
+def partition_command(ahead):
+    """Convert the messages table to monthly partitions."""
+
+    check_unsharded()
+
+    with db.engine.begin() as conn:
+        check_postgres(conn)
+
+        if is_partitioned(conn):
+            raise click.ClickException("messages is already partitioned.")
+
+        partition(conn, ahead)
+        click.echo(f"Partitioned messages into {len(partitions(conn))} months")
+
+
+@messages_cli.command('maintain')
+@click.option('--ahead', default=3, show_default=True,
+              help='Months of empty partitions to keep in advance.')
+@click.option('--keep-months', type=int, default=None,
+              help='Archive partitions older than this many months.')
+@click.option('--export-dir', type=click.Path(file_okay=False),
+              help='Archive to gzipped CSV files here and drop the '
+                   'partitions, instead of moving them to messages_archive.')
+def maintain_command(ahead, keep_months, export_dir):
+    """Create upcoming partitions and archive old ones."""
+
+    check_unsharded()
+
+    with db.engine.begin() as conn:
+        check_postgres(conn)
+
+        if not is_partitioned(conn):
+            raise click.ClickException(
+                "messages isn't partitioned; run `flask messages partition`.")
+
+        for name in ensure_partitions(conn, ahead):
+            click.echo(f"Created {name}")
+
+    if keep_months is None:
+        return
+
+    with db.engine.connect() as conn:
+        months = old_partitions(conn, keep_months)
+
+    # One transaction per partition: a failure leaves the rest in place
+    for month in months:
+        with db.engine.begin() as conn:
+            click.echo(f"Archived {archive_partition(conn, month, export_dir)}")
+
+
+def init_app(app):
+    """Add the partition maintenance commands and feed window to `app`."""
+
+    app.config.setdefault('MESSAGES_FEED_WINDOW', timedelta(
+        days=int(os.environ.get('MESSAGES_FEED_WINDOW_DAYS', 31))))
+
+    app.cli.add_command(messages_cli)
@@ -0,0 +1,230 @@
+"""Sampling profiler for live workers.
+
+With PROFILER_ENABLED set, a fraction of requests to each endpoint is
+profiled: PROFILER_RATES maps endpoints to the fraction sampled, and
+every other endpoint gets PROFILER_SAMPLE_RATE. While any sampled request
+is running, a background thread reads its stack every PROFILER_INTERVAL
+seconds and counts it, so the cost is one stack walk per sample, off the
+request's own path, and nothing at all between sampled requests.
+
+The counts are kept per process and served to admins (see admin.py) as
+collapsed stacks, one line per distinct stack, rooted at the endpoint:
+
+    GET    /admin/profile[?endpoint=warbler.homepage]   collapsed stacks
+    GET    /admin/profile/stats                         JSON summary
+    DELETE /admin/profile                               start over
+
+Feed the collapsed stacks to flamegraph.pl or speedscope to get a flame
+graph. Each answer comes from whichever worker took the request.
+
+Creating PROFILER_KILL_FILE stops every worker sampling new requests
+within a second, without a restart or a deploy; remove it to resume.
+
+Samples come from `sys._current_frames()`, so they see OS threads: the
+sync and gthread worker classes, not gevent's greenlets.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, current_app, jsonify, request
+
+from admin import admin_required
+
+profiler = Blueprint('profiler', __name__, url_prefix='/admin/profile')
+
+
+class Profiler:
+    """Count the stacks of sampled requests, by endpoint."""
+
+    def __init__(self, interval=0.005, max_stacks=10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.requests = Counter()
+        self.sampler_seconds = 0.0
+        self._active = {}
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def start_request(self, endpoint):
+        """Sample the current thread as serving `endpoint`."""
+
+        if self._pid != os.getpid():
+            # First use in this process (gunicorn forks after import)
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='profiler',
+                             daemon=True).start()
+
+        with self._lock:
+            self._active[threading.get_ident()] = endpoint
+            self.requests[endpoint] += 1
+
+        self._wake.set()
+
+    def end_request(self):
+        """Stop sampling the current thread."""
+
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+
+        if label is None:
+            label = self._labels[code] = (
+                f"{os.path.basename(code.co_filename)}:{code.co_name}")
+
+        return label
+
+    def sample(self):
+        """Count the current stack of every sampled request."""
+
+        started = time.perf_counter()
+        frames = sys._current_frames()
+
+        with self._lock:
+            active = list(self._active.items())
+
+        for ident, endpoint in active:
+            frame = frames.get(ident)
+            labels = []
+
+            while frame is not None:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+
+            labels.append(endpoint)
+            stack = ';'.join(reversed(labels))
+
+            with self._lock:
+                if (stack not in self.stacks
+                        and len(self.stacks) >= self.max_stacks):
+                    stack = f"{endpoint};[other]"
+                self.stacks[stack] += 1
+
+        self.sampler_seconds += time.perf_counter() - started
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+
+            while self._active:
+                time.sleep(self.interval)
+                self.sample()
+
+    def collapsed(self, endpoint=None):
+        """The counted stacks, as collapsed-stack lines."""
+
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks
+                       if endpoint is None
+                       or stack.split(';', 1)[0] == endpoint)
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.requests.clear()
+            self.sampler_seconds = 0.0
+
+
+def get_profiler():
+    """The current app's profiler."""
+
+    return current_app.extensions['profiler']
+
+
+def killed(app):
+    """Is PROFILER_KILL_FILE there? Checked at most once a second."""
+
+    state = app.extensions['profiler_kill']
+    now = time.monotonic()
+
+    if now - state['checked'] >= 1:
+        state['checked'] = now
+        state['killed'] = os.path.exists(app.config['PROFILER_KILL_FILE'])
+
+    return state['killed']
+
+
+def start_sampling():
+    """Maybe sample this request."""
+
+    app = current_app
+
+    if not app.config['PROFILER_ENABLED'] or request.endpoint is None:
+        return
+
+    rate = app.config['PROFILER_RATES'].get(
+        request.endpoint, app.config['PROFILER_SAMPLE_RATE'])
+
+    if random.random() < rate and not killed(app):
+        get_profiler().start_request(request.endpoint)
+
+
+def stop_sampling(exc):
+    if current_app.config['PROFILER_ENABLED']:
+        get_profiler().end_request()
+
+
+@profiler.route('', methods=['GET'])
+@admin_required
+def show_profile():
+    """Collapsed stacks of the requests sampled by this worker."""
+
+    return (get_profiler().collapsed(request.args.get('endpoint')),
+            200, {'Content-Type': 'text/plain; charset=utf-8'})
+
+
+@profiler.route('/stats')
+@admin_required
+def profile_stats():
+    """How much this worker has sampled, and what it cost."""
+
+    sampler = get_profiler()
+
+    return jsonify(enabled=(current_app.config['PROFILER_ENABLED']
+                            and not killed(current_app)),
+                   pid=os.getpid(),
+                   requests=dict(sampler.requests),
+                   samples=sum(sampler.stacks.values()),
+                   sampler_seconds=round(sampler.sampler_seconds, 6))
+
+
+@profiler.route('', methods=['DELETE'])
+@admin_required
+def reset_profile():
+    """Throw away this worker's samples."""
+
+    get_profiler().reset()
+    return ('', 204)
+
+
+def init_app(app):
+    """Sample requests to `app`, when enabled."""
+
+    app.config.setdefault('PROFILER_ENABLED',
+                          os.environ.get('PROFILER_ENABLED') == '1')
+    app.config.setdefault('PROFILER_SAMPLE_RATE', float(
+        os.environ.get('PROFILER_SAMPLE_RATE', 0.01)))
+    app.config.setdefault('PROFILER_RATES', {})
+    app.config.setdefault('PROFILER_INTERVAL', 0.005)
+    app.config.setdefault('PROFILER_KILL_FILE',
+                          os.path.join(app.instance_path, 'profiler.off'))
+
+    app.extensions['profiler'] = Profiler(app.config['PROFILER_INTERVAL'])
+    app.extensions['profiler_kill'] = {'checked': float('-inf'),
+                                       'killed': False}
+
+    app.register_blueprint(profiler)
+    app.before_request(start_sampling)
+    app.teardown_request(stop_sampling)
@@ -0,0 +1,203 @@
+"""Remove deleted users' rows in small batches, outside of requests.
+
+`delete_user()` only flags the account and queues a `UserPurge`. The rows
+are removed here, one bounded batch per transaction, so a user with a huge
+history never holds locks or memory for long. Progress is stored on the
+`UserPurge` row after every batch; an interrupted purge resumes from its
+last stage.
+
+Run it as a background worker:
+
+    FLASK_APP=app.py flask purge-users --watch
+"""
+
+import time
+
+import click
+from flask import has_app_context
+from flask.cli import with_appcontext
+
+from models import db, utcnow, Follows, Likes, Message, User, UserPurge
+import shards
+
+STAGES = ('likes', 'message_likes', 'messages', 'following', 'followers',
+          'user', 'done')
+
+
+def _delete_in(column, ids_query, *criteria):
+    """Delete rows whose `column` is in `ids_query`; return the row count."""
+
+    ids = [row[0] for row in ids_query]
+
+    if not ids:
+        return 0
+
+    return (column.class_.query
+            .filter(column.in_(ids), *criteria)
+            .delete(synchronize_session=False))
+
+
+def _purge_likes(user_id, size):
+    """Likes made by the user, taking them off the messages' counts."""
+
+    likes = (db.session.query(Likes.id, Likes.message_id)
+             .filter(Likes.user_id == user_id)
+             .limit(size)
+             .all())
+
+    deleted = _delete_in(Likes.id, likes)
+
+    if deleted:
+        # One like per (user, message), so each message loses exactly one
+        (Message.query
+         .filter(Message.id.in_([message_id for _, message_id in likes]))
+         .update({Message.like_count: Message.like_count - 1},
+                 synchronize_session=False))
+
+    return deleted
+
+
+def _purge_message_likes(user_id, size):
+    """Likes other users made on the user's messages."""
+
+    return _delete_in(
+        Likes.id,
+        db.session.query(Likes.id)
+        .join(Message, Likes.message_id == Message.id)
+        .filter(Message.user_id == user_id)
+        .limit(size))
+
+
+def _purge_messages(user_id, size):
+    """The user's messages."""
+
+    return _delete_in(
+        Message.id,
+        db.session.query(Message.id).filter(Message.user_id == user_id)
+        .limit(size))
+
+
+def _purge_following(user_id, size):
+    """Follows from the user to others."""
+
+    return _delete_in(
+        Follows.user_being_followed_id,
+        db.session.query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id == user_id)
+        .limit(size),
+        Follows.user_following_id == user_id)
+
+
+def _purge_followers(user_id, size):
+    """Follows from others to the user."""
+
+    return _delete_in(
+        Follows.user_following_id,
+        db.session.query(Follows.user_following_id)
+        .filter(Follows.user_being_followed_id == user_id)
+        .limit(size),
+        Follows.user_being_followed_id == user_id)
+
+
+def _purge_user(user_id, size):
+    """The user row itself."""
+
+    return User.query.filter_by(id=user_id).delete(synchronize_session=False)
+
+
+PURGERS = {
+    'likes': _purge_likes,
+    'message_likes': _purge_message_likes,
+    'messages': _purge_messages,
+    'following': _purge_following,
+    'followers': _purge_followers,
+    'user': _purge_user,
+}
+
+# With sharding on, messages and likes are on the shards, and each batch
+# of messages takes its likes with it
+SHARD_PURGERS = dict(PURGERS, likes=shards.purge_likes,
+                     message_likes=lambda user_id, size: 0,
+                     messages=shards.purge_messages)
+
+
+def purge_step(purge, batch_size=1000):
+    """Delete one batch of rows for `purge`.
+
+    When the current stage has nothing left, moves on to the next one.
+    Doesn't commit; callers commit after each step so every batch is its
+    own short transaction. Returns the number of rows deleted.
+    """
+
+    if purge.stage == 'done':
+        return 0
+
+    purgers = PURGERS
+
+    if has_app_context() and shards.enabled():
+        purgers = SHARD_PURGERS
+        # Rows deleted mid-move could be copied back
+        shards.wait_for_moves()
+
+    deleted = purgers[purge.stage](purge.user_id, batch_size)
+    purge.rows_deleted += deleted
+
+    if deleted < batch_size or purge.stage == 'user':
+        purge.stage = STAGES[STAGES.index(purge.stage) + 1]
+
+        if purge.stage == 'done':
+            purge.finished_at = utcnow()
+
+    return deleted
+
+
+def purge_user(purge, batch_size=1000, pause=0):
+    """Run `purge` to completion, committing after every batch.
+
+    `pause` seconds are slept between batches to leave room for other
+    writers on a busy database.
+    """
+
+    while purge.stage != 'done':
+        purge_step(purge, batch_size)
+        db.session.commit()
+
+        if pause:
+            time.sleep(pause)
+
+
+def pending_purges():
+    """Query for purges that haven't finished, oldest first."""
+
+    return (UserPurge
+            .query
+            .filter(UserPurge.finished_at.is_(None))
+            .order_by(UserPurge.requested_at, UserPurge.user_id))
+
+
+@click.command('purge-users')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Rows deleted per transaction.')
+@click.option('--pause', default=0.0, show_default=True,
+              help='Seconds to sleep between batches.')
+@click.option('--watch', is_flag=True,
+              help='Keep running and pick up new deletions.')
+@click.option('--poll-interval', default=5.0, show_default=True,
+              help='Seconds between checks for new deletions with --watch.')
+@with_appcontext
+def purge_users_command(batch_size, pause, watch, poll_interval):
+    """Remove the rows of deleted users."""
+
+    while True:
+        for purge in pending_purges().all():
+            click.echo(f"Purging user #{purge.user_id} "
+                       f"(resuming at {purge.stage})")
+            purge_user(purge, batch_size, pause)
+            click.echo(f"Purged user #{purge.user_id}: "
+                       f"{purge.rows_deleted} rows")
+
+        if not watch:
+            break
+
+        db.session.remove()
+        time.sleep(poll_interval)
@@ -0,0 +1,243 @@
+"""Token-bucket rate limiting for the expensive endpoints.
+
+RATELIMITS maps endpoint names to limits like "10/minute": a bucket
+holding up to 10 tokens, refilled at 10 per minute, so clients may burst
+up to the limit and then continue at its average rate. Each POST to a
+limited endpoint takes a token from the bucket of the logged-in user, or
+of the client's IP address for anonymous requests (behind a reverse
+proxy, apply werkzeug's ProxyFix so that's the real client address).
+Reads are never limited.
+
+Limited responses carry RateLimit-Limit, RateLimit-Remaining and
+RateLimit-Reset headers; rejected ones are 429s with Retry-After.
+
+Buckets live in RATELIMIT_STORE_URL:
+
+    memory://                 this process only (the default)
+    redis://host:6379/0       shared by every worker and node
+
+With the memory store each gunicorn worker counts separately, so a
+client can get up to WEB_CONCURRENCY times the limit; use Redis where
+that matters.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from flask import current_app, g, request
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 60 * 60, 'day': 24 * 60 * 60}
+
+DEFAULT_LIMITS = {
+    'warbler.login': '10/minute',
+    'warbler.signup': '10/hour',
+    'warbler.messages_add': '30/minute',
+    'warbler.like_message': '60/minute',
+    'warbler.add_follow': '30/minute',
+}
+
+LIMITED_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+@lru_cache(maxsize=None)
+def parse_limit(limit):
+    """(capacity, tokens per second) for a limit like "10/minute"."""
+
+    count, _, period = limit.partition('/')
+
+    try:
+        capacity = int(count)
+        seconds = PERIODS[period.strip()]
+    except (KeyError, ValueError):
+        raise ValueError(f"Bad rate limit: {limit!r}")
+
+    return capacity, capacity / seconds
+
+
+class MemoryStore:
+    """Token buckets in a dict, shared by this process's threads.
+
+    The dict is kept in least recently used order. Past `max_buckets`,
+    each take drops up to `prune_batch` of the least recently used: ones
+    idle for a day (so full again) first, then the oldest, which only
+    lets their clients start over with a full bucket.
+    """
+
+    max_buckets = 100000
+    prune_batch = 8
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token from `key`'s bucket.
+
+        Returns (allowed, tokens left, seconds until the bucket is full).
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, last = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - last) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+
+        return allowed, tokens, (capacity - tokens) / rate
+
+    def _prune(self, now):
+        buckets = self._buckets
+
+        for _ in range(self.prune_batch):
+            _, last = next(iter(buckets.values()))
+
+            # Buckets refill at different rates; one day refills any of
+            # them. Past that, the front is still idle, but not full yet.
+            if (now - last < PERIODS['day']
+                    and len(buckets) <= self.max_buckets):
+                break
+
+            buckets.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisStore:
+    """Token buckets in Redis, updated atomically by a script."""
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+    local tokens = tonumber(bucket[1]) or capacity
+    local last = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - last) * rate)
+
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self._take = self.redis.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, rate):
+        allowed, tokens = self._take(keys=[f"ratelimit:{key}"],
+                                     args=[capacity, rate])
+        tokens = float(tokens)
+        return bool(allowed), tokens, (capacity - tokens) / rate
+
+    def clear(self):
+        for key in self.redis.scan_iter('ratelimit:*'):
+            self.redis.delete(key)
+
+
+def open_store(url):
+    """The bucket store for RATELIMIT_STORE_URL `url`."""
+
+    if url.startswith('memory:'):
+        return MemoryStore()
+    if url.startswith(('redis:', 'rediss:')):
+        return RedisStore(url)
+
+    raise ValueError(f"Unknown rate limit store: {url}")
+
+
+def get_ratelimit_store():
+    """The current app's bucket store, created from its config on first use."""
+
+    store = current_app.extensions.get('ratelimit_store')
+
+    if store is None:
+        store = current_app.extensions['ratelimit_store'] = open_store(
+            current_app.config['RATELIMIT_STORE_URL'])
+
+    return store
+
+
+def check_rate_limit():
+    """Take a token for this request, or answer 429 if there are none."""
+
+    limit = current_app.config['RATELIMITS'].get(request.endpoint)
+
+    if (not limit or request.method not in LIMITED_METHODS
+            or not current_app.config['RATELIMIT_ENABLED']):
+        return None
+
+    capacity, rate = parse_limit(limit)
+
+    if g.get('user'):
+        key = f"{request.endpoint}:user:{g.user.id}"
+    else:
+        key = f"{request.endpoint}:ip:{request.remote_addr}"
+
+    allowed, tokens, reset = get_ratelimit_store().take(key, capacity, rate)
+
+    g.ratelimit_headers = {
+        'RateLimit-Limit': str(capacity),
+        'RateLimit-Remaining': str(int(tokens)),
+        'RateLimit-Reset': str(math.ceil(reset)),
+    }
+
+    if not allowed:
+        resp = current_app.make_response(
+            ("Too many requests. Please slow down and try again shortly.",
+             429))
+        resp.headers['Retry-After'] = str(math.ceil((1 - tokens) / rate))
+        return resp
+
+    return None
+
+
+def add_rate_limit_headers(resp):
+    """Tell limited clients where they stand."""
+
+    resp.headers.extend(g.get('ratelimit_headers', {}))
+    return resp
+
+
+def init_app(app):
+    """Rate limit `app`'s expensive endpoints.
+
+    Call after registering the blueprints: the check needs `g.user`, so it
+    must run after their before-request hooks.
+    """
+
+    app.config.setdefault('RATELIMITS', dict(DEFAULT_LIMITS))
+    app.config.setdefault('RATELIMIT_ENABLED', True)
+    app.config.setdefault('RATELIMIT_STORE_URL',
+                          os.environ.get('RATELIMIT_STORE_URL', 'memory://'))
+
+    # Fail at startup, not on the first limited request
+    for limit in app.config['RATELIMITS'].values():
+        parse_limit(limit)
+
+    app.before_request(check_rate_limit)
+    app.after_request(add_rate_limit_headers)
@@ -0,0 +1,162 @@
+"""Read-only queries for the hot pages, on SQLAlchemy Core.
+
+The timeline, profile and user list pages only print a handful of
+columns. Loading them as `User` and `Message` objects also loads every
+other column (bio, password hash and all), registers each object in the
+session's identity map and tracks it for changes that never come. These
+queries select just the columns the templates use, in one statement per
+page, into small `__slots__` records with the same attribute names, so
+templates can't tell the difference.
+
+Records are plain data: they can outlive the session and be pickled
+(feedcache.py keeps them). Writes still go through the models.
+
+See benchmarks/read_path.py for what this saves per request.
+"""
+
+from datetime import datetime
+
+from models import db, Follows, Likes, Message, User
+
+messages = Message.__table__
+users = User.__table__
+
+
+class Record:
+    """A row as an object with just the fields in `__slots__`."""
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name, None)!r}"
+                           for name in self.__slots__)
+        return f"<{type(self).__name__} {fields}>"
+
+
+class Author(Record):
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url')
+
+
+class MessageRecord(Record):
+    __slots__ = ('id', 'text', 'timestamp', 'like_count', 'user_id', 'user')
+
+
+class UserCard(Record):
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
+class Stats(Record):
+    __slots__ = ('messages', 'likes', 'following', 'followers')
+
+
+class Profile(Record):
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                 'location', 'stats', 'messages')
+
+
+FEED_COLUMNS = [messages.c.id, messages.c.text, messages.c.timestamp,
+                messages.c.like_count, messages.c.user_id,
+                users.c.username, users.c.image_url, users.c.header_image_url]
+
+CARD_COLUMNS = [users.c.id, users.c.username, users.c.image_url,
+                users.c.header_image_url, users.c.bio]
+
+
+def message_records(rows):
+    """MessageRecords from FEED_COLUMNS rows, one Author per author."""
+
+    authors = {}
+    records = []
+
+    for message_id, text, timestamp, like_count, user_id, *author in rows:
+        user = authors.get(user_id)
+        if user is None:
+            user = authors[user_id] = Author(user_id, *author)
+
+        records.append(MessageRecord(message_id, text, timestamp,
+                                     like_count, user_id, user))
+
+    return records
+
+
+def feed(user_ids, limit=100, window=None):
+    """`Message.feed()`, as MessageRecords with their authors."""
+
+    query = (db.select(FEED_COLUMNS)
+             .select_from(messages.join(users,
+                                        messages.c.user_id == users.c.id))
+             .where(messages.c.user_id.in_(user_ids))
+             .order_by(messages.c.timestamp.desc(), messages.c.id.desc()))
+
+    if not window:
+        rows = db.session.execute(query.limit(limit)).fetchall()
+    else:
+        cutoff = datetime.utcnow() - window
+        rows = db.session.execute(
+            query.where(messages.c.timestamp >= cutoff).limit(limit)
+        ).fetchall()
+
+        if len(rows) < limit:
+            rows += db.session.execute(
+                query.where(messages.c.timestamp < cutoff)
+                .limit(limit - len(rows))).fetchall()
+
+    return message_records(rows)
+
+
+def user_cards(search=None):
+    """UserCards of active users, with `search` in their username if given."""
+
+    query = db.select(CARD_COLUMNS).where(users.c.deleted_at.is_(None))
+
+    if search:
+        query = query.where(users.c.username.like(f"%{search}%"))
+
+    return [UserCard(*row) for row in db.session.execute(query)]
+
+
+def followed_ids(user_id):
+    """Ids of the active users `user_id` follows."""
+
+    follows = Follows.__table__
+    query = (db.select([follows.c.user_being_followed_id])
+             .select_from(follows.join(
+                 users, follows.c.user_being_followed_id == users.c.id))
+             .where(follows.c.user_following_id == user_id)
+             .where(users.c.deleted_at.is_(None)))
+
+    return [followed_id for (followed_id,) in db.session.execute(query)]
+
+
+def profile(user_id, window=None):
+    """An active user's Profile, or None.
+
+    Message and like counts come with the user's row; the follow counts
+    are left for the caller (see graph.py), as None.
+    """
+
+    message_count = (db.select([db.func.count()])
+                     .where(messages.c.user_id == user_id).as_scalar())
+    like_count = (db.select([db.func.count()])
+                  .where(Likes.__table__.c.user_id == user_id).as_scalar())
+
+    row = db.session.execute(
+        db.select([users.c.id, users.c.username, users.c.image_url,
+                   users.c.header_image_url, users.c.bio, users.c.location,
+                   message_count, like_count])
+        .where(users.c.id == user_id)
+        .where(users.c.deleted_at.is_(None))).first()
+
+    if row is None:
+        return None
+
+    *fields, message_count, like_count = row
+    user = Profile(*fields)
+    user.stats = Stats(message_count, like_count, None, None)
+    user.messages = feed([user_id], window=window)
+
+    return user
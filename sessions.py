@@ -0,0 +1,375 @@
+"""Server-side sessions behind a short opaque cookie.
+
+Flask's default session is the whole session dict, signed, in a cookie:
+every request uploads it and pays to verify the signature. Here the
+cookie only holds a random session id; the data lives in a store chosen
+by SESSION_STORE_URL:
+
+    sqlite:///path/to/sessions.db   (default, under the instance folder)
+    file:///path/to/directory       one file per session
+    redis://host:6379/0             shared by every node (needs `redis`)
+
+Each worker keeps recently used sessions in a small LRU for
+SESSION_CACHE_TTL seconds, so hot sessions skip the store entirely; that
+TTL is also how long a session revoked from another process may linger
+in this one. `regenerate()` revokes the current session id immediately
+(logout, login) and expired sessions are swept by a background thread
+every SESSION_SWEEP_INTERVAL seconds.
+"""
+
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+serializer = TaggedJSONSerializer()
+
+# What secrets.token_urlsafe() produces; anything else is never looked up
+SID_PATTERN = re.compile(r'[A-Za-z0-9_-]{16,64}')
+
+
+class SQLiteStore:
+    """Sessions in a SQLite database, one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections mustn't survive a fork (gunicorn's preload_app)
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(sid TEXT PRIMARY KEY, data TEXT, expires REAL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+
+        return conn
+
+    def load(self, sid):
+        """(data, expires) of an unexpired session, or None."""
+
+        return self._connection().execute(
+            "SELECT data, expires FROM sessions WHERE sid = ? AND expires > ?",
+            (sid, time.time())).fetchone()
+
+    def save(self, sid, data, expires):
+        self._connection().execute(
+            "REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+            (sid, data, expires))
+
+    def delete(self, sid):
+        self._connection().execute("DELETE FROM sessions WHERE sid = ?",
+                                   (sid,))
+
+    def sweep(self):
+        """Delete expired sessions; return how many there were."""
+
+        return self._connection().execute(
+            "DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+
+
+class FilesystemStore:
+    """Sessions as JSON files in a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sid):
+        return os.path.join(self.directory, sid)
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid)) as source:
+                record = json.load(source)
+        except (OSError, ValueError):
+            return None
+
+        if record['expires'] <= time.time():
+            return None
+
+        return record['data'], record['expires']
+
+    def save(self, sid, data, expires):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Write aside and rename, so readers never see a partial file
+        partial = f"{self._path(sid)}.{os.getpid()}.{threading.get_ident()}"
+        with open(partial, 'w') as out:
+            json.dump({'data': data, 'expires': expires}, out)
+        os.replace(partial, self._path(sid))
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        swept = 0
+
+        for sid in os.listdir(self.directory):
+            if '.' not in sid and self.load(sid) is None:
+                self.delete(sid)
+                swept += 1
+
+        return swept
+
+
+class RedisStore:
+    """Sessions in Redis, which expires them by itself."""
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def load(self, sid):
+        pipe = self.redis.pipeline()
+        pipe.get(f"session:{sid}")
+        pipe.ttl(f"session:{sid}")
+        data, ttl = pipe.execute()
+
+        if data is None:
+            return None
+
+        return data.decode('utf-8'), time.time() + max(ttl, 0)
+
+    def save(self, sid, data, expires):
+        self.redis.set(f"session:{sid}", data,
+                       ex=max(int(expires - time.time()), 1))
+
+    def delete(self, sid):
+        self.redis.delete(f"session:{sid}")
+
+    def sweep(self):
+        return 0
+
+
+def open_store(url):
+    """The session store for SESSION_STORE_URL `url`."""
+
+    scheme, _, location = url.partition('://')
+
+    if scheme == 'sqlite':
+        return SQLiteStore(location)
+    if scheme == 'file':
+        return FilesystemStore(location)
+    if scheme in ('redis', 'rediss'):
+        return RedisStore(url)
+
+    raise ValueError(f"Unknown session store: {url}")
+
+
+class ServerSideSession(SecureCookieSession):
+    """Session dict that knows its id and when it expires."""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires = expires
+        self.new = sid is None
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keep session data in a store, with only its id in the cookie."""
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def store(self, app):
+        store = app.extensions.get('session_store')
+
+        if store is None:
+            store = app.extensions['session_store'] = open_store(
+                app.config['SESSION_STORE_URL'])
+
+        return store
+
+    def _cached(self, app, sid):
+        with self._lock:
+            entry = self._cache.get(sid)
+
+            if entry is None:
+                return None
+
+            record, fetched = entry
+            if time.monotonic() - fetched > app.config['SESSION_CACHE_TTL']:
+                del self._cache[sid]
+                return None
+
+            self._cache.move_to_end(sid)
+            return record
+
+    def _remember(self, sid, record):
+        with self._lock:
+            self._cache[sid] = (record, time.monotonic())
+            self._cache.move_to_end(sid)
+
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def forget(self, sid):
+        """Drop `sid` from this process's cache."""
+
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+
+        if not sid or not SID_PATTERN.fullmatch(sid):
+            return ServerSideSession()
+
+        record = self._cached(app, sid)
+
+        if record is None:
+            record = self.store(app).load(sid)
+
+            if record is None:
+                return ServerSideSession()
+
+            self._remember(sid, record)
+
+        data, expires = record
+
+        if expires <= time.time():
+            return ServerSideSession()
+
+        data = serializer.loads(data)
+
+        # Whatever else is in the store isn't a session
+        if not isinstance(data, dict):
+            return ServerSideSession()
+
+        return ServerSideSession(data, sid, expires)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                if session.sid:
+                    self.forget(session.sid)
+                    self.store(app).delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+
+        # Unchanged sessions are only written again once half their
+        # lifetime is used up, to keep idle sessions alive
+        if (not session.modified and session.expires
+                and session.expires - now > lifetime / 2):
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(18)
+
+        record = (serializer.dumps(dict(session)), now + lifetime)
+        self.store(app).save(session.sid, *record)
+        self._remember(session.sid, record)
+
+        response.set_cookie(
+            app.session_cookie_name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def regenerate():
+    """Revoke the current session id; keep its data under a fresh one.
+
+    Call on login and logout, so an id seen before can't be replayed.
+    """
+
+    if session.sid:
+        current_app.session_interface.forget(session.sid)
+        get_session_store().delete(session.sid)
+
+    session.sid = None
+    session.modified = True
+
+
+def create_session(data):
+    """Store a new session holding `data`; return its id (for scripts)."""
+
+    sid = secrets.token_urlsafe(18)
+    lifetime = current_app.permanent_session_lifetime.total_seconds()
+
+    get_session_store().save(sid, serializer.dumps(data),
+                             time.time() + lifetime)
+    return sid
+
+
+def get_session_store():
+    """The current app's session store."""
+
+    return current_app.session_interface.store(current_app)
+
+
+def start_sweeper(app):
+    """Delete expired sessions every SESSION_SWEEP_INTERVAL seconds."""
+
+    interval = app.config['SESSION_SWEEP_INTERVAL']
+    store = app.session_interface.store(app)
+
+    def sweep():
+        while True:
+            time.sleep(interval)
+            try:
+                swept = store.sweep()
+            except Exception:
+                app.logger.exception("Session sweep failed")
+            else:
+                if swept:
+                    app.logger.info("Swept %d expired sessions", swept)
+
+    threading.Thread(target=sweep, name='session-sweeper', daemon=True).start()
+
+
+def ensure_sweeper():
+    """Start the sweeper in this worker, after gunicorn has forked."""
+
+    app = current_app._get_current_object()
+    sweeper = app.extensions['session_sweeper']
+
+    if sweeper['pid'] != os.getpid() and app.config['SESSION_SWEEP_INTERVAL']:
+        sweeper['pid'] = os.getpid()
+        start_sweeper(app)
+
+
+def init_app(app):
+    """Store `app`'s sessions server-side."""
+
+    app.config.setdefault('SESSION_STORE_URL', os.environ.get(
+        'SESSION_STORE_URL',
+        'sqlite:///' + os.path.join(app.instance_path, 'sessions.db')))
+    app.config.setdefault('SESSION_CACHE_TTL', 5)
+    app.config.setdefault('SESSION_SWEEP_INTERVAL', 15 * 60)
+
+    app.session_interface = ServerSideSessionInterface()
+
+    app.extensions['session_sweeper'] = {'pid': None}
+    app.before_request(ensure_sweeper)
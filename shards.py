@@ -0,0 +1,1056 @@
+"""Horizontal sharding of messages and likes by user id.
+
+With SHARD_URLS set, messages (with their tags and mentions) and likes
+no longer live in the main database but on N shard databases, so posting
+and liking are spread over N primaries. Users, follows and everything
+else stay in the main database.
+
+    messages, message_tags, mentions   on the shard of the author
+    likes                              on the shard of the liker
+
+User ids are hashed into BUCKETS buckets (`user_id % BUCKETS`), and the
+shard map, a JSON file at SHARD_MAP_PATH, says which shard holds each
+bucket. Workers re-read it when it changes, so moving buckets between
+shards (`flask shards rebalance`) needs no restart. While a bucket moves
+the map marks it read-only, and writes by its users are refused with a
+503 until the move is done.
+
+Message ids must stay unique across shards, and keep working after their
+rows move, so they're not taken from a per-table sequence. Each process
+reserves blocks of ID_BLOCK ids from the `id_blocks` table of the shard
+it's writing to; block b of the shard with index k covers
+
+    first_id + (b * MAX_SHARDS + k) * ID_BLOCK  ...  + ID_BLOCK - 1
+
+Indexes are never reused, even after a shard is retired.
+
+A like and its message can be on different shards. The like is written
+first, then the message's like_count; if the process dies in between the
+count is one off until `flask shards reconcile-likes` repairs it.
+
+Reads that span users fan out: the home timeline asks each shard holding
+one of the followed users for its newest messages (in parallel), merges
+those by timestamp and keeps the top `limit`; a message looked up by id
+is asked of every shard. Authors come from the main database in one
+query.
+
+Routed: posting, liking and unliking, deleting a message, the home
+timeline, profiles, message pages, likes pages, tag and mention pages and
+user purges. With sharding on, the async read routes (asgi.py) hand every
+request to the sync views, /stream doesn't replay missed messages to a
+reconnecting browser (shard ids aren't in posting order), and `flask
+messages` partitioning refuses to run.
+
+Setting up, then growing from two shards to three:
+
+    SHARD_URLS=a=postgresql:///warbler-a,b=postgresql:///warbler-b \\
+        flask shards init a b
+    flask shards migrate              # copy existing rows from main
+    SHARD_URLS=a=...,b=...,c=postgresql:///warbler-c \\
+        flask shards rebalance a b c
+"""
+
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import abort, current_app
+from flask.cli import AppGroup
+from sqlalchemy import (
+    Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table,
+    Text, UniqueConstraint, create_engine, func, select, true, tuple_)
+from sqlalchemy.exc import IntegrityError
+
+import reads
+import tags
+from models import db, utcnow
+
+shards_cli = AppGroup('shards', help='Manage message and like shards.')
+
+BUCKETS = 1024
+MAX_SHARDS = 16
+ID_BLOCK = 1000
+
+# The shards' tables: as in models.py, minus the foreign keys that would
+# point into another database
+metadata = MetaData()
+
+messages = Table(
+    'messages', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False, server_default=utcnow()),
+    Column('user_id', Integer, nullable=False),
+    Column('like_count', Integer, nullable=False, server_default='0'),
+    Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+)
+
+likes = Table(
+    'likes', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, nullable=False),
+    Column('message_id', Integer, nullable=False, index=True),
+    UniqueConstraint('user_id', 'message_id'),
+)
+
+message_tags = Table(
+    'message_tags', metadata,
+    Column('tag', Text, primary_key=True),
+    Column('message_id', Integer,
+           ForeignKey('messages.id', ondelete='cascade'),
+           primary_key=True, index=True),
+)
+
+mentions = Table(
+    'mentions', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('message_id', Integer,
+           ForeignKey('messages.id', ondelete='cascade'),
+           primary_key=True, index=True),
+)
+
+id_blocks = Table(
+    'id_blocks', metadata,
+    Column('id', Integer, primary_key=True),
+)
+
+FEED_COLUMNS = [messages.c.id, messages.c.text, messages.c.timestamp,
+                messages.c.like_count, messages.c.user_id]
+
+
+class ShardMap:
+    """Which shard holds each bucket of user ids."""
+
+    def __init__(self, buckets, indexes, first_id=1, moving=()):
+        self.buckets = list(buckets)
+        self.indexes = dict(indexes)
+        self.first_id = first_id
+        self.moving = frozenset(moving)
+
+    @classmethod
+    def spread(cls, names, first_id=1):
+        """The buckets dealt out evenly to shards `names`."""
+
+        return cls([names[bucket % len(names)] for bucket in range(BUCKETS)],
+                   {name: index for index, name in enumerate(names)},
+                   first_id)
+
+    @property
+    def names(self):
+        """The shards holding buckets, in index order."""
+
+        return sorted(set(self.buckets), key=self.indexes.get)
+
+    def shard_for(self, user_id):
+        return self.buckets[user_id % BUCKETS]
+
+    def is_moving(self, user_id):
+        return user_id % BUCKETS in self.moving
+
+    def group(self, user_ids):
+        """{shard name: [user ids on it]} for `user_ids`."""
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+        return groups
+
+    def rebalance(self, names):
+        """A map spreading the buckets evenly over `names`, moving as few
+        buckets as it can."""
+
+        indexes = dict(self.indexes)
+        for name in names:
+            if name not in indexes:
+                indexes[name] = max(indexes.values(), default=-1) + 1
+
+        if max(indexes.values()) >= MAX_SHARDS:
+            raise ValueError(f"At most {MAX_SHARDS} shards can ever be used")
+
+        count = len(self.buckets)
+        quota = {name: count // len(names) + (i < count % len(names))
+                 for i, name in enumerate(names)}
+        buckets = list(self.buckets)
+        spare = []
+
+        for bucket, name in enumerate(buckets):
+            if quota.get(name, 0) > 0:
+                quota[name] -= 1
+            else:
+                spare.append(bucket)
+
+        wanting = [name for name in names for _ in range(quota[name])]
+        for bucket, name in zip(spare, wanting):
+            buckets[bucket] = name
+
+        return ShardMap(buckets, indexes, self.first_id)
+
+    def moves(self, other):
+        """{(from shard, to shard): [buckets]} to get from here to `other`."""
+
+        moves = {}
+        for bucket, (old, new) in enumerate(zip(self.buckets, other.buckets)):
+            if old != new:
+                moves.setdefault((old, new), []).append(bucket)
+        return moves
+
+    def freeze(self, buckets):
+        """This map, with `buckets` read-only."""
+
+        return ShardMap(self.buckets, self.indexes, self.first_id, buckets)
+
+    def to_json(self):
+        return {'first_id': self.first_id, 'indexes': self.indexes,
+                'buckets': self.buckets, 'moving': sorted(self.moving)}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['buckets'], data['indexes'], data['first_id'],
+                   data.get('moving', ()))
+
+    def save(self, path):
+        """Write the map to `path`; readers see the old map or the new one."""
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.to_json(), f)
+
+        os.replace(partial, path)
+
+
+class Shards:
+    """Engines for the shards, the current shard map and id blocks."""
+
+    def __init__(self, urls, map_path):
+        self.urls = dict(urls)
+        self.map_path = map_path
+        self._map = None
+        self._map_mtime = None
+        self._map_checked = 0
+        self._engines = {}
+        self._blocks = {}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def _forked(self):
+        # Engines, id blocks and threads don't survive gunicorn's fork
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._engines = {}
+            self._blocks = {}
+            self._executor = None
+
+    def engine(self, name):
+        with self._lock:
+            self._forked()
+
+            engine = self._engines.get(name)
+            if engine is None:
+                engine = self._engines[name] = create_engine(self.urls[name])
+            return engine
+
+    @property
+    def executor(self):
+        with self._lock:
+            self._forked()
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    len(self.urls), thread_name_prefix='shards')
+            return self._executor
+
+    @property
+    def map(self):
+        """The shard map, re-read at most once a second when it changes."""
+
+        now = time.monotonic()
+
+        if self._map is None or now - self._map_checked >= 1:
+            self._map_checked = now
+            mtime = os.stat(self.map_path).st_mtime_ns
+
+            if mtime != self._map_mtime:
+                self._map = ShardMap.load(self.map_path)
+                self._map_mtime = mtime
+
+        return self._map
+
+    def reload_map(self):
+        """Read the shard map again on next use."""
+
+        self._map = None
+
+    def for_user(self, user_id):
+        """The name and engine of the shard holding `user_id`'s rows."""
+
+        name = self.map.shard_for(user_id)
+        return name, self.engine(name)
+
+    def next_id(self, name):
+        """A message id no other process or shard will hand out."""
+
+        with self._lock:
+            self._forked()
+            block = self._blocks.get(name)
+
+            if not block:
+                with self.engine(name).begin() as conn:
+                    number = conn.execute(
+                        id_blocks.insert()).inserted_primary_key[0]
+
+                shard_map = self.map
+                first = shard_map.first_id + (
+                    number * MAX_SHARDS + shard_map.indexes[name]) * ID_BLOCK
+                block = self._blocks[name] = list(
+                    range(first + ID_BLOCK - 1, first - 1, -1))
+
+            return block.pop()
+
+    def each(self, function, work):
+        """[`function(engine, arg)` for each shard name: arg in `work`],
+        run on the shards in parallel."""
+
+        if len(work) == 1:
+            (name, arg), = work.items()
+            return [function(self.engine(name), arg)]
+
+        futures = [self.executor.submit(function, self.engine(name), arg)
+                   for name, arg in work.items()]
+        return [future.result() for future in futures]
+
+    def dispose(self):
+        """Close the shards' connections and fan-out threads."""
+
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines = {}
+
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def get_shards():
+    """The current app's Shards, or None when sharding is off."""
+
+    return current_app.extensions.get('shards')
+
+
+def enabled():
+    return get_shards() is not None
+
+
+def create_tables(engine):
+    metadata.create_all(engine)
+
+
+def _check_writable(user_ids=None):
+    """503 if a bucket of `user_ids` (any bucket, by default) is being
+    moved."""
+
+    shard_map = get_shards().map
+
+    if shard_map.moving and (user_ids is None or any(
+            shard_map.is_moving(user_id) for user_id in user_ids)):
+        abort(503, "Messages are being moved between databases. Please "
+                   "try again in a moment.", retry_after=5)
+
+
+def _authors(user_ids, active=False):
+    """{user id: (username, image_url, header_image_url)} from main; only
+    of users who haven't deleted their account, if `active`."""
+
+    users = reads.users
+
+    if not user_ids:
+        return {}
+
+    query = (db.select([users.c.id, users.c.username, users.c.image_url,
+                        users.c.header_image_url])
+             .where(users.c.id.in_(list(user_ids))))
+
+    if active:
+        query = query.where(users.c.deleted_at.is_(None))
+
+    return {user_id: author
+            for user_id, *author in db.session.execute(query)}
+
+
+def _with_authors(rows, active=False):
+    """MessageRecords for FEED_COLUMNS `rows`; authors gone are dropped."""
+
+    authors = _authors({row[4] for row in rows}, active)
+    return reads.message_records(
+        (*row, *authors[row[4]]) for row in rows if row[4] in authors)
+
+
+def _newest(engine, user_ids, limit, cutoff):
+    """The newest `limit` messages on one shard by any of `user_ids`."""
+
+    query = (select(FEED_COLUMNS)
+             .where(messages.c.user_id.in_(user_ids))
+             .order_by(messages.c.timestamp.desc(), messages.c.id.desc()))
+
+    with engine.connect() as conn:
+        if cutoff is None:
+            return [tuple(row) for row in conn.execute(query.limit(limit))]
+
+        rows = [tuple(row) for row in conn.execute(
+            query.where(messages.c.timestamp >= cutoff).limit(limit))]
+
+        if len(rows) < limit:
+            rows += [tuple(row) for row in conn.execute(
+                query.where(messages.c.timestamp < cutoff)
+                .limit(limit - len(rows)))]
+
+        return rows
+
+
+def feed(user_ids, limit=100, window=None):
+    """`reads.feed()` across the shards: each shard's newest `limit`,
+    merged newest first."""
+
+    shards = get_shards()
+    cutoff = datetime.utcnow() - window if window else None
+
+    per_shard = shards.each(
+        lambda engine, ids: _newest(engine, ids, limit, cutoff),
+        shards.map.group(user_ids))
+
+    newest = heapq.merge(*per_shard, key=lambda row: (row[2], row[0]),
+                         reverse=True)
+    return _with_authors(list(islice(newest, limit)))
+
+
+def profile(user_id, window=None):
+    """`reads.profile()`, with the counts from the user's shard."""
+
+    users = reads.users
+    row = db.session.execute(
+        db.select([users.c.id, users.c.username, users.c.image_url,
+                   users.c.header_image_url, users.c.bio, users.c.location])
+        .where(users.c.id == user_id)
+        .where(users.c.deleted_at.is_(None))).first()
+
+    if row is None:
+        return None
+
+    _, engine = get_shards().for_user(user_id)
+
+    with engine.connect() as conn:
+        message_count = conn.execute(
+            select([func.count()]).where(messages.c.user_id == user_id)
+        ).scalar()
+        like_count = conn.execute(
+            select([func.count()]).where(likes.c.user_id == user_id)
+        ).scalar()
+
+    user = reads.Profile(*row)
+    user.stats = reads.Stats(message_count, like_count, None, None)
+    user.messages = feed([user_id], window=window)
+
+    return user
+
+
+def tagged(table, column, value, before, size):
+    """`tags.page()` across the shards, for the messages whose `table`
+    (message_tags or mentions) row has `column` == `value`.
+
+    Returns (MessageRecords, `before` for the next page or None).
+    """
+
+    query = (select(FEED_COLUMNS)
+             .select_from(messages.join(
+                 table, table.c.message_id == messages.c.id))
+             .where(table.c[column] == value)
+             .order_by(messages.c.id.desc()).limit(size + 1))
+
+    if before:
+        query = query.where(messages.c.id < before)
+
+    def newest(engine, _):
+        with engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(query)]
+
+    shards = get_shards()
+    rows = list(islice(heapq.merge(
+        *shards.each(newest, {name: None for name in shards.map.names}),
+        key=lambda row: row[0], reverse=True), size + 1))
+
+    if len(rows) > size:
+        return _with_authors(rows[:size], active=True), rows[size - 1][0]
+
+    return _with_authors(rows, active=True), None
+
+
+def find_message(message_id):
+    """(shard name, FEED_COLUMNS row) of message `message_id`; 404s."""
+
+    def lookup(engine, name):
+        with engine.connect() as conn:
+            row = conn.execute(select(FEED_COLUMNS)
+                               .where(messages.c.id == message_id)).first()
+        return row and (name, tuple(row))
+
+    shards = get_shards()
+    for found in shards.each(lookup, {name: name
+                                      for name in shards.map.names}):
+        if found:
+            return found
+
+    abort(404)
+
+
+def get_message(message_id):
+    """Message `message_id` as a MessageRecord; 404s if it or its author
+    is gone."""
+
+    _, row = find_message(message_id)
+    users = reads.users
+    author = db.session.execute(
+        db.select([users.c.username, users.c.image_url,
+                   users.c.header_image_url])
+        .where(users.c.id == row[4])
+        .where(users.c.deleted_at.is_(None))).first()
+
+    if author is None:
+        abort(404)
+
+    return reads.message_records([(*row, *author)])[0]
+
+
+def post_message(user, text):
+    """Add a message by `user` on their shard, with its tags and mentions.
+
+    Commits, and returns the message as a MessageRecord.
+    """
+
+    _check_writable([user.id])
+
+    shards = get_shards()
+    name, engine = shards.for_user(user.id)
+    message_id = shards.next_id(name)
+    mentioned = tags.mentioned_user_ids(text)
+
+    with engine.begin() as conn:
+        conn.execute(messages.insert().values(id=message_id, user_id=user.id,
+                                              text=text))
+
+        for tag in tags.parse_tags(text):
+            conn.execute(message_tags.insert().values(tag=tag,
+                                                      message_id=message_id))
+        for user_id in mentioned:
+            conn.execute(mentions.insert().values(user_id=user_id,
+                                                  message_id=message_id))
+
+        timestamp = conn.execute(select([messages.c.timestamp])
+                                 .where(messages.c.id == message_id)).scalar()
+
+    author = reads.Author(user.id, user.username, user.image_url,
+                          user.header_image_url)
+    return reads.MessageRecord(message_id, text, timestamp, 0, user.id, author)
+
+
+def _count_like(conn, message_id, change):
+    conn.execute(messages.update()
+                 .where(messages.c.id == message_id)
+                 .values(like_count=messages.c.like_count + change))
+
+
+def _change_like(message_id, user_id, liked):
+    """Like or unlike; returns the message's author id. 404s."""
+
+    shards = get_shards()
+    owner, row = find_message(message_id)
+    _check_writable([user_id, row[4]])
+    liker, engine = shards.for_user(user_id)
+
+    try:
+        with engine.begin() as conn:
+            if liked:
+                conn.execute(likes.insert().values(user_id=user_id,
+                                                   message_id=message_id))
+            elif not conn.execute(likes.delete().where(
+                    (likes.c.user_id == user_id)
+                    & (likes.c.message_id == message_id))).rowcount:
+                return row[4]
+
+            if owner == liker:
+                _count_like(conn, message_id, 1 if liked else -1)
+    except IntegrityError:
+        # Already liked
+        return row[4]
+
+    if owner != liker:
+        # Not atomic with the like; `flask shards reconcile-likes` repairs
+        with shards.engine(owner).begin() as conn:
+            _count_like(conn, message_id, 1 if liked else -1)
+
+    return row[4]
+
+
+def like(message_id, user_id):
+    """`Message.like()` across shards; commits, returns the author's id."""
+
+    return _change_like(message_id, user_id, True)
+
+
+def unlike(message_id, user_id):
+    """`Message.unlike()` across shards; commits, returns the author's id."""
+
+    return _change_like(message_id, user_id, False)
+
+
+def delete_message(message_id, user_id):
+    """Delete `user_id`'s message `message_id` and every like of it.
+
+    Returns False, deleting nothing, if it isn't theirs. 404s, or 503s
+    while any bucket is moving: its likes may be in one.
+    """
+
+    shards = get_shards()
+    owner, row = find_message(message_id)
+
+    if row[4] != user_id:
+        return False
+
+    _check_writable()
+
+    with shards.engine(owner).begin() as conn:
+        for table in (message_tags, mentions):
+            conn.execute(table.delete().where(
+                table.c.message_id == message_id))
+        conn.execute(messages.delete().where(messages.c.id == message_id))
+
+    def unlike_all(engine, _):
+        with engine.begin() as conn:
+            conn.execute(likes.delete().where(
+                likes.c.message_id == message_id))
+
+    shards.each(unlike_all, {name: None for name in shards.map.names})
+    return True
+
+
+def liked_message_ids(user_id):
+    _, engine = get_shards().for_user(user_id)
+
+    with engine.connect() as conn:
+        return frozenset(message_id for (message_id,) in conn.execute(
+            select([likes.c.message_id]).where(likes.c.user_id == user_id)))
+
+
+def liked_messages(user_id):
+    """MessageRecords of the messages `user_id` likes, in liking order."""
+
+    shards = get_shards()
+    _, engine = shards.for_user(user_id)
+
+    with engine.connect() as conn:
+        message_ids = [message_id for (message_id,) in conn.execute(
+            select([likes.c.message_id]).where(likes.c.user_id == user_id)
+            .order_by(likes.c.id))]
+
+    def fetch(engine, _):
+        with engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(
+                select(FEED_COLUMNS).where(messages.c.id.in_(message_ids)))]
+
+    found = {row[0]: row for rows in shards.each(
+        fetch, {name: None for name in shards.map.names}) for row in rows}
+
+    return _with_authors([found[message_id] for message_id in message_ids
+                          if message_id in found])
+
+
+def wait_for_moves(interval=1):
+    """Block while any bucket is being moved."""
+
+    shards = get_shards()
+
+    while shards.map.moving:
+        time.sleep(interval)
+
+
+def purge_likes(user_id, size):
+    """`purge._purge_likes()` on the shards: up to `size` of the user's
+    likes, taken off the messages' counts."""
+
+    shards = get_shards()
+    _, engine = shards.for_user(user_id)
+
+    with engine.begin() as conn:
+        rows = conn.execute(select([likes.c.id, likes.c.message_id])
+                            .where(likes.c.user_id == user_id)
+                            .limit(size)).fetchall()
+        if rows:
+            conn.execute(likes.delete().where(
+                likes.c.id.in_([like_id for like_id, _ in rows])))
+
+    if rows:
+        message_ids = [message_id for _, message_id in rows]
+
+        def uncount(engine, _):
+            with engine.begin() as conn:
+                conn.execute(messages.update()
+                             .where(messages.c.id.in_(message_ids))
+                             .values(like_count=messages.c.like_count - 1))
+
+        shards.each(uncount, {name: None for name in shards.map.names})
+
+    return len(rows)
+
+
+def purge_messages(user_id, size):
+    """`purge._purge_messages()` on the shards: up to `size` of the
+    user's messages, with their tags, mentions and likes."""
+
+    shards = get_shards()
+    _, engine = shards.for_user(user_id)
+
+    with engine.connect() as conn:
+        message_ids = [message_id for (message_id,) in conn.execute(
+            select([messages.c.id]).where(messages.c.user_id == user_id)
+            .limit(size))]
+
+    if not message_ids:
+        return 0
+
+    # The likes first: if this stops halfway, they're still findable
+    def unlike_all(engine, _):
+        with engine.begin() as conn:
+            return conn.execute(likes.delete().where(
+                likes.c.message_id.in_(message_ids))).rowcount
+
+    deleted = sum(shards.each(unlike_all,
+                              {name: None for name in shards.map.names}))
+
+    with engine.begin() as conn:
+        for table in (message_tags, mentions):
+            conn.execute(table.delete().where(
+                table.c.message_id.in_(message_ids)))
+        deleted += conn.execute(messages.delete().where(
+            messages.c.id.in_(message_ids))).rowcount
+
+    return deleted
+
+
+##############################################################################
+# Moving rows: migrating from main, rebalancing and repairing counts
+
+def _bucket_filter(column, buckets):
+    return (column % BUCKETS).in_(list(buckets)) if buckets else true()
+
+
+def _insert_missing(conn, table, rows, key):
+    """Insert those of `rows` (dicts) whose `key` columns aren't in
+    `table` yet."""
+
+    if not rows:
+        return 0
+
+    columns = [table.c[name] for name in key]
+    keys = [tuple(row[name] for name in key) for row in rows]
+
+    if len(columns) == 1:
+        present = columns[0].in_([value for (value,) in keys])
+    else:
+        present = tuple_(*columns).in_(keys)
+
+    existing = {tuple(row) for row in conn.execute(
+        select(columns).where(present))}
+    missing = [row for row in rows
+               if tuple(row[name] for name in key) not in existing]
+
+    if missing:
+        conn.execute(table.insert(), missing)
+
+    return len(missing)
+
+
+def copy_rows(source, route, buckets=None, batch_size=1000):
+    """Copy messages (with tags and mentions) and likes from `source` to
+    the shard `route(user_id)` names, skipping rows already there.
+
+    With `buckets`, only rows of users in those buckets are copied.
+    Returns the number of messages and of likes copied.
+    """
+
+    shards = get_shards()
+    copied = [0, 0]
+
+    def batches(table, order):
+        last = 0
+        with source.connect() as conn:
+            while True:
+                rows = [dict(row) for row in conn.execute(
+                    select([table])
+                    .where(_bucket_filter(table.c.user_id, buckets))
+                    .where(order > last).order_by(order).limit(batch_size))]
+                if not rows:
+                    return
+                yield rows
+                last = rows[-1][order.name]
+
+    for rows in batches(messages, messages.c.id):
+        with source.connect() as conn:
+            children = {table: [dict(row) for row in conn.execute(
+                select([table]).where(table.c.message_id.in_(
+                    [row['id'] for row in rows])))]
+                for table in (message_tags, mentions)}
+
+        for name, group in _by_shard(rows, route).items():
+            ids = {row['id'] for row in group}
+
+            with shards.engine(name).begin() as conn:
+                copied[0] += _insert_missing(conn, messages, group, ['id'])
+                for table, key in ((message_tags, ['tag', 'message_id']),
+                                   (mentions, ['user_id', 'message_id'])):
+                    _insert_missing(conn, table,
+                                    [row for row in children[table]
+                                     if row['message_id'] in ids], key)
+
+    for rows in batches(likes, likes.c.id):
+        for name, group in _by_shard(rows, route).items():
+            # Like ids are local to a shard; the target picks new ones
+            with shards.engine(name).begin() as conn:
+                copied[1] += _insert_missing(
+                    conn, likes,
+                    [{'user_id': row['user_id'],
+                      'message_id': row['message_id']} for row in group],
+                    ['user_id', 'message_id'])
+
+    return tuple(copied)
+
+
+def _by_shard(rows, route):
+    groups = {}
+    for row in rows:
+        groups.setdefault(route(row['user_id']), []).append(row)
+    return groups
+
+
+def delete_buckets(engine, buckets):
+    """Delete the rows of users in `buckets` from one shard."""
+
+    moved = select([messages.c.id]).where(
+        _bucket_filter(messages.c.user_id, buckets))
+
+    with engine.begin() as conn:
+        for table in (message_tags, mentions):
+            conn.execute(table.delete().where(table.c.message_id.in_(moved)))
+        conn.execute(messages.delete().where(
+            _bucket_filter(messages.c.user_id, buckets)))
+        conn.execute(likes.delete().where(
+            _bucket_filter(likes.c.user_id, buckets)))
+
+
+def rebalance(names, pause=2, batch_size=1000):
+    """Spread the buckets over shards `names`, moving their rows.
+
+    The moving buckets are marked read-only in the map first, and after
+    `pause` seconds (for workers to re-read the map and finish writes
+    already under way) their rows are copied. Then the new map is saved,
+    and once workers have switched to it the rows are deleted from the
+    old shards. Returns the moves made, as ShardMap.moves() does.
+    """
+
+    shards = get_shards()
+    old = shards.map
+    new = old.rebalance(names)
+    moves = old.moves(new)
+
+    for name in names:
+        create_tables(shards.engine(name))
+
+    def switch(shard_map):
+        shard_map.save(shards.map_path)
+        shards.reload_map()
+        time.sleep(pause)
+
+    switch(old.freeze(bucket for buckets in moves.values()
+                      for bucket in buckets))
+
+    try:
+        for (source, target), buckets in moves.items():
+            # Rows left behind by a move that didn't finish may be stale
+            delete_buckets(shards.engine(target), buckets)
+            copy_rows(shards.engine(source), lambda user_id: target,
+                      buckets, batch_size)
+    except BaseException:
+        # Nothing's moved yet: writable again, where they were
+        switch(old.freeze(()))
+        raise
+
+    switch(new)
+
+    for (source, _), buckets in moves.items():
+        delete_buckets(shards.engine(source), buckets)
+
+    # Likes made mid-move may have counted on the old copy of a message
+    reconcile_likes(batch_size)
+    return moves
+
+
+def reconcile_likes(batch_size=1000):
+    """Recount every message's likes across all shards and fix the
+    counts that are off. Returns how many were."""
+
+    shards = get_shards()
+    names = shards.map.names
+    fixed = 0
+
+    def count(engine, message_ids):
+        with engine.connect() as conn:
+            return dict(conn.execute(
+                select([likes.c.message_id, func.count()])
+                .where(likes.c.message_id.in_(message_ids))
+                .group_by(likes.c.message_id)).fetchall())
+
+    for name in names:
+        engine = shards.engine(name)
+        last = 0
+
+        while True:
+            with engine.connect() as conn:
+                rows = conn.execute(
+                    select([messages.c.id, messages.c.like_count])
+                    .where(messages.c.id > last)
+                    .order_by(messages.c.id).limit(batch_size)).fetchall()
+
+            if not rows:
+                break
+
+            message_ids = [message_id for message_id, _ in rows]
+            actual = {}
+            for counts in shards.each(count, {shard: message_ids
+                                              for shard in names}):
+                for message_id, n in counts.items():
+                    actual[message_id] = actual.get(message_id, 0) + n
+
+            wrong = [(message_id, actual.get(message_id, 0))
+                     for message_id, like_count in rows
+                     if like_count != actual.get(message_id, 0)]
+
+            if wrong:
+                with engine.begin() as conn:
+                    for message_id, like_count in wrong:
+                        conn.execute(messages.update()
+                                     .where(messages.c.id == message_id)
+                                     .values(like_count=like_count))
+                fixed += len(wrong)
+
+            last = message_ids[-1]
+
+    return fixed
+
+
+@shards_cli.command('init')
+@click.argument('names', nargs=-1, required=True)
+def init_command(names):
+    """Create the shards' tables and a shard map spreading users over NAMES.
+
+    Message ids on the shards start above the main database's.
+    """
+
+    shards = get_shards()
+
+    if shards is None:
+        raise click.ClickException("Set SHARD_URLS first")
+    if os.path.exists(shards.map_path):
+        raise click.ClickException(f"{shards.map_path} already exists")
+
+    for name in names:
+        create_tables(shards.engine(name))
+
+    last_id = db.session.execute(
+        db.select([func.max(messages.c.id)])).scalar()
+    ShardMap.spread(list(names), first_id=(last_id or 0) + 1).save(
+        shards.map_path)
+
+    click.echo(f"Spread {BUCKETS} buckets over {', '.join(names)}")
+
+
+@shards_cli.command('migrate')
+@click.option('--batch-size', default=1000, show_default=True)
+def migrate_command(batch_size):
+    """Copy messages and likes from the main database onto the shards.
+
+    Rows already on a shard are skipped, so it can be run again.
+    """
+
+    shards = get_shards()
+    copied = copy_rows(db.engine, shards.map.shard_for,
+                       batch_size=batch_size)
+    click.echo("Copied {} messages and {} likes".format(*copied))
+
+
+@shards_cli.command('rebalance')
+@click.argument('names', nargs=-1, required=True)
+@click.option('--pause', default=2.0, show_default=True,
+              help='Seconds for workers to pick up the new map.')
+@click.option('--batch-size', default=1000, show_default=True)
+def rebalance_command(names, pause, batch_size):
+    """Move buckets so they're spread evenly over NAMES."""
+
+    moves = rebalance(list(names), pause, batch_size)
+
+    for (source, target), buckets in sorted(moves.items()):
+        click.echo(f"{source} -> {target}: {len(buckets)} buckets")
+
+
+@shards_cli.command('status')
+def status_command():
+    """Buckets, messages and likes per shard."""
+
+    shards = get_shards()
+    shard_map = shards.map
+
+    for name in shard_map.names:
+        with shards.engine(name).connect() as conn:
+            counts = [conn.execute(select([func.count()]).select_from(table))
+                      .scalar() for table in (messages, likes)]
+        click.echo(f"{name}: {shard_map.buckets.count(name)} buckets, "
+                   f"{counts[0]} messages, {counts[1]} likes")
+
+
+@shards_cli.command('reconcile-likes')
+@click.option('--batch-size', default=1000, show_default=True)
+def reconcile_likes_command(batch_size):
+    """Recount likes across shards and fix messages whose count is off."""
+
+    click.echo(f"Fixed {reconcile_likes(batch_size)} like counts")
+
+
+def parse_urls(value):
+    """{name: url} from "name=url,name=url"."""
+
+    return dict(item.split('=', 1) for item in value.split(',') if item)
+
+
+def init_app(app):
+    """Shard `app`'s messages and likes when SHARD_URLS is set."""
+
+    app.config.setdefault('SHARD_URLS',
+                          parse_urls(os.environ.get('SHARD_URLS', '')))
+    app.config.setdefault('SHARD_MAP_PATH', os.environ.get(
+        'SHARD_MAP_PATH', os.path.join(app.instance_path, 'shard-map.json')))
+
+    if app.config['SHARD_URLS']:
+        app.extensions['shards'] = Shards(app.config['SHARD_URLS'],
+                                          app.config['SHARD_MAP_PATH'])
+
+    app.cli.add_command(shards_cli)
@@ -0,0 +1,43 @@
+// Prepend new messages from followed users to the homepage timeline as
+// /stream announces them (see live.py).
+
+(function () {
+  var timeline = document.getElementById('messages');
+
+  if (!timeline || !window.EventSource) {
+    return;
+  }
+
+  function element(tag, attrs, children) {
+    var el = document.createElement(tag);
+
+    Object.keys(attrs).forEach(function (name) {
+      el.setAttribute(name, attrs[name]);
+    });
+    (children || []).forEach(function (child) {
+      el.appendChild(typeof child === 'string'
+        ? document.createTextNode(child) : child);
+    });
+
+    return el;
+  }
+
+  new EventSource('/stream').onmessage = function (event) {
+    var msg = JSON.parse(event.data);
+    var profile = '/users/' + msg.user_id;
+
+    timeline.insertBefore(element('li', {'class': 'list-group-item'}, [
+      element('a', {'href': '/messages/' + msg.id, 'class': 'message-link'}),
+      element('a', {'href': profile}, [
+        element('img', {'src': msg.image_url, 'alt': '',
+                        'class': 'timeline-image'})
+      ]),
+      element('div', {'class': 'message-area'}, [
+        element('a', {'href': profile}, ['@' + msg.username]),
+        ' ',
+        element('span', {'class': 'text-muted'}, [msg.timestamp]),
+        element('p', {}, [msg.text])
+      ])
+    ]), timeline.firstChild);
+  };
+})();
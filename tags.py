@@ -0,0 +1,250 @@
+"""#tags and @mentions, indexed for lookup.
+
+`index_message()` parses a new message and records its tags in
+message_tags and the users it mentions in mentions; both tables are keyed
+for the lookups below, so they're index range reads however many
+messages there are:
+
+    /tags/<tag>                  messages using #tag
+    /users/<user_id>/mentions    messages mentioning @user
+
+Both pages are newest first and paginated by keyset (?before=<message
+id>) rather than OFFSET, so deep pages cost the same as the first.
+
+Messages written before this existed, or in bulk by `Message.post_many`,
+are indexed with
+
+    FLASK_APP=app.py flask tags backfill --workers 4
+"""
+
+import re
+from multiprocessing import Pool
+
+import click
+from flask import Blueprint, current_app, render_template, request
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+
+from models import db, Mention, Message, MessageTag, User
+
+TAG_PATTERN = re.compile(r'(?<![\w#&])#(\w{1,64})')
+MENTION_PATTERN = re.compile(r'(?<![\w@])@(\w{1,64})')
+
+tags = Blueprint('tags', __name__)
+tags_cli = AppGroup('tags', help='Index #tags and @mentions.')
+
+
+def parse_tags(text):
+    """The distinct #tags in `text`, lowercased."""
+
+    return {tag.lower() for tag in TAG_PATTERN.findall(text)}
+
+
+def parse_mentions(text):
+    """The distinct @usernames in `text`."""
+
+    return set(MENTION_PATTERN.findall(text))
+
+
+def index_message(message):
+    """Add the tag and mention rows for a new `message` to the session."""
+
+    db.session.flush()
+
+    for tag in parse_tags(message.text):
+        db.session.add(MessageTag(tag=tag, message_id=message.id))
+
+    for user_id in mentioned_user_ids(message.text):
+        db.session.add(Mention(user_id=user_id, message_id=message.id))
+
+
+def mentioned_user_ids(text):
+    """Ids of the users @mentioned in `text`."""
+
+    usernames = parse_mentions(text)
+
+    if not usernames:
+        return []
+
+    return [user_id for (user_id,) in
+            db.session.query(User.id).filter(User.username.in_(usernames))]
+
+
+def linkify_tags(text):
+    """`text`, escaped, with its #tags linked to their pages."""
+
+    return Markup(TAG_PATTERN.sub(
+        lambda match: (f'<a href="/tags/{match.group(1).lower()}">'
+                       f'#{match.group(1)}</a>'),
+        str(escape(text))))
+
+
+def page(query, key, before):
+    """One page of `query` ordered by `key` descending, below `before`.
+
+    Returns (messages, `before` for the next page or None).
+    """
+
+    size = current_app.config['TAGS_PAGE_SIZE']
+
+    if before:
+        query = query.filter(key < before)
+
+    messages = query.order_by(key.desc()).limit(size + 1).all()
+
+    if len(messages) > size:
+        return messages[:size], messages[size - 1].id
+
+    return messages, None
+
+
+def visible(query):
+    """Messages in `query` whose authors haven't been deleted."""
+
+    return (query.join(User, Message.user_id == User.id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def sharded_page(table, column, value):
+    """`page()` of the messages on the shards whose `table` row has
+    `column` == `value`."""
+
+    # Imported here: shards.py imports this module
+    import shards
+
+    return shards.tagged(getattr(shards, table), column, value,
+                         request.args.get('before', type=int),
+                         current_app.config['TAGS_PAGE_SIZE'])
+
+
+@tags.route('/tags/<tag>')
+def show_tag(tag):
+    """Messages using #tag, newest first."""
+
+    tag = tag.lower()
+
+    if 'shards' in current_app.extensions:
+        messages, before = sharded_page('message_tags', 'tag', tag)
+    else:
+        query = visible(Message.query
+                        .join(MessageTag, MessageTag.message_id == Message.id)
+                        .filter(MessageTag.tag == tag))
+
+        messages, before = page(query, MessageTag.message_id,
+                                request.args.get('before', type=int))
+
+    return render_template('messages/list.html', title=f"#{tag}",
+                           messages=messages, before=before)
+
+
+@tags.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Messages mentioning a user, newest first."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+
+    if 'shards' in current_app.extensions:
+        messages, before = sharded_page('mentions', 'user_id', user_id)
+    else:
+        query = visible(Message.query
+                        .join(Mention, Mention.message_id == Message.id)
+                        .filter(Mention.user_id == user_id))
+
+        messages, before = page(query, Mention.message_id,
+                                request.args.get('before', type=int))
+
+    return render_template('messages/list.html',
+                           title=f"Mentions of @{user.username}",
+                           messages=messages, before=before)
+
+
+def backfill_chunk(conn, first_id, last_id):
+    """(Re)index messages with ids in [first_id, last_id] on `conn`.
+
+    Returns the number of messages read.
+    """
+
+    rows = conn.execute(
+        db.select([Message.id, Message.text])
+        .where(Message.id.between(first_id, last_id))).fetchall()
+
+    conn.execute(MessageTag.__table__.delete()
+                 .where(MessageTag.message_id.between(first_id, last_id)))
+    conn.execute(Mention.__table__.delete()
+                 .where(Mention.message_id.between(first_id, last_id)))
+
+    tag_rows = [{'tag': tag, 'message_id': message_id}
+                for message_id, text in rows for tag in parse_tags(text)]
+    mentions = [(message_id, username)
+                for message_id, text in rows
+                for username in parse_mentions(text)]
+
+    user_ids = {}
+    if mentions:
+        user_ids = {username: user_id for username, user_id in conn.execute(
+            db.select([User.username, User.id])
+            .where(User.username.in_({name for _, name in mentions})))}
+
+    mention_rows = [{'user_id': user_ids[username], 'message_id': message_id}
+                    for message_id, username in mentions
+                    if username in user_ids]
+
+    if tag_rows:
+        conn.execute(MessageTag.__table__.insert(), tag_rows)
+    if mention_rows:
+        conn.execute(Mention.__table__.insert(), mention_rows)
+
+    return len(rows)
+
+
+def _backfill_worker(bounds):
+    with db.engine.begin() as conn:
+        return backfill_chunk(conn, *bounds)
+
+
+def _init_worker(app):
+    # Each process needs its own connections, and an app context to
+    # find the engine through
+    app.app_context().push()
+    db.engine.dispose()
+
+
+@tags_cli.command('backfill')
+@click.option('--workers', default=4, show_default=True,
+              help='Processes indexing chunks in parallel.')
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='Messages (by id range) per chunk and transaction.')
+def backfill_command(workers, chunk_size):
+    """Index the tags and mentions of existing messages."""
+
+    low, high = db.session.query(db.func.min(Message.id),
+                                 db.func.max(Message.id)).one()
+    db.session.remove()
+
+    if low is None:
+        click.echo("No messages to index")
+        return
+
+    chunks = [(first, min(first + chunk_size - 1, high))
+              for first in range(low, high + 1, chunk_size)]
+
+    app = current_app._get_current_object()
+    db.engine.dispose()
+
+    with Pool(workers, initializer=_init_worker, initargs=(app,)) as pool:
+        done = 0
+        for count in pool.imap_unordered(_backfill_worker, chunks):
+            done += count
+            click.echo(f"Indexed {done} messages", err=True)
+
+    click.echo(f"Indexed {done} messages in {len(chunks)} chunks")
+
+
+def init_app(app):
+    """Serve tag and mention pages from `app`."""
+
+    app.config.setdefault('TAGS_PAGE_SIZE', 50)
+
+    app.register_blueprint(tags)
+    app.cli.add_command(tags_cli)
+    app.add_template_filter(linkify_tags)
@@ -0,0 +1,93 @@
+"""Compiled templates, on disk and in memory before the first request.
+
+Jinja compiles each template to Python the first time it's rendered, and
+does it again in every worker. Two things take that off the request path:
+
+- A bytecode cache in TEMPLATE_CACHE_DIR, shared by every worker on the
+  node. Fill it as part of the build, next to `flask assets build`:
+
+      FLASK_APP=app.py flask templates compile
+
+  Entries are keyed on the templates' absolute paths and checked against
+  their source, so a cache built elsewhere (or for other templates) is
+  simply not used.
+
+- `warm_up()`, which wsgi.py calls before gunicorn forks its workers:
+  every template is loaded into the environment's in-memory cache once,
+  from bytecode when it's there, and every worker inherits the result.
+"""
+
+import os
+import tempfile
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+
+templates_cli = AppGroup('templates', help='Compile templates.')
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache whose files never appear half-written.
+
+    Workers starting together would otherwise read each other's partial
+    writes and fail to unmarshal them.
+    """
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        fd, partial = tempfile.mkstemp(dir=self.directory,
+                                       prefix='.partial-')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(partial, filename)
+        except OSError:
+            # A cache we can't write to only costs compile time
+            if os.path.exists(partial):
+                os.remove(partial)
+
+
+def template_names(env):
+    """Every HTML template in the Jinja environment `env`."""
+
+    return [name for name in env.list_templates() if name.endswith('.html')]
+
+
+def warm_up(env):
+    """Load every template into `env`'s cache; return their names."""
+
+    names = template_names(env)
+
+    for name in names:
+        env.get_template(name)
+
+    return names
+
+
+@templates_cli.command('compile')
+def compile_command():
+    """Compile every template into the bytecode cache."""
+
+    names = warm_up(current_app.jinja_env)
+    click.echo(f"Compiled {len(names)} templates into "
+               f"{current_app.config['TEMPLATE_CACHE_DIR']}")
+
+
+def init_app(app):
+    """Cache `app`'s compiled templates on disk."""
+
+    app.config.setdefault('TEMPLATE_CACHE_DIR', os.environ.get(
+        'TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja-cache')))
+
+    directory = app.config['TEMPLATE_CACHE_DIR']
+    os.makedirs(directory, exist_ok=True)
+
+    # Must be set before anything touches app.jinja_env, which is built
+    # from jinja_options on first use
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=AtomicBytecodeCache(directory))
+
+    app.cli.add_command(templates_cli)
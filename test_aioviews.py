@@ -0,0 +1,245 @@
+"""Async read route tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_aioviews.py
+#
+# These need Postgres (TEST_DATABASE_URL), asyncpg and asgiref. The async
+# routes read committed rows only, so they're compared with the sync views
+# on the seed data.
+
+
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from benchmarks.replay import load_trace
+from capture import CaptureLog
+from models import db, Follows, Message
+from sessions import create_session
+import sessions
+
+try:
+    import asgiref  # noqa: F401
+    import asyncpg  # noqa: F401
+except ImportError:
+    asyncpg = None
+
+import aioreads
+
+
+@unittest.skipUnless(asyncpg and db.engine.dialect.name == 'postgresql',
+                     "needs asyncpg, asgiref and Postgres")
+class AsyncReadsTestCase(DatabaseTestCase):
+    """Test that the async routes serve the pages the sync views do."""
+
+    def setUp(self):
+        """Open a pool, and pick a seed user who follows and is followed."""
+
+        super().setUp()
+
+        from aioviews import AsyncReads
+
+        self.asgi = AsyncReads(app)
+        self.fallbacks = []
+        self.asgi.wsgi = self.fallback
+
+        self.loop = asyncio.new_event_loop()
+        self.asgi.pool = self.loop.run_until_complete(
+            aioreads.create_pool(app))
+
+        follow, self.message_id = (
+            db.session.query(Follows, Message.id)
+            .join(Message,
+                  Message.user_id == Follows.user_being_followed_id)
+            .first())
+        self.user_id = follow.user_following_id
+        self.followed_id = follow.user_being_followed_id
+
+        with app.app_context():
+            self.sid = create_session({CURR_USER_KEY: self.user_id})
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi.pool.close())
+        self.loop.close()
+        super().tearDown()
+
+    async def fallback(self, scope, receive, send):
+        """Stands in for the WSGI app: records what was handed to it."""
+
+        self.fallbacks.append((scope['method'], scope['path']))
+        await send({'type': 'http.response.start', 'status': 599,
+                    'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def get(self, path, logged_in=False):
+        """(status, body) of GET `path` from the ASGI app."""
+
+        path, _, query = path.partition('?')
+        headers = [(b'host', b'localhost')]
+
+        if logged_in:
+            headers.append((b'cookie', f"{app.session_cookie_name}="
+                                       f"{self.sid}".encode()))
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'},
+                 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                 'path': path, 'raw_path': path.encode(),
+                 'query_string': query.encode(), 'root_path': '',
+                 'headers': headers, 'client': ('127.0.0.1', 50000),
+                 'server': ('localhost', 80)}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.asgi(scope, receive, send))
+
+        return (sent[0]['status'],
+                b''.join(m.get('body', b'') for m in sent[1:]).decode())
+
+    def sync_get(self, path, logged_in=False):
+        if logged_in:
+            self.client.set_cookie('localhost', app.session_cookie_name,
+                                   self.sid)
+        return self.client.get(path).get_data(as_text=True)
+
+    def test_pages_match(self):
+        """Do the async routes render exactly what the sync views do?"""
+
+        paths = ['/', '/users', '/users?q=a', f'/users/{self.followed_id}',
+                 f'/users/{self.user_id}/following',
+                 f'/users/{self.followed_id}/followers',
+                 f'/messages/{self.message_id}']
+
+        for logged_in in (False, True):
+            for path in paths:
+                if path.endswith(('following', 'followers')) and not logged_in:
+                    continue
+
+                with self.subTest(path=path, logged_in=logged_in):
+                    status, body = self.get(path, logged_in)
+
+                    self.assertEqual(status, 200)
+                    self.assertEqual(body, self.sync_get(path, logged_in))
+
+        self.assertEqual(self.fallbacks, [])
+
+    def test_follow_pages_match(self):
+        """Are the follow pages paged the same way?"""
+
+        app.config['FOLLOW_PAGE_SIZE'] = 2
+        self.addCleanup(app.config.update, FOLLOW_PAGE_SIZE=48)
+
+        for name in ('following', 'followers'):
+            for page in (1, 2, 1000):
+                path = f'/users/{self.followed_id}/{name}?page={page}'
+
+                with self.subTest(path=path):
+                    status, body = self.get(path, logged_in=True)
+
+                    self.assertEqual(status, 200)
+                    self.assertEqual(body, self.sync_get(path, True))
+
+        self.assertEqual(self.fallbacks, [])
+
+    def test_fallbacks(self):
+        """Are 404s, redirects and other routes left to the WSGI app?"""
+
+        self.get('/users/999999')
+        self.get('/messages/999999')
+        self.get(f'/users/{self.user_id}/followers')
+        self.get('/login')
+
+        self.assertEqual(self.fallbacks, [
+            ('GET', '/users/999999'), ('GET', '/messages/999999'),
+            ('GET', f'/users/{self.user_id}/followers'), ('GET', '/login')])
+
+    def test_hooks(self):
+        """Do the async routes start the sweeper and get captured?"""
+
+        started = []
+        start_sweeper = sessions.start_sweeper
+        sessions.start_sweeper = started.append
+        app.extensions['session_sweeper']['pid'] = None
+        app.config['SESSION_SWEEP_INTERVAL'] = 60
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.jsonl')
+            log = app.extensions['capture_log'] = CaptureLog(path)
+
+            try:
+                self.get(f'/users/{self.followed_id}', logged_in=True)
+                log.flush()
+            finally:
+                sessions.start_sweeper = start_sweeper
+                app.config['SESSION_SWEEP_INTERVAL'] = 0
+                del app.extensions['capture_log']
+
+            trace = load_trace(path)
+
+        self.assertEqual(self.fallbacks, [])
+        self.assertEqual(started, [app])
+        self.assertEqual([(line['endpoint'], line['status'])
+                          for line in trace],
+                         [('warbler.users_show', 200)])
+        self.assertIsNotNone(trace[0]['user'])
+
+    def test_session_saved_off_loop(self):
+        """Is the session saved in the thread pool, not on the loop?"""
+
+        interface = app.session_interface
+        save_session = interface.save_session
+        threads = []
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return save_session(*args)
+
+        interface.save_session = record
+        try:
+            self.get(f'/users/{self.followed_id}', logged_in=True)
+        finally:
+            del interface.save_session
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_sync_only(self):
+        """Are reads left to the WSGI app while they're being measured,
+        or with messages on shards?"""
+
+        for setting in ('PROFILER_ENABLED', 'MEMORY_PROFILE_ENABLED'):
+            app.config[setting] = True
+            try:
+                self.get('/users')
+            finally:
+                app.config[setting] = False
+
+        app.extensions['shards'] = None
+        try:
+            self.get('/users')
+        finally:
+            del app.extensions['shards']
+
+        self.assertEqual(self.fallbacks, [('GET', '/users')] * 3)
+
+
+class DsnTestCase(unittest.TestCase):
+    """Test picking the asyncpg DSN from the SQLAlchemy URI."""
+
+    def test_dsn(self):
+        self.assertEqual(aioreads.dsn('postgres:///warbler'),
+                         'postgresql:///warbler')
+        self.assertEqual(aioreads.dsn('postgresql+psycopg2://u@h/warbler'),
+                         'postgresql://u@h/warbler')
+        self.assertIsNone(aioreads.dsn('sqlite:////tmp/warbler.db'))
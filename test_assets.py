@@ -0,0 +1,155 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app
+from assets import build, minify_css, static_url
+
+
+class AssetBuildTestCase(DatabaseTestCase):
+    """Test building and serving fingerprinted assets."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Build the real static folder into a scratch directory, once."""
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.dist = os.path.join(cls.tmp.name, 'dist')
+        cls.manifest = build(app.static_folder, cls.dist)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove the build."""
+
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        """Serve assets from the scratch build."""
+
+        super().setUp()
+
+        self._config = dict(app.config)
+        app.config['ASSETS_DIST_DIR'] = self.dist
+        app.extensions.pop('assets_manifest', None)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Restore the app's config."""
+
+        app.config.clear()
+        app.config.update(self._config)
+        app.extensions.pop('assets_manifest', None)
+
+        super().tearDown()
+
+    def test_fingerprinted(self):
+        """Are built files named after their contents?"""
+
+        built = self.manifest['stylesheets/style.css']
+
+        self.assertRegex(built, r'^stylesheets/style\.[0-9a-f]{10}\.css$')
+        self.assertTrue(os.path.isfile(os.path.join(self.dist, built)))
+
+    def test_css_urls_rewritten(self):
+        """Does the stylesheet point at fingerprinted images?"""
+
+        with open(os.path.join(self.dist,
+                               self.manifest['stylesheets/style.css'])) as css:
+            css = css.read()
+
+        self.assertNotIn('/static/', css)
+        self.assertIn(f"/assets/{self.manifest['images/nav-bg.png']}", css)
+
+    def test_static_url(self):
+        """Do templates link the built assets?"""
+
+        with app.test_request_context():
+            self.assertEqual(static_url('stylesheets/style.css'),
+                             f"/assets/{self.manifest['stylesheets/style.css']}")
+
+        resp = self.client.get('/')
+        self.assertIn(f"/assets/{self.manifest['stylesheets/style.css']}",
+                      resp.get_data(as_text=True))
+
+    def test_serve_gzip(self):
+        """Is the precompressed variant served, cached for a year?"""
+
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b'{', gzip.decompress(resp.data))
+
+    def test_serve_identity(self):
+        """Do clients without compression get the plain file?"""
+
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+        resp = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'{', resp.data)
+
+    def test_serve_webp(self):
+        """Do browsers that accept WebP get it for large photos?"""
+
+        url = f"/assets/{self.manifest['images/signed-out-home.jpg']}"
+        resp = self.client.get(url, headers={'Accept': 'image/webp,*/*'})
+
+        self.assertEqual(resp.mimetype, 'image/webp')
+
+    def test_not_modified(self):
+        """Are revalidations answered without a body?"""
+
+        url = f"/assets/{self.manifest['images/warbler-logo.png']}"
+        etag = self.client.get(url).headers['ETag']
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 304)
+
+    def test_outside_dist(self):
+        """Are paths outside the build directory refused?"""
+
+        resp = self.client.get('/assets/../app.py')
+        self.assertEqual(resp.status_code, 404)
+
+
+class AssetFallbackTestCase(TestCase):
+    """Test linking assets before they've been built."""
+
+    def test_unbuilt(self):
+        """Without a manifest, are plain /static/ URLs used?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config = app.config['ASSETS_DIST_DIR']
+            app.config['ASSETS_DIST_DIR'] = tmp
+            app.extensions.pop('assets_manifest', None)
+
+            try:
+                with app.test_request_context():
+                    self.assertEqual(static_url('favicon.ico'),
+                                     '/static/favicon.ico')
+            finally:
+                app.config['ASSETS_DIST_DIR'] = config
+                app.extensions.pop('assets_manifest', None)
+
+    def test_minify_css(self):
+        """Are comments and whitespace stripped?"""
+
+        css = "/* nav */\n.nav > a ,\n.nav b {\n  color: red;\n  margin: 0 auto;\n}\n"
+
+        self.assertEqual(minify_css(css), ".nav>a,.nav b{color: red;margin: 0 auto}")
@@ -0,0 +1,162 @@
+"""Request capture and replay tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_capture.py
+
+
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app
+from benchmarks.replay import World, execute, load_trace, replay, summarize
+from capture import CaptureLog, pseudonym
+from models import db, Message, User
+
+
+class CaptureTestCase(DatabaseTestCase):
+    """Test capturing requests, and replaying what was captured."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup(username="captured", email="cap@test.com",
+                                password="password", image_url=None)
+        db.session.commit()
+        message = Message.post(self.user.id, "secret words")
+        db.session.commit()
+        self.user_id, self.message_id = self.user.id, message.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'trace.jsonl')
+        self.log = app.extensions['capture_log'] = CaptureLog(self.path)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.extensions.pop('capture_log', None)
+        self.directory.cleanup()
+        super().tearDown()
+
+    def capture(self):
+        """Drive a little traffic; return the trace."""
+
+        self.client.post('/login', data={'username': "captured",
+                                         'password': "password"})
+        self.client.get(f'/users/{self.user_id}')
+        self.client.get('/users?q=capt')
+        self.client.post('/messages/new', data={'text': "more secrets"})
+        self.client.post(f'/messages/{self.message_id}/like')
+        self.client.get('/static/stylesheets/style.css')
+        self.log.flush()
+
+        return load_trace(self.path)
+
+    def test_capture(self):
+        """Are requests recorded, with nothing identifying in them?"""
+
+        trace = self.capture()
+
+        with open(self.path) as f:
+            raw = f.read()
+        for secret in ('captured', '"capt"', 'secret words', 'more secrets',
+                       ':"password"', f'/{self.user_id}'):
+            self.assertNotIn(secret, raw)
+
+        with app.app_context():
+            user = pseudonym('u', self.user_id)
+            message = pseudonym('m', self.message_id)
+
+        self.assertEqual([(r['method'], r['rule']) for r in trace], [
+            ('POST', '/login'),
+            ('GET', '/users/<int:user_id>'),
+            ('GET', '/users'),
+            ('POST', '/messages/new'),
+            ('POST', '/messages/<int:message_id>/like')])
+        self.assertEqual([r['user'] for r in trace], [user] * 5)
+        self.assertEqual(trace[0]['form'], {'username': 's:8',
+                                            'password': 'secret'})
+        self.assertEqual(trace[1]['args'], {'user_id': user})
+        self.assertEqual(trace[2]['query'], {'q': 's:4'})
+        self.assertEqual(trace[3]['form'], {'text': 's:12'})
+        self.assertEqual(trace[4]['args'], {'message_id': message})
+        self.assertEqual([r['status'] for r in trace],
+                         [302, 200, 200, 302, 302])
+
+    def test_execute(self):
+        """Are the captured requests sent again, as the mapped user?"""
+
+        trace = self.capture()
+        del app.extensions['capture_log']
+
+        replayed = []
+        client = app.test_client(use_cookies=False)
+
+        def send(method, path, body, headers):
+            replayed.append((method, path.split('?')[0],
+                             headers.get('Cookie')))
+            resp = client.open(path, method=method, data=body,
+                               headers=headers)
+            return resp.status_code, resp.headers, resp.data
+
+        world = World([(self.user_id, "captured")], [self.message_id],
+                      mint_cookie=lambda user_id: f"minted-{user_id}")
+        statuses = [execute(send, world, record) for record in trace]
+
+        cookie = f"minted-{self.user_id}"
+        self.assertEqual(replayed, [
+            ('POST', '/login', None),
+            ('GET', f'/users/{self.user_id}', cookie),
+            ('GET', '/users', cookie),
+            ('POST', '/messages/new', cookie),
+            ('POST', f'/messages/{self.message_id}/like', cookie)])
+
+        # The login logs in for real
+        self.assertEqual(statuses[:3], [302, 200, 200])
+
+    def test_replay(self):
+        """Are requests replayed on schedule, and summarized by route?"""
+
+        trace = [{'ts': 100 + n, 'method': 'GET', 'endpoint': endpoint,
+                  'rule': '/users/<int:user_id>', 'args': {'user_id': 'u:0'},
+                  'query': {}, 'form': {}, 'user': None, 'status': 200,
+                  'ms': 5.0}
+                 for n, endpoint in enumerate(['warbler.users_show'] * 3
+                                              + ['live.stream'])]
+        sent = []
+
+        def send(method, path, body, headers):
+            sent.append(time.perf_counter())
+            return 200 if len(sent) < 3 else 500, {}, b''
+
+        results = replay(trace, send, World([(7, "seven")], [], None),
+                         speed=20, concurrency=2)
+
+        self.assertEqual(len(sent), 3)
+        self.assertGreaterEqual(sent[2] - sent[0], 0.09)
+
+        row, = [row for row in summarize(results) if row['route'] == 'all']
+        self.assertEqual((row['count'], row['errors'], row['mismatch']),
+                         (3, 1, 1))
+
+
+class CaptureLogTestCase(TestCase):
+    def test_buffered(self):
+        """Are lines held until the buffer fills?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.jsonl')
+            log = CaptureLog(path, buffer_size=3, flush_interval=60)
+
+            log.write({'n': 1})
+            log.write({'n': 2})
+            self.assertFalse(os.path.exists(path))
+
+            log.write({'n': 3})
+            with open(path) as f:
+                self.assertEqual([json.loads(line)['n'] for line in f],
+                                 [1, 2, 3])
@@ -0,0 +1,157 @@
+"""User data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from models import db, Follows, Message, User
+from export import FIELDS, chunked
+
+
+class ExportViewTestCase(DatabaseTestCase):
+    """Test downloading your own data."""
+
+    def setUp(self):
+        """A user with messages, a like, and follows both ways."""
+
+        super().setUp()
+
+        self.user = User.signup(username="exporter", email="ex@test.com",
+                                password="password", image_url=None)
+        self.other = User.signup(username="other", email="other@test.com",
+                                 password="password", image_url=None)
+        db.session.commit()
+
+        Message.post(self.user.id, "first, with a comma")
+        liked = Message.post(self.other.id, "likeable")
+        db.session.commit()
+
+        self.user.likes.append(liked)
+        self.user.following.append(self.other)
+        self.other.following.append(self.user)
+        db.session.commit()
+
+        self.user_id, self.other_id = self.user.id, self.other.id
+        self.liked_id = liked.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_ndjson(self):
+        resp = self.client.get(f'/users/{self.user_id}/export')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+
+        records = [json.loads(line)
+                   for line in resp.get_data(as_text=True).splitlines()]
+
+        self.assertEqual([r['type'] for r in records],
+                         ['message', 'like', 'following', 'follower'])
+        self.assertEqual(records[0]['text'], "first, with a comma")
+        self.assertEqual(records[1], {'type': 'like',
+                                      'message_id': self.liked_id})
+        self.assertEqual(records[2], {'type': 'following',
+                                      'user_id': self.other_id,
+                                      'username': "other"})
+
+    def test_csv(self):
+        resp = self.client.get(f'/users/{self.user_id}/export?format=csv')
+
+        self.assertEqual(resp.mimetype, 'text/csv')
+
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(list(rows[0]), FIELDS)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['text'], "first, with a comma")
+        self.assertEqual(rows[3]['username'], "other")
+
+    def test_only_your_own(self):
+        resp = self.client.get(f'/users/{self.other_id}/export')
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.get(f'/users/{self.user_id}/export?format=xml')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_small_chunks(self):
+        """Does a chunk size smaller than the account still export it
+        all?"""
+
+        app.config['EXPORT_CHUNK_ROWS'] = 1
+        try:
+            resp = self.client.get(f'/users/{self.user_id}/export')
+        finally:
+            app.config['EXPORT_CHUNK_ROWS'] = 1000
+
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 4)
+
+
+class ChunkedTestCase(TestCase):
+    def test_chunked(self):
+        chunks = list(chunked(['a' * 3] * 5, size=6))
+
+        self.assertEqual(chunks, [b'aaaaaa', b'aaaaaa', b'aaa'])
+
+
+class ExportAllTestCase(TestCase):
+    """Test exporting every user in worker processes.
+
+    The workers have their own connections, so this reads the (committed)
+    seed data, not a test transaction.
+    """
+
+    def test_export_all(self):
+        with app.app_context():
+            follow = Follows.query.first()
+            user_id = follow.user_following_id
+            users = User.query.count()
+            db.session.remove()
+
+        with tempfile.TemporaryDirectory() as directory:
+            result = app.test_cli_runner().invoke(args=[
+                'export', 'all', '--directory', directory, '--workers', '2'])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            with open(os.path.join(directory, 'MANIFEST.json')) as f:
+                self.assertEqual(json.load(f)['users'], users)
+
+            self.assertEqual(len(os.listdir(directory)), users + 1)
+
+            with open(os.path.join(directory, f'{user_id}.ndjson')) as f:
+                records = [json.loads(line) for line in f]
+
+            self.assertIn({'type': 'following',
+                           'user_id': follow.user_being_followed_id},
+                          [{k: r.get(k) for k in ('type', 'user_id')}
+                           for r in records])
+
+    def test_list_exports(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'a'))
+            os.makedirs(os.path.join(root, 'b'))
+            with open(os.path.join(root, 'b', 'MANIFEST.json'), 'w') as f:
+                json.dump({'users': 3}, f)
+
+            app.config.update(ADMIN_TOKEN='sekrit', EXPORT_DIRECTORY=root)
+            try:
+                resp = app.test_client().get(
+                    '/admin/exports',
+                    headers={'Authorization': 'Bearer sekrit'})
+            finally:
+                app.config['ADMIN_TOKEN'] = None
+
+        self.assertEqual(resp.json['exports'], [
+            {'name': 'a', 'finished': False, 'manifest': None},
+            {'name': 'b', 'finished': True, 'manifest': {'users': 3}}])
@@ -0,0 +1,293 @@
+"""Feed cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_feedcache.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+import feedcache
+from feedcache import CircuitBreaker, FeedCache, MemoryStore
+from models import db, Message, User
+
+
+class Counter:
+    """A compute function that counts its calls, optionally failing."""
+
+    def __init__(self, delay=0):
+        self.calls = 0
+        self.delay = delay
+        self.fail = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+
+        with self._lock:
+            self.calls += 1
+
+            if self.fail:
+                raise RuntimeError("database on fire")
+
+            return self.calls
+
+
+class FeedCacheTestCase(TestCase):
+    """Test stale-while-revalidate reads, coalescing and the breaker."""
+
+    def setUp(self):
+        """Make a cache over an empty store."""
+
+        self._config = dict(app.config)
+        app.config.update(FEEDCACHE_TTL=60, FEEDCACHE_MAX_STALE=600,
+                          FEEDCACHE_KEEP=3600, FEEDCACHE_SLOW_SECONDS=5,
+                          FEEDCACHE_BREAKER_FAILURES=2,
+                          FEEDCACHE_BREAKER_COOLDOWN=60)
+        self.cache = FeedCache(app, MemoryStore())
+
+    def tearDown(self):
+        """Restore the app's config."""
+
+        self.cache.executor.shutdown(wait=True)
+        app.config.clear()
+        app.config.update(self._config)
+
+    def age(self, key, seconds):
+        """Pretend `key` was stored `seconds` ago."""
+
+        value, stored_at = self.cache.store.get(key)
+        self.cache.store.set(key, (value, stored_at - seconds), 0)
+
+    def test_fresh(self):
+        """Are fresh entries served without recomputing?"""
+
+        compute = Counter()
+
+        self.assertEqual(self.cache.get('k', compute), 1)
+        self.assertEqual(self.cache.get('k', compute), 1)
+        self.assertEqual(compute.calls, 1)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale entry served while one refresh replaces it?"""
+
+        compute = Counter()
+        self.cache.get('k', compute)
+        self.age('k', 120)
+
+        for _ in range(5):
+            self.assertEqual(self.cache.get('k', compute), 1)
+
+        self.cache.executor.shutdown(wait=True)
+
+        self.assertEqual(compute.calls, 2)
+        self.assertEqual(self.cache.get('k', compute), 2)
+
+    def test_misses_coalesced(self):
+        """Do concurrent misses for one key compute it once?"""
+
+        compute = Counter(delay=0.05)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get('k', compute)))
+            for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [1] * 8)
+        self.assertEqual(compute.calls, 1)
+
+    def test_invalidate(self):
+        """Are invalidated entries recomputed at once?"""
+
+        compute = Counter()
+        self.cache.get('k', compute)
+        self.cache.get('other', compute)
+
+        self.cache.invalidate('k')
+        self.assertEqual(self.cache.get('k', compute), 3)
+        self.assertEqual(self.cache.get('other', compute), 2)
+
+    def test_stale_on_failure(self):
+        """Is an expired entry served when recomputing it fails?"""
+
+        compute = Counter()
+        self.cache.get('k', compute)
+        self.age('k', 1200)
+
+        compute.fail = True
+        self.assertEqual(self.cache.get('k', compute), 1)
+
+        with self.assertRaises(RuntimeError):
+            self.cache.get('new', compute)
+
+    def test_breaker_serves_stale(self):
+        """Once the breaker opens, are expired entries served untouched?"""
+
+        app.config['FEEDCACHE_SLOW_SECONDS'] = 0
+        compute = Counter()
+
+        # Two "slow" computes open the breaker
+        self.cache.get('a', compute)
+        self.cache.get('k', compute)
+        self.assertTrue(self.cache.breaker.open)
+
+        self.age('k', 1200)
+
+        self.assertEqual(self.cache.get('k', compute), 2)
+        self.cache.executor.shutdown(wait=True)
+        self.assertEqual(compute.calls, 2)
+
+    def test_kept_past_max_stale(self):
+        """Does the store keep entries for FEEDCACHE_KEEP, so Redis hasn't
+        expired the ones an open breaker serves?"""
+
+        ttls = []
+        store_set = self.cache.store.set
+        self.cache.store.set = lambda key, entry, ttl: (
+            ttls.append(ttl), store_set(key, entry, ttl))
+
+        self.cache.get('k', Counter())
+        self.assertEqual(ttls, [3600])
+
+
+class CircuitBreakerTestCase(TestCase):
+    """Test opening, probing and closing the breaker."""
+
+    def test_open_probe_close(self):
+        breaker = CircuitBreaker(failures=2, cooldown=0.05)
+
+        breaker.record(False)
+        self.assertFalse(breaker.open)
+        breaker.record(False)
+        self.assertTrue(breaker.open)
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.record(True)
+        self.assertFalse(breaker.open)
+        self.assertTrue(breaker.allow())
+
+
+class ConfigTestCase(TestCase):
+    def test_memory_store_needs_one_worker(self):
+        """Is a per-process cache refused when writes on one worker
+        couldn't invalidate the others'?"""
+
+        # Off by default without a shared store
+        other = Flask(__name__)
+        other.config.update(WEB_CONCURRENCY=4, FEEDCACHE_URL='memory://')
+        feedcache.init_app(other)
+        self.assertFalse(other.config['FEEDCACHE_ENABLED'])
+
+        other = Flask(__name__)
+        other.config.update(WEB_CONCURRENCY=4, FEEDCACHE_ENABLED=True)
+        with self.assertRaises(ValueError):
+            feedcache.init_app(other)
+
+
+class FeedCacheViewsTestCase(DatabaseTestCase):
+    """Test that writes invalidate the cached pages they change."""
+
+    def setUp(self):
+        """Create a reader, and an author with a message."""
+
+        super().setUp()
+
+        self.reader = User.signup(username="reader", email="reader@test.com",
+                                  password="password", image_url=None)
+        self.author = User.signup(username="author", email="author@test.com",
+                                  password="password", image_url=None)
+        db.session.commit()
+
+        self.message = Message.post(self.author.id, "first warble")
+        db.session.commit()
+
+        self.reader_id, self.author_id = self.reader.id, self.author.id
+        self.message_id = self.message.id
+
+        app.config['FEEDCACHE_ENABLED'] = True
+        app.extensions['feed_cache'].clear()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def tearDown(self):
+        app.config['FEEDCACHE_ENABLED'] = False
+        app.extensions['feed_cache'].clear()
+        super().tearDown()
+
+    def page(self, url):
+        return self.client.get(url).get_data(as_text=True)
+
+    def test_profile_cached(self):
+        """Is the profile served from cache until its author posts?"""
+
+        self.assertIn("first warble", self.page(f'/users/{self.author_id}'))
+
+        # Behind the app's back: not seen until something invalidates
+        Message.post(self.author_id, "sneaky warble")
+        db.session.commit()
+        self.assertNotIn("sneaky warble",
+                         self.page(f'/users/{self.author_id}'))
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        self.client.post('/messages/new', data={'text': "posted warble"})
+
+        html = self.page(f'/users/{self.author_id}')
+        self.assertIn("posted warble", html)
+        self.assertIn("sneaky warble", html)
+
+    def test_follow_invalidates_home(self):
+        """Does following someone update the home timeline at once?"""
+
+        self.assertNotIn("first warble", self.page('/'))
+
+        self.client.post(f'/users/follow/{self.author_id}')
+        html = self.page('/')
+
+        self.assertIn("first warble", html)
+        self.assertIn('fa-thumbs-up"></i> 0', html)
+
+        self.client.post(f'/messages/{self.message_id}/like')
+        self.assertIn('fa-thumbs-up"></i> 1', self.page('/'))
+
+    def test_delete_invalidates_followers(self):
+        """Does a deleted message leave followers' timelines at once,
+        leaving everyone else's cached?"""
+
+        self.client.post(f'/users/follow/{self.author_id}')
+        self.assertIn("first warble", self.page('/'))
+
+        stranger = User.query.filter(User.id.notin_(
+            [self.reader_id, self.author_id])).first()
+        key = feedcache.feed_key(stranger.id)
+        with app.test_request_context():
+            feedcache.cached(key, lambda: "stranger's timeline")
+
+        author = app.test_client()
+        with author.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        author.post(f'/messages/{self.message_id}/delete')
+
+        self.assertNotIn("first warble", self.page('/'))
+        self.assertIsNotNone(app.extensions['feed_cache'].store.get(key))
+
+    def test_missing_profile(self):
+        """Do unknown users still 404?"""
+
+        self.assertEqual(self.client.get('/users/999999').status_code, 404)
@@ -0,0 +1,223 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import os
+import re
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from graph import Adjacency, FollowGraph
+from models import db, Follows, Message, User
+
+EDGES = [(0, 2), (0, 5), (0, 9), (1, 0), (3, 2), (3, 9)]
+
+
+class AdjacencyTestCase(TestCase):
+    """Test the packed adjacency lists and their overlays."""
+
+    def setUp(self):
+        self.adjacency = Adjacency.from_sorted(EDGES, 4)
+
+    def test_queries(self):
+        """Do membership, degree and slices read the packed arrays?"""
+
+        self.assertTrue(self.adjacency.contains(0, 5))
+        self.assertFalse(self.adjacency.contains(0, 6))
+        self.assertFalse(self.adjacency.contains(2, 0))
+        self.assertFalse(self.adjacency.contains(100, 0))
+        self.assertEqual(self.adjacency.degree(0), 3)
+        self.assertEqual(self.adjacency.degree(2), 0)
+        self.assertEqual(self.adjacency.neighbours(0), [2, 5, 9])
+        self.assertEqual(self.adjacency.neighbours(0, 1, 2), [5])
+        self.assertEqual(self.adjacency.neighbours(0, 5), [])
+
+    def test_size_grows(self):
+        """Are nodes past the size hint kept?"""
+
+        adjacency = Adjacency.from_sorted(EDGES + [(7, 1)], 2)
+        self.assertEqual(adjacency.neighbours(7), [1])
+        self.assertEqual(adjacency.neighbours(3), [2, 9])
+
+    def test_transpose(self):
+        """Does the transpose hold every edge reversed, sorted?"""
+
+        reverse = self.adjacency.transpose()
+
+        self.assertEqual(reverse.neighbours(2), [0, 3])
+        self.assertEqual(reverse.neighbours(9), [0, 3])
+        self.assertEqual(reverse.neighbours(0), [1])
+        self.assertEqual(len(reverse.targets), len(EDGES))
+
+    def test_overlay(self):
+        """Do changes show up at once?"""
+
+        self.adjacency.add(0, 3)
+        self.adjacency.add(0, 5)
+        self.adjacency.remove(0, 9)
+        self.adjacency.add(8, 1)
+        self.adjacency.remove(3, 4)
+
+        self.assertEqual(self.adjacency.neighbours(0), [2, 3, 5])
+        self.assertEqual(self.adjacency.neighbours(0, 1), [3, 5])
+        self.assertEqual(self.adjacency.degree(0), 3)
+        self.assertFalse(self.adjacency.contains(0, 9))
+        self.assertTrue(self.adjacency.contains(8, 1))
+        self.assertEqual(self.adjacency.neighbours(3), [2, 9])
+
+        self.adjacency.remove(0, 3)
+        self.adjacency.add(0, 9)
+        self.assertEqual(self.adjacency.neighbours(0), [2, 5, 9])
+        self.assertEqual((self.adjacency.added, self.adjacency.removed),
+                         ({8: {1}}, {}))
+
+    def test_retire(self):
+        """Are updates made during a reload carried over to the new graph?"""
+
+        old = FollowGraph(Adjacency.from_sorted(EDGES, 4))
+        old.start_journal()
+        old.update(True, 1, 9)
+        old.update(False, 0, 2)
+
+        # Loaded while the updates were happening: has one, not the other
+        new = FollowGraph(Adjacency.from_sorted(EDGES[1:], 4))
+        old.retire(new)
+        old.update(True, 3, 5)
+
+        self.assertEqual(new.following_ids(0), [5, 9])
+        self.assertEqual(new.following_ids(1), [0, 9])
+        self.assertEqual(new.follower_ids(5), [0, 3])
+        self.assertEqual(new.edges, len(EDGES) + 1)
+
+
+class FollowGraphViewsTestCase(DatabaseTestCase):
+    """Test serving follow reads from the graph."""
+
+    def setUp(self):
+        """Turn the graph on, loaded from this test's database."""
+
+        super().setUp()
+
+        self.reader = User.signup(username="reader", email="reader@test.com",
+                                  password="password", image_url=None)
+        self.author = User.signup(username="author", email="author@test.com",
+                                  password="password", image_url=None)
+        db.session.commit()
+        Message.post(self.author.id, "graph-indexed warble")
+        db.session.commit()
+
+        self.reader_id, self.author_id = self.reader.id, self.author.id
+
+        app.config['GRAPH_INDEX_ENABLED'] = True
+        app.extensions['follow_graph'].update(
+            pid=os.getpid(), reloading=False,
+            graph=FollowGraph.load(self._connection))
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def tearDown(self):
+        """Turn the graph back off."""
+
+        app.config['GRAPH_INDEX_ENABLED'] = False
+        app.extensions['follow_graph'].update(pid=None, graph=None)
+
+        super().tearDown()
+
+    def test_load(self):
+        """Does the loaded graph match the follows table?"""
+
+        graph = app.extensions['follow_graph']['graph']
+
+        self.assertEqual(graph.edges, Follows.query.count())
+
+        for user in User.query.limit(20):
+            self.assertEqual(graph.following_ids(user.id),
+                             sorted(u.id for u in user.following))
+            self.assertEqual(graph.follower_count(user.id),
+                             len(user.followers))
+
+    def test_follow_unfollow(self):
+        """Are follows and unfollows seen by the next read?"""
+
+        self.client.post(f'/users/follow/{self.author_id}')
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn("graph-indexed warble", html)
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn(f'action="/users/stop-following/{self.author_id}"', html)
+
+        self.client.post(f'/users/stop-following/{self.author_id}')
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn("graph-indexed warble", html)
+
+    def test_other_workers_follows(self):
+        """Are the user's own follows seen at once, even when made by
+        another process (so this graph hasn't heard of them)?"""
+
+        db.session.add(Follows(user_following_id=self.reader_id,
+                               user_being_followed_id=self.author_id))
+        db.session.commit()
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn("graph-indexed warble", html)
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn(f'action="/users/stop-following/{self.author_id}"', html)
+
+    def test_deleted_users_left_out(self):
+        """Are deleted accounts' messages kept off the homepage?"""
+
+        self.client.post(f'/users/follow/{self.author_id}')
+        User.query.get(self.author_id).deleted_at = db.func.now()
+        db.session.commit()
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn("graph-indexed warble", html)
+
+    def test_follow_pages(self):
+        """Do the follow pages show a page of users at a time, from the
+        graph and from the database alike?"""
+
+        app.config['FOLLOW_PAGE_SIZE'] = 2
+        self.addCleanup(app.config.update, FOLLOW_PAGE_SIZE=48)
+
+        user = User.query.get(Follows.query.first().user_following_id)
+        lists = {'following': sorted(u.id for u in user.following),
+                 'followers': sorted(u.id for u in user.followers)}
+
+        for enabled in (True, False):
+            app.config['GRAPH_INDEX_ENABLED'] = enabled
+
+            for name, ids in lists.items():
+                for page in (1, 2):
+                    with self.subTest(enabled=enabled, name=name, page=page):
+                        html = self.client.get(
+                            f'/users/{user.id}/{name}?page={page}'
+                        ).get_data(as_text=True)
+
+                        shown = [int(user_id) for user_id in re.findall(
+                            r'action="/users/(?:stop-following|follow)/'
+                            r'(\d+)"', html) if int(user_id) != user.id]
+                        self.assertEqual(shown, ids[page * 2 - 2:page * 2])
+                        self.assertEqual(f'?page={page + 1}' in html,
+                                         len(ids) > page * 2)
+
+    def test_own_following_page(self):
+        """Does the user's own following page show follows this graph
+        hasn't heard of?"""
+
+        db.session.add(Follows(user_following_id=self.reader_id,
+                               user_being_followed_id=self.author_id))
+        db.session.commit()
+
+        html = self.client.get(f'/users/{self.reader_id}/following'
+                               ).get_data(as_text=True)
+        self.assertIn(f'action="/users/stop-following/{self.author_id}"', html)
@@ -0,0 +1,245 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from io import BytesIO
+
+from PIL import Image
+
+from testing import DatabaseTestCase
+from app import app
+from images import ImageCache, fetch, thumbnail_url
+from models import db, User
+
+
+def write_image(path, size, color):
+    """Save a solid-color PNG at `path`."""
+
+    Image.new('RGB', size, color).save(path, 'PNG')
+
+
+class ImageProxyTestCase(DatabaseTestCase):
+    """Test serving resized profile images."""
+
+    def setUp(self):
+        """Point a user's images at local files standing in for the origin."""
+
+        super().setUp()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.tmp.name, 'origin.png')
+        write_image(self.origin, (300, 200), 'red')
+
+        self._config = dict(app.config)
+        app.config['IMAGE_CACHE_DIR'] = os.path.join(self.tmp.name, 'cache')
+        app.config['IMAGE_PROXY_SCHEMES'] = ('file',)
+        app.extensions.pop('image_cache', None)
+
+        self.user = User(username="pictured", email="pictured@test.com",
+                         password="x", image_url=f"file://{self.origin}")
+        db.session.add(self.user)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Restore the app's config and remove the files."""
+
+        app.config.clear()
+        app.config.update(self._config)
+        app.extensions.pop('image_cache', None)
+        self.tmp.cleanup()
+
+        super().tearDown()
+
+    def test_thumbnail(self):
+        """Is the image resized and served with long-lived caching?"""
+
+        resp = self.client.get(thumbnail_url(self.user, 'avatar', 'timeline'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (96, 96))
+
+    def test_thumbnail_cached(self):
+        """Is the origin fetched only once?"""
+
+        url = thumbnail_url(self.user, 'avatar', 'card')
+        first = self.client.get(url)
+        os.remove(self.origin)
+        second = self.client.get(url)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.data, second.data)
+
+    def test_thumbnail_fallback(self):
+        """Does an unreachable origin fall back to the default image?"""
+
+        os.remove(self.origin)
+        resp = self.client.get(thumbnail_url(self.user, 'avatar', 'card'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (140, 140))
+
+    def test_decompression_bomb(self):
+        """Is a small file claiming huge dimensions refused undecoded?"""
+
+        with open(self.origin, 'rb') as f:
+            png = f.read()
+
+        # IHDR's width and height (the first chunk, after the signature)
+        ihdr = b'IHDR' + struct.pack('>II', 50000, 50000) + png[24:29]
+        with open(self.origin, 'wb') as f:
+            f.write(png[:12] + ihdr
+                    + struct.pack('>I', zlib.crc32(ihdr)) + png[33:])
+
+        resp = self.client.get(thumbnail_url(self.user, 'avatar', 'card'))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (140, 140))
+
+    def test_failure_remembered(self):
+        """Is a failed origin left alone for IMAGE_PROXY_FAILURE_TTL?"""
+
+        url = thumbnail_url(self.user, 'avatar', 'card')
+        os.rename(self.origin, self.origin + '.away')
+        self.client.get(url)
+        os.rename(self.origin + '.away', self.origin)
+
+        # Other sizes of the same image aren't fetched either
+        for path in (url, thumbnail_url(self.user, 'avatar', 'hero')):
+            resp = self.client.get(path)
+            self.assertNotIn('immutable', resp.headers['Cache-Control'])
+
+        app.config['IMAGE_PROXY_FAILURE_TTL'] = 0
+        resp = self.client.get(url)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+    def test_thumbnail_url_versioned(self):
+        """Does changing the image give a new thumbnail URL?"""
+
+        before = thumbnail_url(self.user, 'avatar', 'timeline')
+        self.user.image_url = "/static/images/default-pic.png"
+
+        self.assertNotEqual(before, thumbnail_url(self.user, 'avatar', 'timeline'))
+
+    def test_unknown_slot(self):
+        """Are unknown sizes rejected?"""
+
+        resp = self.client.get(f"/images/avatar/huge/{self.user.id}")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_cache_eviction(self):
+        """Does the cache drop least recently used files past its limit?"""
+
+        cache = ImageCache(os.path.join(self.tmp.name, 'small'), max_bytes=250)
+        first = cache.put('aa01', b'x' * 100)
+        second = cache.put('bb02', b'x' * 100)
+
+        # Touch the first entry, making the second the least recent
+        os.utime(first, (1, 1))
+        os.utime(second, (0, 0))
+        cache.get('aa01')
+
+        cache.put('cc03', b'x' * 100)
+
+        self.assertIsNotNone(cache.get('aa01'))
+        self.assertIsNone(cache.get('bb02'))
+        self.assertIsNotNone(cache.get('cc03'))
+
+
+class OriginHandler(SimpleHTTPRequestHandler):
+    """Serves files, and redirects /to/<url> to <url>."""
+
+    def do_GET(self):
+        if self.path.startswith('/to/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/to/'):])
+            self.end_headers()
+        else:
+            super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTestCase(DatabaseTestCase):
+    """Test that the proxy only fetches from public addresses."""
+
+    def setUp(self):
+        super().setUp()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        write_image(os.path.join(self.tmp.name, 'origin.png'), (30, 20),
+                    'red')
+
+        self.server = HTTPServer(('127.0.0.1', 0), partial(
+            OriginHandler, directory=self.tmp.name))
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.origin = f"http://127.0.0.1:{self.server.server_port}"
+
+        self._config = dict(app.config)
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        app.config.clear()
+        app.config.update(self._config)
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+        super().tearDown()
+
+    def test_private_refused(self):
+        """Are internal addresses refused, before connecting?"""
+
+        for url in [f"{self.origin}/origin.png",
+                    "http://localhost:5432/",
+                    "http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.1/", "http://192.168.1.1/x.png",
+                    "http://[::1]/", "http://[::ffff:127.0.0.1]/",
+                    "http://0.0.0.0/"]:
+            with self.subTest(url=url):
+                with self.assertRaisesRegex(ValueError, "Not a public"):
+                    fetch(url)
+
+    def test_allowed_network(self):
+        app.config['IMAGE_PROXY_ALLOWED_NETWORKS'] = ('127.0.0.1/32',)
+
+        data = fetch(f"{self.origin}/origin.png")
+        self.assertEqual(Image.open(BytesIO(data)).size, (30, 20))
+
+    def test_redirects_checked(self):
+        """Is every redirect hop checked, and their number bounded?"""
+
+        app.config['IMAGE_PROXY_ALLOWED_NETWORKS'] = ('127.0.0.1/32',)
+
+        data = fetch(f"{self.origin}/to/{self.origin}/origin.png")
+        self.assertEqual(Image.open(BytesIO(data)).size, (30, 20))
+
+        with self.assertRaisesRegex(ValueError, "Not a public"):
+            fetch(f"{self.origin}/to/http://127.0.0.2:"
+                  f"{self.server.server_port}/origin.png")
+
+        with self.assertRaisesRegex(ValueError, "Can't fetch images over"):
+            fetch(f"{self.origin}/to/file:///etc/passwd")
+
+        app.config['IMAGE_PROXY_MAX_REDIRECTS'] = 1
+        with self.assertRaisesRegex(ValueError, "Too many redirects"):
+            fetch(f"{self.origin}/to/{self.origin}/to/{self.origin}/x.png")
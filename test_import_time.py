@@ -0,0 +1,63 @@
+"""Import time regression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_import_time.py
+#
+# IMPORT_BUDGET_MS overrides the time budget (e.g. on slow CI machines).
+
+
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 1500))
+
+# Modules that should only be loaded once a request (or debug mode) needs them
+DEFERRED_MODULES = ['forms', 'wtforms', 'flask_wtf', 'flask_bcrypt',
+                    'flask_debugtoolbar']
+
+
+def import_app():
+    """Import app in a fresh interpreter; return {module: cumulative us}."""
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, DATABASE_URL='postgresql:///warbler-test'),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    timings = {}
+
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line.split('|')
+        timings[name.strip()] = int(cumulative)
+
+    return timings
+
+
+class ImportTimeTestCase(TestCase):
+    """Test that importing the app stays cheap."""
+
+    def setUp(self):
+        """Import the app once in a clean process."""
+
+        self.timings = import_app()
+
+    def test_heavy_imports_deferred(self):
+        """Are forms, bcrypt and the debug toolbar left unimported?"""
+
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, self.timings)
+
+    def test_import_budget(self):
+        """Does `import app` fit in the time budget?"""
+
+        self.assertLess(self.timings['app'] / 1000, IMPORT_BUDGET_MS)
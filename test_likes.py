@@ -0,0 +1,147 @@
+"""Like count tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+#
+# The concurrency test needs Postgres (TEST_DATABASE_URL).
+
+
+import threading
+import unittest
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from likes import reconcile
+from models import db, Likes, Message, User
+
+
+class LikeCountTestCase(DatabaseTestCase):
+    """Test keeping like_count in step with likes."""
+
+    def setUp(self):
+        """Create a message and a user to like it."""
+
+        super().setUp()
+
+        self.author = User(username="liked", email="liked@test.com",
+                           password="x")
+        self.fan = User(username="fan", email="fan@test.com", password="x")
+        db.session.add_all([self.author, self.fan])
+        db.session.flush()
+
+        self.message = Message.post(self.author.id, "like me")
+        db.session.commit()
+
+        self.message_id, self.fan_id = self.message.id, self.fan.id
+
+    def like_count(self):
+        return Message.query.get(self.message_id).like_count
+
+    def test_like_unlike_views(self):
+        """Do the like and unlike routes move the count?"""
+
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+        client.post(f'/messages/{self.message_id}/like')
+        self.assertEqual(self.like_count(), 1)
+
+        resp = client.get(f'/users/{self.fan_id}/likes')
+        self.assertIn('fa-thumbs-up"></i> 1', resp.get_data(as_text=True))
+
+        client.post(f'/messages/{self.message_id}/unlike')
+        self.assertEqual(self.like_count(), 0)
+
+    def test_like_twice(self):
+        """Is a second like by the same user a no-op?"""
+
+        self.assertTrue(Message.like(self.message_id, self.fan_id))
+        self.assertFalse(Message.like(self.message_id, self.fan_id))
+        db.session.commit()
+
+        self.assertEqual(self.like_count(), 1)
+        self.assertEqual(Likes.query.filter_by(user_id=self.fan_id).count(), 1)
+
+    def test_unlike_unliked(self):
+        """Does unliking something never liked leave the count alone?"""
+
+        self.assertFalse(Message.unlike(self.message_id, self.fan_id))
+        self.assertEqual(self.like_count(), 0)
+
+    def test_reconcile(self):
+        """Does reconciling repair a drifted count?"""
+
+        db.session.add(Likes(user_id=self.fan_id, message_id=self.message_id))
+        db.session.commit()
+
+        self.assertEqual(self.like_count(), 0)
+        self.assertEqual(reconcile(batch_size=100), 1)
+        self.assertEqual(self.like_count(), 1)
+        self.assertEqual(reconcile(batch_size=100), 0)
+
+
+@unittest.skipUnless(db.engine.dialect.name == 'postgresql',
+                     "needs concurrent writers")
+class ConcurrentLikesTestCase(TestCase):
+    """Test many users liking one message at once, for real (committed)."""
+
+    LIKERS = 20
+
+    def setUp(self):
+        """Commit a message and users to like it."""
+
+        with app.app_context():
+            users = [User(username=f"liker{n}", email=f"liker{n}@test.com",
+                          password="x") for n in range(self.LIKERS + 1)]
+            db.session.add_all(users)
+            db.session.flush()
+
+            self.user_ids = [user.id for user in users]
+            message = Message.post(self.user_ids[0], "popular")
+            db.session.commit()
+            self.message_id = message.id
+
+    def tearDown(self):
+        """Delete the users, and with them the message and likes."""
+
+        with app.app_context():
+            User.query.filter(User.id.in_(self.user_ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+
+    def test_concurrent_likes(self):
+        """Is every like counted exactly once, despite the races?"""
+
+        # Every user likes the message twice, all threads at once
+        likers = self.user_ids[1:] * 2
+        barrier = threading.Barrier(len(likers))
+        errors = []
+
+        def like(user_id):
+            try:
+                with app.app_context():
+                    barrier.wait()
+                    Message.like(self.message_id, user_id)
+                    db.session.commit()
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=like, args=(user_id,))
+                   for user_id in likers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        with app.app_context():
+            self.assertEqual(Message.query.get(self.message_id).like_count,
+                             self.LIKERS)
+            self.assertEqual(
+                Likes.query.filter_by(message_id=self.message_id).count(),
+                self.LIKERS)
@@ -0,0 +1,222 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import json
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+import live
+from live import Broker
+from models import db, Message, User
+from writebuffer import WriteBuffer
+
+
+def read_event(chunks):
+    """The next data event from an SSE stream's chunks, skipping the rest."""
+
+    for chunk in chunks:
+        chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+
+        for line in chunk.splitlines():
+            if line.startswith('data: '):
+                return json.loads(line[len('data: '):])
+
+
+class LiveTimelineTestCase(DatabaseTestCase):
+    """Test streaming new messages to followers."""
+
+    def setUp(self):
+        """Create a reader who follows an author."""
+
+        super().setUp()
+
+        app.extensions.pop('live_backend', None)
+        app.config['LIVE_ENABLED'] = True
+
+        self.reader = User.signup(username="reader", email="reader@test.com",
+                                  password="password", image_url=None)
+        self.author = User.signup(username="author", email="author@test.com",
+                                  password="password", image_url=None)
+        self.stranger = User.signup(username="stranger",
+                                    email="stranger@test.com",
+                                    password="password", image_url=None)
+        self.reader.following.append(self.author)
+        db.session.commit()
+
+        self.reader_id = self.reader.id
+        self.author_id = self.author.id
+        self.stranger_id = self.stranger.id
+
+    def tearDown(self):
+        """Drop the broker and its subscriptions."""
+
+        app.extensions.pop('live_backend', None)
+        app.config['LIVE_ENABLED'] = False
+        super().tearDown()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return client
+
+    def open_stream(self, **kwargs):
+        """Open the reader's stream; return the response and its chunks."""
+
+        resp = self.client_for(self.reader_id).get('/stream', **kwargs)
+        self.addCleanup(resp.close)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        return resp, iter(resp.response)
+
+    def test_new_message_pushed(self):
+        """Does a followed author's new message reach the stream?"""
+
+        resp, chunks = self.open_stream()
+
+        self.client_for(self.author_id).post('/messages/new',
+                                             data={'text': 'Live!'})
+        event = read_event(chunks)
+
+        self.assertEqual(event['text'], 'Live!')
+        self.assertEqual(event['username'], 'author')
+
+    def test_only_followed_authors(self):
+        """Are messages from unfollowed users left out?"""
+
+        resp, chunks = self.open_stream()
+
+        self.client_for(self.stranger_id).post('/messages/new',
+                                               data={'text': 'Hidden'})
+        self.client_for(self.author_id).post('/messages/new',
+                                             data={'text': 'Shown'})
+
+        self.assertEqual(read_event(chunks)['text'], 'Shown')
+
+    def test_pending_follow(self):
+        """Are follows still in the write buffer streamed from?"""
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        buffer = app.extensions['write_buffer'] = WriteBuffer(
+            app, directory.name, window=0)
+
+        # Closed here rather than as a cleanup: closing flushes, and
+        # cleanups run after tearDown has rolled the test back
+        try:
+            client = self.client_for(self.reader_id)
+            client.post(f'/users/follow/{self.stranger_id}')
+            resp = client.get('/stream')
+            self.addCleanup(resp.close)
+            chunks = iter(resp.response)
+
+            self.client_for(self.stranger_id).post(
+                '/messages/new', data={'text': 'Followed'})
+
+            self.assertEqual(read_event(chunks)['text'], 'Followed')
+        finally:
+            del app.extensions['write_buffer']
+            buffer.close()
+
+    def test_backfill(self):
+        """Does reconnecting with Last-Event-ID replay missed messages?"""
+
+        first = Message.post(self.author_id, 'Seen')
+        db.session.flush()
+        Message.post(self.author_id, 'Missed')
+        db.session.commit()
+
+        resp, chunks = self.open_stream(headers={'Last-Event-ID': first.id})
+
+        self.assertEqual(read_event(chunks)['text'], 'Missed')
+
+    def test_closing_unsubscribes(self):
+        """Does a closed stream stop receiving events?"""
+
+        resp, chunks = self.open_stream()
+        next(chunks)
+        broker = app.extensions['live_backend'].broker
+
+        self.assertEqual(broker.subscriber_count(), 1)
+        resp.close()
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_anonymous(self):
+        """Do logged out visitors get no stream?"""
+
+        resp = app.test_client().get('/stream')
+        self.assertEqual(resp.status_code, 204)
+
+    def test_disabled(self):
+        """Without an async worker class, is there no stream to hold a
+        worker?"""
+
+        client = self.client_for(self.reader_id)
+        self.assertIn('live.js', client.get('/').get_data(as_text=True))
+
+        app.config['LIVE_ENABLED'] = False
+
+        self.assertEqual(client.get('/stream').status_code, 204)
+        self.assertNotIn('live.js', client.get('/').get_data(as_text=True))
+
+    def test_slow_stream_ends(self):
+        """Does a stream dropped for falling behind send what it has, then
+        end, so the browser reconnects?"""
+
+        resp, chunks = self.open_stream()
+        next(chunks)
+        broker = app.extensions['live_backend'].broker
+
+        for n in range(101):
+            broker.publish({'id': n, 'user_id': self.author_id})
+
+        rest = ''.join(chunk.decode('utf-8') if isinstance(chunk, bytes)
+                       else chunk for chunk in chunks)
+        self.assertEqual(rest.count('data: '), 100)
+        self.assertNotIn('keepalive', rest)
+
+
+class BrokerTestCase(TestCase):
+    """Test fanning events out in process."""
+
+    def test_slow_subscriber_dropped(self):
+        """Is a subscriber with a full queue unsubscribed?"""
+
+        broker = Broker()
+        subscription = broker.subscribe([1])
+
+        for n in range(101):
+            broker.publish({'id': n, 'user_id': 1})
+
+        self.assertEqual(broker.subscriber_count(), 0)
+        self.assertEqual(subscription.get(timeout=0)['id'], 0)
+
+
+class ConfigTestCase(TestCase):
+    def test_memory_backend_needs_one_worker(self):
+        """Are live updates refused when a post on one worker couldn't
+        reach the others' streams?"""
+
+        other = Flask(__name__)
+        other.config.update(WEB_CONCURRENCY=4, WEB_WORKER_CLASS='gevent',
+                            LIVE_BACKEND='memory')
+        with self.assertRaises(ValueError):
+            live.init_app(other)
+
+        for settings in ({'WEB_CONCURRENCY': 1},
+                         {'WEB_CONCURRENCY': 4, 'LIVE_BACKEND': 'postgres'}):
+            other = Flask(__name__)
+            other.config.update(WEB_WORKER_CLASS='gevent', **settings)
+            live.init_app(other)
+            self.assertTrue(other.config['LIVE_ENABLED'])
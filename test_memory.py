@@ -0,0 +1,106 @@
+"""Per-request memory accounting and memory budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_memory.py
+#
+# MEMORY_BUDGET_ROWS sets how many followers, follows and likes the heavy
+# user gets (default 500); the budgets scale with it.
+
+
+import os
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from models import db, User
+import memory
+
+MEMORY_BUDGET_ROWS = int(os.environ.get('MEMORY_BUDGET_ROWS', 500))
+
+# Per page: (bytes allowed, plus bytes per row, ORM objects per row). The
+# list pages load and render every row, so they're budgeted per row; a
+# page loading a second object per row, or doubling what a row costs,
+# fails.
+BUDGETS = {
+    '/': (2 << 20, 0, 0),
+    '/users/{user_id}': (2 << 20, 0, 0),
+    '/users/{user_id}/followers': (1 << 20, 6 << 10, 1),
+    '/users/{user_id}/following': (1 << 20, 6 << 10, 1),
+    '/users/{user_id}/likes': (1 << 20, 8 << 10, 2),
+    '/users': (1 << 20, 6 << 10, 1),
+}
+
+
+class MeasureTestCase(DatabaseTestCase):
+    """Test measuring blocks of code and requests."""
+
+    def test_measure(self):
+        with memory.measure() as usage:
+            users = User.query.limit(5).all()
+            buffer = bytearray(1 << 20)
+
+        self.assertEqual(usage.objects, {'User': 5})
+        self.assertGreaterEqual(usage.peak, 1 << 20)
+        self.assertGreaterEqual(usage.identity, 5)
+        del users, buffer
+
+    def test_report(self):
+        """Are measured requests reported by endpoint, to admins?"""
+
+        app.config.update(MEMORY_PROFILE_ENABLED=True, ADMIN_TOKEN='sekrit',
+                          MEMORY_SNAPSHOT_BYTES=0)
+        admin = {'Authorization': 'Bearer sekrit'}
+        client = app.test_client()
+
+        try:
+            client.get('/users')
+            client.get('/users')
+            app.config['MEMORY_PROFILE_ENABLED'] = False
+
+            report = client.get('/admin/memory', headers=admin).json
+            client.delete('/admin/memory', headers=admin)
+            after = client.get('/admin/memory', headers=admin).json
+        finally:
+            app.config.update(MEMORY_PROFILE_ENABLED=False, ADMIN_TOKEN=None,
+                              MEMORY_SNAPSHOT_BYTES=10 * 1024 * 1024)
+
+        stats = report['endpoints']['warbler.list_users']
+        self.assertEqual(stats['requests'], 2)
+        # Logged out, the user list reads plain rows, not User objects
+        self.assertEqual(stats['objects_max'], 0)
+        self.assertGreater(stats['peak_max'], 0)
+        self.assertTrue(stats['worst']['sites'])
+        self.assertEqual(after['endpoints'], {})
+
+
+class MemoryBudgetTestCase(DatabaseTestCase):
+    """Test that pages stay within their memory budgets for a user with
+    many followers, follows and likes."""
+
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup(username="heavy", email="heavy@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.seed_crowd(self.user_id, MEMORY_BUDGET_ROWS)
+        db.session.commit()
+        self.users = User.query.count()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_budgets(self):
+        for path, (base, per_row, objects) in BUDGETS.items():
+            path = path.format(user_id=self.user_id)
+
+            # The user list shows everyone, not just the crowd
+            rows = self.users if path == '/users' else MEMORY_BUDGET_ROWS
+
+            with self.subTest(path=path):
+                self.assertMemoryBudget(self.client, path,
+                                        base + per_row * rows,
+                                        objects * rows + 10)
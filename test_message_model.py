@@ -1,27 +1,19 @@
 """Message model tests."""
 
-import os
-from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+from testing import DatabaseTestCase
 from app import app
-app.config['TESTING'] = True
+from models import db, User, Message
 
-db.drop_all()
-db.create_all()
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DatabaseTestCase):
   """Test views for Messages"""
 
   def setUp(self):
     """Create test client, add sample data."""
 
-    User.query.delete()
-    Message.query.delete()
-    Follows.query.delete()
+    super().setUp()
 
     user_one = User.signup(
         email="test@test.com",
@@ -55,11 +47,6 @@ class MessageModelTestCase(TestCase):
     self.message_one = message_one
     self.message_four = message_four
 
-  def tearDown(self):
-    """Clean up fouled transactions."""
-
-    db.session.rollback()
-
   def test_message_model(self):
     """Does basic model work?"""
     
@@ -81,3 +68,32 @@ class MessageModelTestCase(TestCase):
       db.session.add(invalid_message)
       db.session.commit()
       
+
+  def test_timestamps_ordered(self):
+    """Are timestamps set per message, ordering newest first?"""
+
+    first = Message.post(self.user_one.id, "first")
+    db.session.commit()
+    second = Message.post(self.user_one.id, "second")
+    db.session.commit()
+
+    self.assertIsNotNone(first.timestamp)
+    self.assertLessEqual(first.timestamp, second.timestamp)
+
+    newest = (Message
+              .query
+              .filter(Message.user_id == self.user_one.id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .first())
+    self.assertEqual(newest.id, second.id)
+
+  def test_post_many(self):
+    """Does a batched insert add every message?"""
+
+    count = Message.post_many(
+      {"user_id": self.user_two.id, "text": f"batch {i}"} for i in range(5))
+    db.session.commit()
+
+    self.assertEqual(count, 5)
+    self.assertEqual(
+      Message.query.filter(Message.user_id == self.user_two.id).count(), 8)
@@ -5,42 +5,23 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
-
-from models import db, connect_db, Message, User
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
+# testing gives us a database of our own (it has to be imported before
+# our app, since that will connect to the database); every test runs in
+# a transaction that is rolled back afterwards. It also turns off CSRF
+# in WTForms, since it's a pain to test
 
+from testing import DatabaseTestCase
 from app import app, CURR_USER_KEY
+from models import db, Message, User
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DatabaseTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -56,11 +37,6 @@ class MessageViewTestCase(TestCase):
 
         db.session.commit()
 
-    def tearDown(self):
-        """Clean up fouled transactions."""
-
-        db.session.rollback()
-
     def test_add_message(self):
         """Can a logged in user add a message?"""
 
@@ -79,7 +55,7 @@ class MessageViewTestCase(TestCase):
             # Make sure it redirects
             self.assertEqual(resp.status_code, 302)
 
-            msg = Message.query.one()
+            msg = Message.query.filter_by(user_id=self.testuser.id).one()
             self.assertEqual(msg.text, "Hello")
 
     def test_delete_message(self):
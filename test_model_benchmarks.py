@@ -0,0 +1,98 @@
+"""Models micro-benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_model_benchmarks.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from benchmarks.models import (
+    Dataset, append_history, compare, find_run, is_scratch, load_history,
+    run_size)
+from models import Follows, Likes, Message, User
+
+
+class RunTestCase(DatabaseTestCase):
+    def test_run(self):
+        """Is every benchmark timed, on data grown from the generator's,
+        without the writes being kept?"""
+
+        users, messages = User.query.count(), Message.query.count()
+
+        data = Dataset(seed=3)
+        data.grow(20)
+        data.grow(40)
+
+        self.assertEqual(len(data.user_ids), 40)
+        self.assertEqual(User.query.count(), users + 40)
+        self.assertEqual(Message.query.count(),
+                         messages + len(data.message_ids))
+        self.assertTrue(Follows.query.filter(
+            Follows.user_following_id.in_(data.user_ids)).count())
+        self.assertTrue(Likes.query.filter(
+            Likes.user_id.in_(data.user_ids)).count())
+
+        results = list(run_size(data, repeat=3, slow_repeat=1))
+
+        self.assertEqual([r['benchmark'] for r in results], [
+            'signup', 'authenticate', 'is_following', 'is_followed_by',
+            'following', 'followers', 'likes', 'post', 'post_many'])
+        for result in results:
+            self.assertEqual(result['size'], 40)
+            self.assertGreater(result['median_us'], 0)
+            self.assertGreaterEqual(result['p95_us'], result['median_us'])
+
+        self.assertEqual(User.query.filter(
+            User.username.like('signup-%')).count(), 0)
+        self.assertEqual(Message.query.count(),
+                         messages + len(data.message_ids))
+
+
+class CompareTestCase(TestCase):
+    def run_of(self, run_id, commit, **medians):
+        return {'id': run_id, 'commit': commit, 'results': [
+            {'size': 1000, 'benchmark': name, 'median_us': median}
+            for name, median in medians.items()]}
+
+    def test_compare(self):
+        """Are medians slower by over the threshold flagged?"""
+
+        baseline = self.run_of('1', 'aaa111', signup=100.0, post=100.0,
+                               likes=100.0)
+        candidate = self.run_of('2', 'bbb222', signup=109.0, post=125.0,
+                                following=50.0)
+
+        self.assertEqual(compare(baseline, candidate, threshold=10), [
+            (1000, 'signup', 100.0, 109.0, 9.0, False),
+            (1000, 'post', 100.0, 125.0, 25.0, True)])
+
+    def test_is_scratch(self):
+        """Are only databases named for throwaway data fine to drop?"""
+
+        self.assertTrue(is_scratch('postgresql:///warbler-bench'))
+        self.assertTrue(is_scratch('postgresql://u@h/warbler_test'))
+        self.assertTrue(is_scratch('sqlite:////tmp/x/bench.db'))
+        self.assertFalse(is_scratch('postgresql:///warbler'))
+        self.assertFalse(is_scratch('sqlite:////tmp/warbler.db'))
+
+    def test_history(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'runs', 'models.jsonl')
+            for run_id, commit in [('1', 'aaa111'), ('2', 'bbb222'),
+                                   ('3', 'aaa111')]:
+                append_history(path, self.run_of(run_id, commit, post=1.0))
+
+            history = load_history(path)
+
+        self.assertEqual([run['id'] for run in history], ['1', '2', '3'])
+        self.assertEqual(find_run(history, '-2')['id'], '2')
+        self.assertEqual(find_run(history, '2')['id'], '2')
+        self.assertEqual(find_run(history, 'aaa1')['id'], '3')
+        with self.assertRaises(LookupError):
+            find_run(history, 'ccc')
+        with self.assertRaises(LookupError):
+            find_run(history, '-9')
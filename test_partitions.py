@@ -0,0 +1,187 @@
+"""Message partitioning tests."""
+
+# run these tests like:
+#
+#    TEST_DATABASE_URL=postgresql:///warbler-test python -m unittest test_partitions.py
+#
+# Partitioning itself needs Postgres; on SQLite only the feed tests run.
+
+
+import gzip
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from testing import DatabaseTestCase
+from models import db, Likes, Message, User
+from partitions import (
+    archive_partition, ensure_partitions, is_partitioned, old_partitions,
+    partition, partitions)
+
+
+class FeedWindowTestCase(DatabaseTestCase):
+    """Test reading feeds newest window first."""
+
+    def setUp(self):
+        """Give a user one new and two old messages."""
+
+        super().setUp()
+
+        self.user = User.signup(username="windowed", email="windowed@test.com",
+                                password="password", image_url=None)
+        db.session.flush()
+
+        now = datetime.utcnow()
+        db.session.add_all([
+            Message(user_id=self.user.id, text="new", timestamp=now),
+            Message(user_id=self.user.id, text="old", timestamp=now - timedelta(days=90)),
+            Message(user_id=self.user.id, text="older", timestamp=now - timedelta(days=400)),
+        ])
+        db.session.commit()
+
+    def test_window_falls_back(self):
+        """Are older messages read when the window has too few?"""
+
+        feed = Message.feed([self.user.id], window=timedelta(days=31))
+        self.assertEqual([m.text for m in feed], ["new", "old", "older"])
+
+    def test_window_full(self):
+        """Is the limit filled from the window when it can be?"""
+
+        feed = Message.feed([self.user.id], limit=1, window=timedelta(days=31))
+        self.assertEqual([m.text for m in feed], ["new"])
+
+    def test_no_window(self):
+        """Does a feed without a window match one with it?"""
+
+        self.assertEqual(Message.feed([self.user.id], limit=2),
+                         Message.feed([self.user.id], limit=2,
+                                      window=timedelta(days=31)))
+
+
+@unittest.skipUnless(db.engine.dialect.name == 'postgresql',
+                     "partitioning needs Postgres")
+class PartitionTestCase(DatabaseTestCase):
+    """Test partitioning and archiving messages (inside the test's
+    transaction, so it's all rolled back)."""
+
+    def setUp(self):
+        """Partition messages, with a liked message from last year."""
+
+        super().setUp()
+
+        self.conn = self._connection
+        self.total = self.conn.execute("SELECT count(*) FROM messages").scalar()
+
+        # Counts that must survive the copy
+        self.conn.execute("UPDATE messages SET like_count = mod(id, 5)")
+        self.like_counts = dict(self.conn.execute(
+            "SELECT id, like_count FROM messages").fetchall())
+
+        partition(self.conn, ahead=2)
+
+        self.user = User.signup(username="partitioned",
+                                email="partitioned@test.com",
+                                password="password", image_url=None)
+        db.session.flush()
+
+        self.old = Message(user_id=self.user.id, text="old",
+                           timestamp=datetime.utcnow() - timedelta(days=400))
+        db.session.add(self.old)
+        db.session.flush()
+
+        self.user.likes.append(self.old)
+        db.session.commit()
+
+        self.old_month = date(self.old.timestamp.year,
+                              self.old.timestamp.month, 1)
+
+    def test_partitioned(self):
+        """Are all messages kept, with partitions through `ahead`?"""
+
+        self.assertTrue(is_partitioned(self.conn))
+        self.assertEqual(
+            self.conn.execute("SELECT count(*) FROM messages").scalar(),
+            self.total + 1)
+        self.assertEqual(ensure_partitions(self.conn, ahead=2), [])
+        self.assertIn(self.old_month, partitions(self.conn))
+
+    def test_like_counts_kept(self):
+        """Are the messages' like counts copied into the partitions?"""
+
+        self.assertTrue(any(self.like_counts.values()))
+        counts = dict(self.conn.execute(
+            "SELECT id, like_count FROM messages").fetchall())
+        self.assertEqual({message_id: counts[message_id]
+                          for message_id in self.like_counts},
+                         self.like_counts)
+
+    def test_new_message(self):
+        """Do new messages still get ids and timestamps?"""
+
+        msg = Message.post(self.user.id, "fresh")
+        db.session.commit()
+
+        self.assertIsNotNone(msg.id)
+        self.assertEqual(Message.query.get(msg.id).text, "fresh")
+
+    def test_late_partition(self):
+        """Are rows parked in the default partition moved when it's made?"""
+
+        future = datetime.utcnow() + timedelta(days=200)
+        db.session.add(Message(user_id=self.user.id, text="future",
+                               timestamp=future))
+        db.session.commit()
+
+        ensure_partitions(self.conn, ahead=2, today=future)
+
+        self.assertEqual(self.conn.execute(
+            "SELECT count(*) FROM messages_default").scalar(), 0)
+        self.assertEqual(Message.query.filter_by(text="future").count(), 1)
+
+    def test_delete_cascades_to_likes(self):
+        """Does deleting a message still delete its likes?"""
+
+        db.session.delete(self.old)
+        db.session.commit()
+
+        self.assertEqual(Likes.query.filter_by(user_id=self.user.id).count(), 0)
+
+    def test_like_missing_message(self):
+        """Is liking a nonexistent message still refused?"""
+
+        with self.assertRaises(IntegrityError):
+            db.session.add(Likes(user_id=self.user.id, message_id=-1))
+            db.session.flush()
+
+    def test_archive_to_table(self):
+        """Do old partitions move under messages_archive with their likes?"""
+
+        self.assertIn(self.old_month, old_partitions(self.conn, 12))
+        archive_partition(self.conn, self.old_month)
+
+        self.assertNotIn(self.old_month, partitions(self.conn))
+        self.assertIn(self.old_month, partitions(self.conn, 'messages_archive'))
+        self.assertEqual(Message.query.filter_by(text="old").count(), 0)
+        self.assertEqual(self.conn.execute(
+            "SELECT count(*) FROM likes_archive WHERE user_id = %s",
+            self.user.id).scalar(), 1)
+
+    def test_archive_to_files(self):
+        """Are exported partitions written out and dropped?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            name = archive_partition(self.conn, self.old_month, export_dir=tmp)
+
+            with gzip.open(os.path.join(tmp, f"{name}.csv.gz"), 'rt') as rows:
+                self.assertIn("old", rows.read())
+
+            with gzip.open(os.path.join(tmp, f"{name}.likes.csv.gz"), 'rt') as rows:
+                self.assertEqual(len(rows.read().splitlines()), 2)
+
+        self.assertIsNone(self.conn.execute(
+            "SELECT to_regclass(%s)", name).scalar())
+        self.assertEqual(Likes.query.filter_by(user_id=self.user.id).count(), 0)
@@ -0,0 +1,143 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app
+from profiler import Profiler
+
+
+def slow_view_helper(started, done):
+    started.set()
+    done.wait(5)
+
+
+class ProfilerTestCase(TestCase):
+    """Test sampling a running thread."""
+
+    def test_samples_running_thread(self):
+        """Are a sampled thread's stacks counted under its endpoint?"""
+
+        profiler = Profiler(interval=0.001)
+        started, done = threading.Event(), threading.Event()
+
+        def request():
+            profiler.start_request('test.slow')
+            try:
+                slow_view_helper(started, done)
+            finally:
+                profiler.end_request()
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        started.wait(5)
+
+        deadline = time.monotonic() + 5
+        while not profiler.stacks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+        done.set()
+        thread.join()
+
+        collapsed = profiler.collapsed('test.slow')
+        self.assertTrue(collapsed.startswith('test.slow;'))
+        self.assertIn('test_profiler.py:slow_view_helper', collapsed)
+        self.assertEqual(profiler.collapsed('other'), '')
+        self.assertEqual(profiler.requests['test.slow'], 1)
+
+    def test_max_stacks(self):
+        """Are stacks past the limit lumped together?"""
+
+        profiler = Profiler(max_stacks=1)
+        profiler.stacks['a;x'] = 1
+        profiler._active[threading.get_ident()] = 'a'
+
+        profiler.sample()
+
+        self.assertEqual(profiler.stacks['a;[other]'], 1)
+
+
+class ProfilerViewsTestCase(DatabaseTestCase):
+    """Test sampling requests and reading the profile."""
+
+    def setUp(self):
+        """Sample every homepage request, with an admin token set."""
+
+        super().setUp()
+
+        self._config = dict(app.config)
+        self.tmp = tempfile.TemporaryDirectory()
+
+        app.config.update(ADMIN_TOKEN='sekrit', PROFILER_ENABLED=True,
+                          PROFILER_SAMPLE_RATE=0,
+                          PROFILER_RATES={'warbler.homepage': 1},
+                          PROFILER_KILL_FILE=os.path.join(self.tmp.name, 'off'))
+        app.extensions['profiler'] = Profiler()
+        app.extensions['profiler_kill']['checked'] = float('-inf')
+
+        self.client = app.test_client()
+        self.admin = {'Authorization': 'Bearer sekrit'}
+
+    def tearDown(self):
+        """Restore the app's config and profiler."""
+
+        app.config.clear()
+        app.config.update(self._config)
+        app.extensions['profiler'] = Profiler()
+        app.extensions['profiler_kill']['checked'] = float('-inf')
+        self.tmp.cleanup()
+
+        super().tearDown()
+
+    def test_needs_token(self):
+        """Is the profile hidden without a token, and refused with a bad one?"""
+
+        self.assertEqual(self.client.get('/admin/profile').status_code, 401)
+        self.assertEqual(self.client.get(
+            '/admin/profile',
+            headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+
+        app.config['ADMIN_TOKEN'] = None
+        self.assertEqual(self.client.get(
+            '/admin/profile', headers=self.admin).status_code, 404)
+
+    def test_sampled_routes(self):
+        """Are only the configured endpoints sampled?"""
+
+        self.client.get('/')
+        self.client.get('/signup')
+
+        stats = self.client.get('/admin/profile/stats',
+                                headers=self.admin).get_json()
+        self.assertTrue(stats['enabled'])
+        self.assertEqual(stats['requests'], {'warbler.homepage': 1})
+
+        resp = self.client.get('/admin/profile?endpoint=warbler.homepage',
+                               headers=self.admin)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+
+        resp = self.client.delete('/admin/profile', headers=self.admin)
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(app.extensions['profiler'].requests, {})
+
+    def test_kill_file(self):
+        """Does the kill file stop sampling?"""
+
+        open(app.config['PROFILER_KILL_FILE'], 'w').close()
+
+        self.client.get('/')
+
+        stats = self.client.get('/admin/profile/stats',
+                                headers=self.admin).get_json()
+        self.assertFalse(stats['enabled'])
+        self.assertEqual(stats['requests'], {})
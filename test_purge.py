@@ -0,0 +1,95 @@
+"""Deleted-user purge tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_purge.py
+
+
+# testing gives us a database of our own (it has to be imported before
+# our app, since that will connect to the database); every test runs in
+# a transaction that is rolled back afterwards
+
+from testing import DatabaseTestCase
+from models import db, User, Message, Follows, Likes, UserPurge
+from purge import purge_step, purge_user, pending_purges
+
+
+class PurgeTestCase(DatabaseTestCase):
+    """Test removing a deleted user's rows."""
+
+    def setUp(self):
+        """Create a deleted user with messages, likes and follows."""
+
+        super().setUp()
+
+        self.gone = User(username="gone", email="gone@test.com", password="x")
+        self.kept = User(username="kept", email="kept@test.com", password="x")
+        db.session.add_all([self.gone, self.kept])
+        db.session.commit()
+
+        Message.post_many(
+            {"user_id": self.gone.id, "text": f"gone {i}"} for i in range(7))
+        kept_msg = Message.post(self.kept.id, "kept")
+        db.session.commit()
+
+        gone_msg = Message.query.filter_by(user_id=self.gone.id).first()
+        Message.like(gone_msg.id, self.kept.id)
+        Message.like(kept_msg.id, self.gone.id)
+        self.gone.following.append(self.kept)
+        self.kept.following.append(self.gone)
+
+        self.gone.deleted_at = db.func.now()
+        db.session.add(UserPurge(user_id=self.gone.id))
+        db.session.commit()
+
+        self.gone_id = self.gone.id
+        self.kept_id = self.kept.id
+        self.user_ids = [self.gone_id, self.kept_id]
+
+    def test_purge_user(self):
+        """Does a purge remove every row of the deleted user only?"""
+
+        purge = pending_purges().one()
+        purge_user(purge, batch_size=3)
+
+        self.assertEqual(purge.stage, 'done')
+        self.assertIsNotNone(purge.finished_at)
+        self.assertEqual(pending_purges().count(), 0)
+
+        # 7 messages, 2 likes, 2 follows and the user itself
+        self.assertEqual(purge.rows_deleted, 12)
+
+        self.assertIsNone(User.query.get(self.gone_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id).count(), 0)
+        self.assertEqual(
+            Likes.query.filter(Likes.user_id.in_(self.user_ids)).count(), 0)
+        self.assertEqual(
+            Follows.query.filter(
+                Follows.user_following_id.in_(self.user_ids)).count(), 0)
+
+        self.assertIsNotNone(User.query.get(self.kept_id))
+        kept_msg = Message.query.filter_by(user_id=self.kept_id).one()
+        self.assertEqual(kept_msg.like_count, 0)
+
+    def test_purge_resumes(self):
+        """Does an interrupted purge pick up from its saved stage?"""
+
+        purge = pending_purges().one()
+
+        # Stop after a couple of batches, as if the worker died
+        while purge.stage != 'messages':
+            purge_step(purge, batch_size=3)
+            db.session.commit()
+
+        purge_step(purge, batch_size=3)
+        db.session.commit()
+        db.session.remove()
+
+        purge = pending_purges().one()
+        self.assertEqual(purge.stage, 'messages')
+        self.assertEqual(Message.query.filter_by(user_id=self.gone_id).count(), 4)
+
+        purge_user(purge, batch_size=3)
+
+        self.assertEqual(purge.rows_deleted, 12)
+        self.assertIsNone(User.query.get(self.gone_id))
@@ -0,0 +1,141 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from models import db, User
+from ratelimit import MemoryStore, parse_limit
+
+
+class RateLimitViewsTestCase(DatabaseTestCase):
+    """Test limiting logins and follows."""
+
+    def setUp(self):
+        """Turn rate limiting on, with small limits and empty buckets."""
+
+        super().setUp()
+
+        self._config = dict(app.config)
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMITS'] = {'warbler.login': '2/minute',
+                                    'warbler.add_follow': '1/hour'}
+        app.extensions.pop('ratelimit_store', None)
+
+        self.user = User.signup(username="limited", email="limited@test.com",
+                                password="password", image_url=None)
+        self.other = User.signup(username="followed",
+                                 email="followed@test.com",
+                                 password="password", image_url=None)
+        db.session.commit()
+
+        self.user_id, self.other_id = self.user.id, self.other.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Restore the app's config."""
+
+        app.config.clear()
+        app.config.update(self._config)
+        app.extensions.pop('ratelimit_store', None)
+
+        super().tearDown()
+
+    def login(self, ip='10.0.0.1'):
+        return self.client.post('/login',
+                                data={'username': 'limited',
+                                      'password': 'wrong'},
+                                environ_base={'REMOTE_ADDR': ip})
+
+    def test_login_limited(self):
+        """Is a third login attempt in a minute refused?"""
+
+        first = self.login()
+        self.assertEqual(first.headers['RateLimit-Limit'], '2')
+        self.assertEqual(first.headers['RateLimit-Remaining'], '1')
+
+        self.login()
+        resp = self.login()
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['RateLimit-Remaining'], '0')
+        self.assertGreater(int(resp.headers['Retry-After']), 0)
+
+    def test_per_ip(self):
+        """Does each address get a bucket of its own?"""
+
+        self.login()
+        self.login()
+
+        self.assertEqual(self.login(ip='10.0.0.2').status_code, 200)
+
+    def test_reads_unlimited(self):
+        """Are GETs of a limited endpoint left alone?"""
+
+        for _ in range(3):
+            resp = self.client.get('/login')
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('RateLimit-Limit', resp.headers)
+
+    def test_per_user(self):
+        """Are logged in users limited by account?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        first = self.client.post(f'/users/follow/{self.other_id}')
+        second = self.client.post(f'/users/follow/{self.other_id}',
+                                  environ_base={'REMOTE_ADDR': '10.9.9.9'})
+
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(second.status_code, 429)
+
+
+class TokenBucketTestCase(TestCase):
+    """Test the bucket arithmetic."""
+
+    def test_parse_limit(self):
+        """Are limits read as (burst, tokens per second)?"""
+
+        self.assertEqual(parse_limit('30/minute'), (30, 0.5))
+        self.assertRaises(ValueError, parse_limit, '30 per fortnight')
+
+    def test_refill(self):
+        """Do tokens come back at the limit's rate?"""
+
+        store = MemoryStore()
+
+        self.assertTrue(store.take('k', 1, 1000)[0])
+
+        # Wind the bucket's clock back instead of sleeping
+        tokens, last = store._buckets['k']
+        store._buckets['k'] = (tokens, last - 0.01)
+
+        self.assertTrue(store.take('k', 1, 1000)[0])
+        self.assertFalse(store.take('k', 1, 0.001)[0])
+
+    def test_prune(self):
+        """Are idle buckets, then the least recently used, dropped a few
+        at a time past max_buckets?"""
+
+        store = MemoryStore()
+        store.max_buckets, store.prune_batch = 4, 2
+
+        for key in 'abcd':
+            store.take(key, 5, 1)
+        store.take('a', 5, 1)
+
+        # 'b' has been idle for a day, 'c' is just the least recent
+        tokens, last = store._buckets['b']
+        store._buckets['b'] = (tokens, last - 24 * 60 * 60)
+
+        store.take('e', 5, 1)
+        self.assertEqual(list(store._buckets), ['c', 'd', 'a', 'e'])
+
+        store.take('f', 5, 1)
+        self.assertEqual(list(store._buckets), ['d', 'a', 'e', 'f'])
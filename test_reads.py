@@ -0,0 +1,84 @@
+"""Core read path tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_reads.py
+
+
+import pickle
+from datetime import timedelta
+
+from testing import DatabaseTestCase
+from models import db, Message, User
+import reads
+
+
+class ReadsTestCase(DatabaseTestCase):
+    """Test that the Core queries read what the models would."""
+
+    def setUp(self):
+        """Pick a few sample users who have messages."""
+
+        super().setUp()
+
+        self.user_ids = [user_id for (user_id,) in
+                         db.session.query(Message.user_id).distinct()
+                         .order_by(Message.user_id).limit(5)]
+
+    def test_feed(self):
+        """Does the feed match `Message.feed`, authors included?"""
+
+        for window in (None, timedelta(days=31)):
+            expected = Message.feed(self.user_ids, limit=20, window=window)
+            records = reads.feed(self.user_ids, limit=20, window=window)
+
+            self.assertEqual([r.id for r in records], [m.id for m in expected])
+            self.assertEqual(
+                [(r.text, r.timestamp, r.like_count, r.user.username)
+                 for r in records],
+                [(m.text, m.timestamp, m.like_count, m.user.username)
+                 for m in expected])
+
+        # One Author per author, shared by their messages
+        authors = {id(r.user) for r in reads.feed(self.user_ids)}
+        self.assertEqual(len(authors), len(self.user_ids))
+
+    def test_user_cards(self):
+        """Are deleted users left out, and searches applied?"""
+
+        user = User.query.get(self.user_ids[0])
+        user.deleted_at = db.func.now()
+        db.session.commit()
+
+        cards = reads.user_cards()
+        self.assertEqual(sorted(card.id for card in cards),
+                         sorted(u.id for u in User.active()))
+
+        search = User.query.get(self.user_ids[1]).username
+        self.assertIn(self.user_ids[1],
+                      [card.id for card in reads.user_cards(search)])
+
+    def test_profile(self):
+        """Does a profile carry its counts and messages?"""
+
+        user = User.query.get(self.user_ids[0])
+        profile = reads.profile(user.id)
+
+        self.assertEqual((profile.username, profile.bio, profile.location),
+                         (user.username, user.bio, user.location))
+        self.assertEqual(profile.stats.messages, len(user.messages))
+        self.assertEqual(profile.stats.likes, len(user.likes))
+        self.assertEqual([m.id for m in profile.messages],
+                         [m.id for m in Message.feed([user.id])])
+
+        self.assertIsNone(reads.profile(-1))
+
+    def test_records_pickle(self):
+        """Do records survive a round trip through pickle (Redis)?"""
+
+        profile = reads.profile(self.user_ids[0])
+        copy = pickle.loads(pickle.dumps(profile))
+
+        self.assertEqual(copy.username, profile.username)
+        self.assertEqual(copy.messages[0].user.id, profile.id)
+        self.assertFalse(hasattr(copy, '__dict__'))
@@ -0,0 +1,147 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from models import db, User
+from sessions import FilesystemStore, SQLiteStore, get_session_store
+
+
+class SessionViewsTestCase(DatabaseTestCase):
+    """Test logging in and out with server-side sessions."""
+
+    def setUp(self):
+        """Create a user to log in as."""
+
+        super().setUp()
+
+        self.user = User.signup(username="sessioned",
+                                email="sessioned@test.com",
+                                password="password", image_url=None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def login(self):
+        """Log in through the form; return the session cookie's value."""
+
+        resp = self.client.post('/login', data={'username': 'sessioned',
+                                                'password': 'password'})
+        cookie = resp.headers['Set-Cookie']
+
+        self.assertIn('HttpOnly', cookie)
+        return cookie.split(';')[0].split('=', 1)[1]
+
+    def test_cookie_is_opaque(self):
+        """Does the cookie hold a short id instead of the session data?"""
+
+        sid = self.login()
+
+        self.assertLessEqual(len(sid), 32)
+        self.assertNotIn('.', sid)
+
+        with app.app_context():
+            self.assertIsNotNone(get_session_store().load(sid))
+
+    def test_logged_in(self):
+        """Does the stored session identify the user?"""
+
+        self.login()
+        resp = self.client.get('/')
+
+        self.assertIn('@sessioned', resp.get_data(as_text=True))
+
+    def test_logout_revokes(self):
+        """Is the session id dead as soon as the user logs out?"""
+
+        sid = self.login()
+        self.client.get('/logout')
+
+        with app.app_context():
+            self.assertIsNone(get_session_store().load(sid))
+
+        # Replaying the old cookie doesn't log anyone in
+        self.client.set_cookie('localhost', app.session_cookie_name, sid)
+        resp = self.client.get('/')
+        self.assertNotIn('@sessioned', resp.get_data(as_text=True))
+
+    def test_login_regenerates(self):
+        """Does logging in replace a session id issued beforehand?"""
+
+        before = self.login()
+        after = self.login()
+
+        self.assertNotEqual(before, after)
+
+        with app.app_context():
+            self.assertIsNone(get_session_store().load(before))
+
+    def test_cookie_tampered(self):
+        """Are malformed session ids ignored?"""
+
+        self.client.set_cookie('localhost', app.session_cookie_name,
+                               '../../etc/passwd')
+        resp = self.client.get('/login')
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_not_a_session(self):
+        """Is a stored record that isn't a session's dict ignored?"""
+
+        with app.app_context():
+            get_session_store().save('notasessionnotasession', '[1, 2]',
+                                     time.time() + 60)
+
+        self.client.set_cookie('localhost', app.session_cookie_name,
+                               'notasessionnotasession')
+        resp = self.client.get('/login')
+
+        self.assertEqual(resp.status_code, 200)
+
+
+class SessionStoreTestCase(TestCase):
+    """Test the session stores themselves."""
+
+    def setUp(self):
+        """Make one of each local store in a scratch directory."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stores = [
+            SQLiteStore(os.path.join(self.tmp.name, 'sessions.db')),
+            FilesystemStore(os.path.join(self.tmp.name, 'sessions')),
+        ]
+
+    def tearDown(self):
+        """Remove the stores."""
+
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        """Can sessions be saved, loaded and deleted?"""
+
+        for store in self.stores:
+            store.save('abcdefghijklmnop', '{"a": 1}', time.time() + 60)
+            self.assertEqual(store.load('abcdefghijklmnop')[0], '{"a": 1}')
+
+            store.delete('abcdefghijklmnop')
+            self.assertIsNone(store.load('abcdefghijklmnop'))
+
+    def test_sweep(self):
+        """Are only expired sessions swept?"""
+
+        for store in self.stores:
+            store.save('expiredexpired00', '{}', time.time() - 1)
+            store.save('livelivelivelive', '{}', time.time() + 60)
+
+            self.assertIsNone(store.load('expiredexpired00'))
+            self.assertEqual(store.sweep(), 1)
+            self.assertIsNotNone(store.load('livelivelivelive'))
@@ -0,0 +1,381 @@
+"""Message and like sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+#
+# The shards are extra SQLite files, or Postgres databases when
+# TEST_DATABASE_URL is set (see testing.prepare_shards).
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import func, select
+
+from testing import DatabaseTestCase, prepare_shards
+from app import app, CURR_USER_KEY
+from models import db, Message, User, UserPurge
+from purge import purge_user
+import shards
+from shards import BUCKETS, ShardMap, Shards
+
+
+class ShardMapTestCase(TestCase):
+    """Test spreading buckets and moving as few as possible."""
+
+    def test_spread(self):
+        shard_map = ShardMap.spread(['a', 'b'])
+
+        self.assertEqual(shard_map.buckets.count('a'), BUCKETS // 2)
+        self.assertEqual(shard_map.shard_for(0), 'a')
+        self.assertEqual(shard_map.shard_for(BUCKETS + 1), 'b')
+        self.assertEqual(shard_map.group([0, 1, 2]), {'a': [0, 2], 'b': [1]})
+
+    def test_rebalance(self):
+        """Does adding a shard only move buckets onto it?"""
+
+        old = ShardMap.spread(['a', 'b'])
+        new = old.rebalance(['a', 'b', 'c'])
+        moves = old.moves(new)
+
+        self.assertEqual(set(moves), {('a', 'c'), ('b', 'c')})
+        self.assertEqual(sum(map(len, moves.values())),
+                         new.buckets.count('c'))
+        self.assertLessEqual(max(new.buckets.count(name) for name in 'abc')
+                             - min(new.buckets.count(name) for name in 'abc'),
+                             1)
+        self.assertEqual(new.indexes, {'a': 0, 'b': 1, 'c': 2})
+
+        # Retiring a shard keeps its index from ever being reused
+        retired = new.rebalance(['a', 'c'])
+        self.assertEqual(retired.names, ['a', 'c'])
+        self.assertEqual(retired.rebalance(['a', 'c', 'd']).indexes['d'], 3)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'map.json')
+            ShardMap.spread(['a', 'b'], first_id=500).save(path)
+
+            loaded = ShardMap.load(path)
+            self.assertEqual(loaded.buckets,
+                             ShardMap.spread(['a', 'b']).buckets)
+            self.assertEqual(loaded.first_id, 500)
+
+
+class ShardedTestCase(DatabaseTestCase):
+    """Test the app with messages and likes on two (then three) shards."""
+
+    def setUp(self):
+        """Turn sharding on, and sign up users on different shards."""
+
+        super().setUp()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.shards = Shards(prepare_shards(3),
+                             os.path.join(self.directory.name, 'map.json'))
+        for name in self.shards.urls:
+            shards.create_tables(self.shards.engine(name))
+        ShardMap.spread(['shard0', 'shard1'], first_id=10 ** 6).save(
+            self.shards.map_path)
+        app.extensions['shards'] = self.shards
+
+        self.context = app.app_context()
+        self.context.push()
+
+        # Two users in buckets that stay put when a third shard is added,
+        # two in buckets that move
+        self.ids = [BUCKETS * 5 + 2, BUCKETS * 5 + 3, BUCKETS - 2, BUCKETS - 1]
+        self.users = [User.signup(username=f"sharded{n}",
+                                  email=f"sharded{n}@test.com",
+                                  password="password", image_url=None)
+                      for n in range(4)]
+        for user, user_id in zip(self.users, self.ids):
+            user.id = user_id
+        db.session.commit()
+
+        # Everyone follows everyone
+        for user in self.users:
+            user.following = [other for other in self.users
+                              if other is not user]
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.context.pop()
+        del app.extensions['shards']
+        self.shards.dispose()
+        self.directory.cleanup()
+        super().tearDown()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        self.client.post('/messages/new', data={'text': text})
+
+    def count(self, name, table, **where):
+        query = select([func.count()]).select_from(table)
+        for column, value in where.items():
+            query = query.where(table.c[column] == value)
+
+        with self.shards.engine(name).connect() as conn:
+            return conn.execute(query).scalar()
+
+    def shard_of(self, user_id):
+        return self.shards.map.shard_for(user_id)
+
+    def message_ids(self):
+        ids = []
+        for name in self.shards.urls:
+            with self.shards.engine(name).connect() as conn:
+                ids += [row[0] for row in conn.execute(
+                    select([shards.messages.c.id]))]
+        return ids
+
+    def test_posts_on_author_shard(self):
+        """Do posts land on their author's shard, not in main?"""
+
+        before = Message.query.count()
+
+        for n, user_id in enumerate(self.ids):
+            self.post(user_id, f"warble {n} #sharded")
+
+        self.assertEqual(Message.query.count(), before)
+        for user_id in self.ids:
+            self.assertEqual(self.count(self.shard_of(user_id),
+                                        shards.messages, user_id=user_id), 1)
+
+        self.assertEqual(sum(self.count(name, shards.message_tags)
+                             for name in self.shards.urls), 4)
+        self.assertEqual(len(set(self.message_ids())), 4)
+        self.assertTrue(all(message_id >= 10 ** 6
+                            for message_id in self.message_ids()))
+
+    def test_home_fans_in(self):
+        """Does the home timeline merge every shard's messages, newest
+        first?"""
+
+        for n in range(8):
+            self.post(self.ids[n % 4], f"warble {n}")
+
+        self.login(self.ids[0])
+        html = self.client.get('/').get_data(as_text=True)
+
+        positions = [html.index(f"warble {n}<") for n in range(8)]
+        self.assertEqual(positions, sorted(positions, reverse=True))
+
+        self.assertEqual(
+            [m.text for m in shards.feed(self.ids, limit=3)],
+            ["warble 7", "warble 6", "warble 5"])
+
+    def test_likes_across_shards(self):
+        """Does a like go on the liker's shard and count on the author's?"""
+
+        author, fan = next((a, b) for a in self.ids for b in self.ids
+                           if self.shard_of(a) != self.shard_of(b))
+        self.post(author, "like me")
+        message_id, = self.message_ids()
+
+        self.login(fan)
+        self.client.post(f'/messages/{message_id}/like')
+        self.client.post(f'/messages/{message_id}/like')
+
+        self.assertEqual(self.count(self.shard_of(fan), shards.likes,
+                                    user_id=fan), 1)
+        self.assertEqual(shards.get_message(message_id).like_count, 1)
+        self.assertIn("like me",
+                      self.client.get(f'/users/{fan}/likes').get_data(
+                          as_text=True))
+
+        self.client.post(f'/messages/{message_id}/unlike')
+        self.assertEqual(shards.get_message(message_id).like_count, 0)
+
+    def test_message_page_and_delete(self):
+        """Are messages found by id, and deleted only by their author?"""
+
+        self.post(self.ids[0], "short-lived")
+        message_id, = self.message_ids()
+
+        self.login(self.ids[1])
+        self.client.post(f'/messages/{message_id}/like')
+        self.assertIn("short-lived",
+                      self.client.get(f'/messages/{message_id}')
+                      .get_data(as_text=True))
+
+        self.client.post(f'/messages/{message_id}/delete')
+        self.assertEqual(self.message_ids(), [message_id])
+
+        self.login(self.ids[0])
+        self.client.post(f'/messages/{message_id}/delete')
+        self.assertEqual(self.message_ids(), [])
+        self.assertEqual(sum(self.count(name, shards.likes)
+                             for name in self.shards.urls), 0)
+        self.assertEqual(
+            self.client.get(f'/messages/{message_id}').status_code, 404)
+
+    def test_profile(self):
+        self.post(self.ids[0], "on my profile")
+        self.login(self.ids[1])
+        self.client.post(f'/messages/{self.message_ids()[0]}/like')
+
+        user = shards.profile(self.ids[1])
+        self.assertEqual((user.stats.messages, user.stats.likes), (0, 1))
+        self.assertEqual(
+            [m.text for m in shards.profile(self.ids[0]).messages],
+            ["on my profile"])
+
+    def test_rebalance(self):
+        """After moving buckets to a new shard, is everything where the
+        new map says, and still counted right?"""
+
+        for n in range(8):
+            self.post(self.ids[n % 4], f"warble {n}")
+        for user_id in self.ids:
+            self.login(user_id)
+            for message_id in self.message_ids():
+                self.client.post(f'/messages/{message_id}/like')
+
+        moves = shards.rebalance(['shard0', 'shard1', 'shard2'], pause=0)
+        self.assertTrue(all(target == 'shard2' for _, target in moves))
+        self.assertEqual([self.shard_of(user_id) for user_id in self.ids],
+                         ['shard0', 'shard1', 'shard2', 'shard2'])
+
+        for user_id in self.ids:
+            name = self.shard_of(user_id)
+            self.assertEqual(self.count(name, shards.messages,
+                                        user_id=user_id), 2)
+            self.assertEqual(self.count(name, shards.likes,
+                                        user_id=user_id), 8)
+
+        self.assertEqual(len(self.message_ids()), 8)
+        self.assertEqual([m.like_count for m in shards.feed(self.ids)],
+                         [4] * 8)
+        self.assertEqual(self.shards.map.moving, frozenset())
+
+    def test_moving_read_only(self):
+        """Are writes by users whose bucket is moving refused?"""
+
+        mover, stayer = self.ids[3], self.ids[0]
+        self.post(mover, "before the move")
+        message_id, = self.message_ids()
+
+        self.shards.map.freeze([mover % BUCKETS]).save(self.shards.map_path)
+        self.shards.reload_map()
+
+        self.login(mover)
+        resp = self.client.post('/messages/new', data={'text': "lost"})
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '5')
+        self.assertEqual(self.client.post(
+            f'/messages/{message_id}/delete').status_code, 503)
+
+        self.login(stayer)
+        self.assertEqual(self.client.post(
+            f'/messages/{message_id}/like').status_code, 503)
+
+        self.post(stayer, "not moving")
+        self.assertEqual(len(self.message_ids()), 2)
+        self.assertEqual(self.count(self.shard_of(stayer), shards.likes), 0)
+
+    def test_rebalance_fails(self):
+        """Does a move that fails leave the buckets where they were, and
+        writable?"""
+
+        def copy_rows(*args):
+            raise OSError("shard2 is down")
+
+        copy, shards.copy_rows = shards.copy_rows, copy_rows
+        try:
+            with self.assertRaises(OSError):
+                shards.rebalance(['shard0', 'shard1', 'shard2'], pause=0)
+        finally:
+            shards.copy_rows = copy
+
+        self.assertEqual(self.shards.map.names, ['shard0', 'shard1'])
+        self.assertEqual(self.shards.map.moving, frozenset())
+
+    def test_reconcile_likes(self):
+        self.post(self.ids[0], "miscounted")
+        message_id, = self.message_ids()
+
+        with self.shards.engine(self.shard_of(self.ids[0])).begin() as conn:
+            conn.execute(shards.messages.update().values(like_count=5))
+
+        self.assertEqual(shards.reconcile_likes(), 1)
+        self.assertEqual(shards.get_message(message_id).like_count, 0)
+
+    def test_tags_and_mentions(self):
+        """Are tag and mention pages read from every shard?"""
+
+        self.post(self.ids[0], "#sharded by @sharded1")
+        self.post(self.ids[1], "#sharded too")
+        self.post(self.ids[2], "#elsewhere")
+
+        html = self.client.get('/tags/sharded').get_data(as_text=True)
+        self.assertLess(html.index("too"), html.index("by @"))
+        self.assertNotIn("elsewhere", html)
+
+        messages, before = shards.tagged(shards.message_tags, 'tag',
+                                         'sharded', None, 1)
+        self.assertEqual([m.text for m in messages], ["#sharded too"])
+        messages, before = shards.tagged(shards.message_tags, 'tag',
+                                         'sharded', before, 1)
+        self.assertEqual([m.text for m in messages],
+                         ["#sharded by @sharded1"])
+        self.assertIsNone(before)
+
+        self.assertIn("by @sharded1", self.client.get(
+            f'/users/{self.ids[1]}/mentions').get_data(as_text=True))
+
+    def test_purge(self):
+        """Does purging a user delete their rows on the shards, and their
+        likes from the counts?"""
+
+        gone, other = self.ids[0], self.ids[1]
+        self.post(gone, "gone #soon")
+        self.post(other, "staying")
+        gone_message, other_message = sorted(
+            self.message_ids(),
+            key=lambda message_id: shards.get_message(message_id).text)
+
+        self.login(gone)
+        self.client.post(f'/messages/{other_message}/like')
+        self.login(other)
+        self.client.post(f'/messages/{gone_message}/like')
+
+        purge = UserPurge(user_id=gone)
+        db.session.add(purge)
+        db.session.commit()
+        purge_user(purge, batch_size=1)
+
+        self.assertEqual(self.message_ids(), [other_message])
+        self.assertEqual(shards.get_message(other_message).like_count, 0)
+        self.assertEqual(sum(self.count(name, table)
+                             for name in self.shards.urls
+                             for table in (shards.likes,
+                                           shards.message_tags)), 0)
+
+    def test_export(self):
+        """Are messages and likes exported from the user's shard?"""
+
+        self.post(self.ids[0], "exported")
+        self.login(self.ids[1])
+        self.client.post(f'/messages/{self.message_ids()[0]}/like')
+
+        self.login(self.ids[0])
+        types = [json.loads(line)['type'] for line in
+                 self.client.get(f'/users/{self.ids[0]}/export')
+                 .get_data(as_text=True).splitlines()]
+        self.assertEqual(types, ['message'] + ['following'] * 3
+                         + ['follower'] * 3)
+
+        self.login(self.ids[1])
+        self.assertIn('"type": "like"',
+                      self.client.get(f'/users/{self.ids[1]}/export')
+                      .get_data(as_text=True))
@@ -0,0 +1,126 @@
+"""Tag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+from unittest import TestCase
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from models import db, Mention, Message, MessageTag, User
+from tags import backfill_chunk, linkify_tags, parse_mentions, parse_tags
+
+
+class ParseTestCase(TestCase):
+    """Test finding tags and mentions in text."""
+
+    def test_parse_tags(self):
+        """Are tags found, lowercased and deduplicated?"""
+
+        self.assertEqual(parse_tags("#Flask and #flask, #py3! not#this ##no"),
+                         {'flask', 'py3'})
+
+    def test_parse_mentions(self):
+        """Are mentions found, but not email addresses?"""
+
+        self.assertEqual(parse_mentions("hi @ann and @bob_2, mail x@y.com"),
+                         {'ann', 'bob_2'})
+
+    def test_linkify_tags(self):
+        """Are tags linked and everything else escaped?"""
+
+        self.assertEqual(
+            linkify_tags("<b>#Hi</b> it's"),
+            '&lt;b&gt;<a href="/tags/hi">#Hi</a>&lt;/b&gt; it&#39;s')
+
+
+class TagViewsTestCase(DatabaseTestCase):
+    """Test indexing posted messages and the tag and mention pages."""
+
+    def setUp(self):
+        """Create a poster and a user to mention."""
+
+        super().setUp()
+
+        self.poster = User.signup(username="poster", email="poster@test.com",
+                                  password="password", image_url=None)
+        self.famous = User.signup(username="famous", email="famous@test.com",
+                                  password="password", image_url=None)
+        db.session.commit()
+
+        self.poster_id, self.famous_id = self.poster.id, self.famous.id
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.poster_id
+
+    def post(self, text):
+        self.client.post('/messages/new', data={'text': text})
+        return Message.query.filter_by(text=text).one().id
+
+    def test_index_on_post(self):
+        """Does posting record the message's tags and mentions?"""
+
+        message_id = self.post("#Hello @famous and @nobody")
+
+        self.assertEqual(
+            [t.tag for t in MessageTag.query.filter_by(message_id=message_id)],
+            ['hello'])
+        self.assertEqual(
+            [m.user_id for m in Mention.query.filter_by(message_id=message_id)],
+            [self.famous_id])
+
+    def test_tag_page(self):
+        """Does /tags/<tag> list just the tagged messages?"""
+
+        self.post("all about #warbler")
+        self.post("something else")
+
+        resp = self.client.get('/tags/Warbler')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('all about <a href="/tags/warbler">#warbler</a>', html)
+        self.assertNotIn('something else', html)
+
+    def test_mentions_paginated(self):
+        """Do mention pages go newest first, a page at a time?"""
+
+        app.config['TAGS_PAGE_SIZE'] = 2
+        self.addCleanup(app.config.__setitem__, 'TAGS_PAGE_SIZE', 50)
+
+        ids = [self.post(f"@famous number {n}") for n in range(3)]
+
+        first = self.client.get(f'/users/{self.famous_id}/mentions')
+        html = first.get_data(as_text=True)
+
+        self.assertIn('number 2', html)
+        self.assertIn('number 1', html)
+        self.assertNotIn('number 0', html)
+        self.assertIn(f'?before={ids[1]}', html)
+
+        second = self.client.get(
+            f'/users/{self.famous_id}/mentions?before={ids[1]}')
+        html = second.get_data(as_text=True)
+
+        self.assertIn('number 0', html)
+        self.assertNotIn('?before=', html)
+
+    def test_backfill(self):
+        """Does the backfill index messages posted without indexing?"""
+
+        Message.post_many([{'user_id': self.poster_id,
+                            'text': "#old news for @famous"}])
+        db.session.commit()
+        message_id = Message.query.filter_by(text="#old news for @famous").one().id
+
+        # Twice, to show re-running a chunk is harmless
+        for _ in range(2):
+            self.assertEqual(
+                backfill_chunk(self._connection, message_id, message_id), 1)
+
+        self.assertEqual(MessageTag.query.filter_by(tag='old').count(), 1)
+        self.assertEqual(Mention.query.filter_by(user_id=self.famous_id).count(), 1)
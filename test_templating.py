@@ -0,0 +1,63 @@
+"""Template precompilation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_templating.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from testing import DatabaseTestCase  # noqa: F401 (sets up the database)
+from app import app
+from templating import AtomicBytecodeCache, template_names, warm_up
+
+
+class TemplateCacheTestCase(TestCase):
+    """Test compiling templates ahead of time."""
+
+    def setUp(self):
+        """Make an empty bytecode cache."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def worker_env(self):
+        """A fresh copy of the app's environment, using the empty cache."""
+
+        return app.jinja_env.overlay(
+            bytecode_cache=AtomicBytecodeCache(self.tmp.name),
+            cache_size=400)
+
+    def cache_files(self):
+        return {name: os.path.getmtime(os.path.join(self.tmp.name, name))
+                for name in os.listdir(self.tmp.name)}
+
+    def test_compile_command(self):
+        """Does the command compile every template?"""
+
+        result = app.test_cli_runner().invoke(args=['templates', 'compile'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(f"Compiled {len(template_names(app.jinja_env))} "
+                      f"templates", result.output)
+        self.assertIn('users/show.html', template_names(app.jinja_env))
+
+    def test_warm_up_from_cache(self):
+        """Does a new worker load every template, from the cache?"""
+
+        names = warm_up(self.worker_env())
+        written = self.cache_files()
+
+        self.assertEqual(len(written), len(names))
+
+        worker = self.worker_env()
+        warm_up(worker)
+
+        self.assertEqual(len(worker.cache), len(names))
+
+        # Nothing was recompiled and written back
+        self.assertEqual(self.cache_files(), written)
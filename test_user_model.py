@@ -5,39 +5,24 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
 from sqlalchemy import exc
-from models import db, User, Message, Follows
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-# Now we can import app
+# testing gives us a database of our own (it has to be imported before
+# our app, since that will connect to the database); every test runs in
+# a transaction that is rolled back afterwards
 
+from testing import DatabaseTestCase
 from app import app
-app.config['TESTING'] = True
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
+from models import db, User
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Test views for Users."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
+        super().setUp()
 
         u = User.signup(
             email="test@test.com",
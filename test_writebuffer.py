@@ -0,0 +1,236 @@
+"""Write-behind buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writebuffer.py
+
+
+import json
+import os
+import tempfile
+import time
+
+from testing import DatabaseTestCase
+from app import app, CURR_USER_KEY
+from models import db, BufferedWrite, Follows, Likes, Message, User
+from sessions import get_session_store
+from writebuffer import NOTES_COOKIE, WriteBuffer, forget_written, notes_key
+
+
+class WriteBufferTestCase(DatabaseTestCase):
+    """Test buffering likes and follows, and writing them in batches."""
+
+    def setUp(self):
+        """A buffer that only flushes when told to, and two users."""
+
+        super().setUp()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.buffer = WriteBuffer(app, self.directory.name, window=0)
+        app.extensions['write_buffer'] = self.buffer
+
+        self.fan = User.signup(username="fan", email="fan@test.com",
+                               password="password", image_url=None)
+        self.author = User.signup(username="author", email="au@test.com",
+                                  password="password", image_url=None)
+        db.session.commit()
+
+        message = Message.post(self.author.id, "buffered")
+        db.session.commit()
+
+        self.fan_id, self.author_id = self.fan.id, self.author.id
+        self.message_id = message.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+    def tearDown(self):
+        del app.extensions['write_buffer']
+        self.buffer.close()
+        self.directory.cleanup()
+        super().tearDown()
+
+    def flush(self):
+        with app.app_context():
+            return self.buffer.flush()
+
+    def likes(self):
+        return Likes.query.filter_by(user_id=self.fan_id).count()
+
+    def like_count(self):
+        return Message.query.get(self.message_id).like_count
+
+    def follows(self):
+        return Follows.query.filter_by(
+            user_following_id=self.fan_id,
+            user_being_followed_id=self.author_id).count() == 1
+
+    def journals(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def orphan(self, *changes):
+        """A dead process's journal of `changes`, taken over."""
+
+        path = os.path.join(self.directory.name, '1-000001.journal')
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(change) + '\n' for change in changes)
+
+        with app.app_context():
+            return self.buffer.recover()
+
+    def test_coalesce_likes(self):
+        """Are toggles of one like written as one change, and seen by the
+        user before that?"""
+
+        for action in ('like', 'unlike', 'like'):
+            self.client.post(f'/messages/{self.message_id}/{action}')
+
+        self.assertEqual(self.likes(), 0)
+        self.assertEqual({key: on for key, (on, _)
+                          in self.buffer.pending.items()},
+                         {('like', self.fan_id, self.message_id): True})
+        self.assertIn("buffered", self.client.get(
+            f'/users/{self.fan_id}/likes').get_data(as_text=True))
+
+        journal, = self.journals()
+        with open(os.path.join(self.directory.name, journal)) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        self.assertEqual(self.flush(), 1)
+        self.assertEqual(self.likes(), 1)
+        self.assertEqual(self.like_count(), 1)
+        self.assertEqual(self.buffer.pending, {})
+        self.assertNotIn(journal, self.journals())
+
+    def test_like_count(self):
+        """Is like_count moved only by likes really added or removed?"""
+
+        Message.like(self.message_id, self.fan_id)
+        db.session.commit()
+
+        # Already liked: nothing to add
+        self.client.post(f'/messages/{self.message_id}/like')
+        self.flush()
+        self.assertEqual((self.likes(), self.like_count()), (1, 1))
+
+        self.client.post(f'/messages/{self.message_id}/unlike')
+        self.flush()
+        self.client.post(f'/messages/{self.message_id}/unlike')
+        self.flush()
+        self.assertEqual((self.likes(), self.like_count()), (0, 0))
+
+    def test_follow(self):
+        self.client.post(f'/users/follow/{self.author_id}')
+
+        self.assertFalse(self.follows())
+        self.assertIn("@author", self.client.get(
+            f'/users/{self.fan_id}/following').get_data(as_text=True))
+
+        self.flush()
+        self.assertTrue(self.follows())
+
+        self.client.post(f'/users/stop-following/{self.author_id}')
+        self.assertNotIn("@author", self.client.get(
+            f'/users/{self.fan_id}/following').get_data(as_text=True))
+
+        self.flush()
+        self.assertFalse(self.follows())
+
+    def test_notes_expire(self):
+        """Are old session notes ignored (the writes are in by then)?"""
+
+        app.config['WRITEBUFFER_READ_WINDOW'] = 0.01
+        try:
+            self.client.post(f'/messages/{self.message_id}/like')
+            time.sleep(0.02)
+            html = self.client.get(
+                f'/users/{self.fan_id}/likes').get_data(as_text=True)
+        finally:
+            app.config['WRITEBUFFER_READ_WINDOW'] = 30
+
+        self.assertNotIn("buffered", html)
+        with app.app_context():
+            self.assertIsNone(get_session_store().load(
+                notes_key(self.fan_id)))
+
+    def test_notes_outside_session(self):
+        """Are the notes seen by a worker holding a copy of the session
+        from before the toggle?"""
+
+        self.client.get('/')
+        interface = app.session_interface
+        with interface._lock:
+            cached = dict(interface._cache)
+
+        self.client.post(f'/messages/{self.message_id}/like')
+
+        with interface._lock:
+            interface._cache.update(cached)
+
+        self.assertIn("buffered", self.client.get(
+            f'/users/{self.fan_id}/likes').get_data(as_text=True))
+        self.assertIn(NOTES_COOKIE, {cookie.name for cookie
+                                     in self.client.cookie_jar})
+
+    def test_notes_not_a_session(self):
+        """Can't the notes' key be passed off as a session id?"""
+
+        self.client.post(f'/messages/{self.message_id}/like')
+
+        other = app.test_client()
+        other.set_cookie('localhost', app.session_cookie_name,
+                         notes_key(self.fan_id))
+        resp = other.get('/')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("@fan", resp.get_data(as_text=True))
+
+    def test_recover(self):
+        """Are a dead process's journaled changes taken over?"""
+
+        self.client.post(f'/messages/{self.message_id}/like')
+
+        # Another process's journal, no longer locked by anyone; the last
+        # line was torn by the crash
+        self.assertEqual(self.orphan(
+            ['follow', self.fan_id, self.author_id, True, time.time()],
+            '["like", 1'), 1)
+
+        self.assertNotIn('1-000001.journal', self.journals())
+        self.assertEqual(self.flush(), 2)
+        self.assertEqual(self.likes(), 1)
+        self.assertTrue(self.follows())
+
+    def test_older_change_skipped(self):
+        """Does a toggle written late (from a dead process's journal here)
+        leave a newer one in place?"""
+
+        self.client.post(f'/messages/{self.message_id}/like')
+        made_at = self.buffer.pending[
+            'like', self.fan_id, self.message_id][1]
+        self.flush()
+
+        self.orphan(['like', self.fan_id, self.message_id, False,
+                     made_at - 1])
+        self.assertEqual(self.flush(), 1)
+        self.assertEqual((self.likes(), self.like_count()), (1, 1))
+
+        self.orphan(['like', self.fan_id, self.message_id, False,
+                     made_at + 1])
+        self.flush()
+        self.assertEqual((self.likes(), self.like_count()), (0, 0))
+
+        with app.app_context():
+            self.assertEqual(forget_written(made_at + 2), 1)
+        self.assertEqual(BufferedWrite.query.count(), 0)
+
+    def test_deleted_message(self):
+        """Is a pending like of a since-deleted message dropped?"""
+
+        self.client.post(f'/messages/{self.message_id}/like')
+        Message.query.filter_by(id=self.message_id).delete()
+        db.session.commit()
+
+        self.assertEqual(self.flush(), 1)
+        self.assertEqual(self.likes(), 0)
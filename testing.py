@@ -0,0 +1,339 @@
+"""Shared database setup for the test suite.
+
+Import this module before anything that imports `app`; it points the app
+at a database of its own for this test process:
+
+    from testing import DatabaseTestCase
+
+Each test process (each pytest-xdist worker, or a plain unittest run)
+gets a private copy of a fixture snapshot: the schema plus the sample
+data in generator/*.csv. The snapshot is built once, by whichever process
+gets there first, and reused until models.py or the CSVs change.
+
+By default the databases are SQLite files in the temp directory. Set
+TEST_DATABASE_URL (e.g. postgresql:///warbler-test) to use Postgres; the
+snapshot is then a template database that each worker is cloned from.
+
+`DatabaseTestCase` runs every test inside a transaction that is rolled
+back afterwards, so tests never need to delete rows. Code under test can
+commit freely; commits only release a savepoint.
+
+Run the suite across all cores with:
+
+    python -m pytest -n auto
+"""
+
+import csv
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, orm
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORKER = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+
+SNAPSHOT_SOURCES = ['models.py', 'generator/users.csv',
+                    'generator/messages.csv', 'generator/follows.csv']
+
+
+def snapshot_digest():
+    """Fingerprint of everything the fixture snapshot is built from."""
+
+    digest = hashlib.sha1()
+
+    for name in SNAPSHOT_SOURCES:
+        with open(os.path.join(ROOT, name), 'rb') as source:
+            digest.update(source.read())
+
+    return digest.hexdigest()[:12]
+
+
+def read_csv(name, **converters):
+    """Rows of generator/`name`.csv as dicts, with columns converted."""
+
+    with open(os.path.join(ROOT, 'generator', f'{name}.csv')) as source:
+        rows = list(csv.DictReader(source))
+
+    for row in rows:
+        for column, convert in converters.items():
+            row[column] = convert(row[column])
+
+    return rows
+
+
+def seed(engine):
+    """Create the schema on `engine` and load the sample data."""
+
+    from models import db, Follows, Message, User
+
+    db.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), read_csv('users'))
+        conn.execute(Message.__table__.insert(),
+                     read_csv('messages', user_id=int,
+                              timestamp=datetime.fromisoformat))
+        conn.execute(Follows.__table__.insert(),
+                     read_csv('follows', user_being_followed_id=int,
+                              user_following_id=int))
+
+
+def prepare_sqlite():
+    """Copy the SQLite snapshot to this worker's database; return its URL."""
+
+    tmp = tempfile.gettempdir()
+    snapshot = os.path.join(tmp, f'warbler-test-{snapshot_digest()}.db')
+    database = os.path.join(tmp, f'warbler-test-{WORKER}.db')
+
+    with open(f'{snapshot}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if not os.path.exists(snapshot):
+            building = f'{snapshot}.{os.getpid()}'
+            engine = create_engine(f'sqlite:///{building}')
+            seed(engine)
+            engine.dispose()
+            os.rename(building, snapshot)
+
+    shutil.copyfile(snapshot, database)
+    return f'sqlite:///{database}'
+
+
+def prepare_postgres(base_url):
+    """Clone this worker's database from the Postgres snapshot.
+
+    The snapshot is a template database named after `base_url`. Returns
+    the worker database's URL.
+    """
+
+    base, _, name = base_url.rpartition('/')
+    template = f'{name}-{snapshot_digest()}'
+    database = f'{name}-{WORKER}'
+
+    engine = create_engine(f'{base}/postgres',
+                           isolation_level='AUTOCOMMIT')
+
+    with engine.connect() as conn:
+        conn.execute("SELECT pg_advisory_lock(hashtext(%s))", template)
+
+        exists = conn.execute("SELECT 1 FROM pg_database WHERE datname = %s",
+                              template).scalar()
+
+        if not exists:
+            conn.execute(f'CREATE DATABASE "{template}"')
+            template_engine = create_engine(f'{base}/{template}')
+            seed(template_engine)
+            template_engine.dispose()
+
+        conn.execute(f'DROP DATABASE IF EXISTS "{database}"')
+        conn.execute(f'CREATE DATABASE "{database}" TEMPLATE "{template}"')
+        conn.execute("SELECT pg_advisory_unlock(hashtext(%s))", template)
+
+    engine.dispose()
+    return f'{base}/{database}'
+
+
+def sqlite_savepoints(engine):
+    """Make pysqlite emit BEGIN itself, so SAVEPOINTs behave."""
+
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(conn):
+        conn.execute("BEGIN")
+
+
+# Compiled templates go to a cache of this worker's own
+os.environ['TEMPLATE_CACHE_DIR'] = os.path.join(
+    tempfile.gettempdir(), f'warbler-jinja-{WORKER}')
+
+
+def prepare_shards(count):
+    """Empty databases for `count` shards; return {name: URL}.
+
+    SQLite files in the temp directory, or Postgres databases named after
+    TEST_DATABASE_URL's when that's set. Any left from an earlier test
+    are dropped first.
+    """
+
+    names = [f'shard{i}' for i in range(count)]
+    base_url = os.environ.get('TEST_DATABASE_URL')
+
+    if not base_url:
+        urls = {}
+        for name in names:
+            path = os.path.join(tempfile.gettempdir(),
+                                f'warbler-test-{WORKER}-{name}.db')
+            if os.path.exists(path):
+                os.remove(path)
+            urls[name] = f'sqlite:///{path}'
+        return urls
+
+    base, _, database = base_url.rpartition('/')
+    engine = create_engine(f'{base}/postgres', isolation_level='AUTOCOMMIT')
+
+    urls = {}
+
+    with engine.connect() as conn:
+        for name in names:
+            shard = f'{database}-{WORKER}-{name}'
+            conn.execute(f'DROP DATABASE IF EXISTS "{shard}"')
+            conn.execute(f'CREATE DATABASE "{shard}"')
+            urls[name] = f'{base}/{shard}'
+
+    engine.dispose()
+    return urls
+
+
+if os.environ.get('TEST_DATABASE_URL'):
+    os.environ['DATABASE_URL'] = prepare_postgres(
+        os.environ['TEST_DATABASE_URL'])
+else:
+    os.environ['DATABASE_URL'] = prepare_sqlite()
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+
+app.config['TESTING'] = True
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Cheap password hashes; real ones cost ~250ms each
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+# A session store per worker, without the background sweeper
+app.config['SESSION_STORE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.gettempdir(), f'warbler-sessions-{WORKER}.db')
+app.config['SESSION_SWEEP_INTERVAL'] = 0
+
+# Tests post far faster than any user; test_ratelimit.py turns this back on
+app.config['RATELIMIT_ENABLED'] = False
+
+if db.engine.dialect.name == 'sqlite':
+    sqlite_savepoints(db.engine)
+
+
+class SavepointScopedSession(orm.scoped_session):
+    """scoped_session that flags its session as closing on remove().
+
+    Lets the savepoint listener tell "the test committed" apart from "the
+    request ended", which both end the current savepoint.
+    """
+
+    def remove(self):
+        if self.registry.has():
+            self.registry().info['closing'] = True
+
+        super().remove()
+
+
+class DatabaseTestCase(TestCase):
+    """TestCase whose tests each run in a rolled-back transaction.
+
+    `db.session` is swapped for one bound to a single connection with an
+    open transaction. Each session works inside a SAVEPOINT that is
+    restarted whenever the code under test commits or rolls back, and the
+    whole transaction is rolled back after the test.
+    """
+
+    def setUp(self):
+        """Open the per-test transaction and bind db.session to it."""
+
+        # Cached timelines from earlier tests are of rolled-back data
+        app.extensions['feed_cache'].clear()
+
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+        self._scoped_session = db.session
+
+        maker = db.create_session({'bind': self._connection, 'binds': {}})
+
+        @event.listens_for(maker, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if session.info.get('closing'):
+                return
+
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        def start_session():
+            session = maker()
+            session.begin_nested()
+            return session
+
+        db.session = SavepointScopedSession(
+            start_session,
+            scopefunc=self._scoped_session.registry.scopefunc)
+
+    def tearDown(self):
+        """Throw away everything the test wrote."""
+
+        db.session.remove()
+        db.session = self._scoped_session
+
+        # Closing the connection rolls back its transaction, along with any
+        # savepoints that sessions closed mid-test left open
+        self._connection.close()
+
+    def seed_crowd(self, user_id, count):
+        """Give user `user_id` `count` followers, follows and liked
+        messages (of `count` new users), for memory budget tests."""
+
+        from models import Follows, Likes, Message, User
+
+        conn = db.session.connection()
+        prefix = f'crowd{user_id}-'
+
+        conn.execute(User.__table__.insert(), [
+            {'username': f'{prefix}{n}', 'email': f'{prefix}{n}@test.com',
+             'password': 'x'} for n in range(count)])
+        crowd = [crowd_id for (crowd_id,) in conn.execute(
+            db.select([User.id]).where(User.username.like(f'{prefix}%')))]
+
+        conn.execute(Follows.__table__.insert(), [
+            row for crowd_id in crowd for row in (
+                {'user_being_followed_id': user_id,
+                 'user_following_id': crowd_id},
+                {'user_being_followed_id': crowd_id,
+                 'user_following_id': user_id})])
+
+        conn.execute(Message.__table__.insert(), [
+            {'text': f"warble {crowd_id}", 'user_id': crowd_id,
+             'like_count': 1} for crowd_id in crowd])
+        conn.execute(Likes.__table__.insert().from_select(
+            ['user_id', 'message_id'],
+            db.select([db.literal(user_id), Message.id])
+            .where(Message.user_id.in_(crowd))))
+
+    def assertMemoryBudget(self, client, path, peak_bytes, objects=None):
+        """Fail if GET `path` peaks over `peak_bytes` of Python
+        allocations, or loads over `objects` ORM instances."""
+
+        import memory
+
+        with memory.measure(snapshot_bytes=peak_bytes) as usage:
+            status = client.get(path).status_code
+
+        self.assertEqual(status, 200, path)
+
+        loaded = sum(usage.objects.values())
+        if usage.peak > peak_bytes or (objects is not None
+                                       and loaded > objects):
+            self.fail(
+                f"GET {path} peaked at {usage.peak} bytes (budget "
+                f"{peak_bytes}) and loaded {loaded} objects (budget "
+                f"{objects}): {dict(usage.objects)}\n"
+                + "\n".join(f"  {size:>10} {site}"
+                            for site, size in usage.sites))
@@ -0,0 +1,595 @@
+"""Write-behind buffer for likes and follows.
+
+With WRITEBUFFER_ENABLED, liking, unliking, following and unfollowing
+don't write to the database in the request. Each toggle is appended,
+with the time it was made, to this process's journal (a file under
+WRITEBUFFER_DIRECTORY) and kept in memory by (kind, user, target), so a
+burst of toggles of one like is one pending change: the last. Every
+WRITEBUFFER_WINDOW seconds, or sooner once WRITEBUFFER_MAX_PENDING pile
+up, a background thread writes them all in one transaction -- a batched
+insert and a batched delete per table, and one like_count update per
+message by the likes it really gained or lost -- then tells the follow
+graph and the feed cache, as the unbuffered views do.
+
+Toggles of one like made on different workers can be flushed in either
+order, so the time of the last one written is kept per (kind, user,
+target) in buffered_writes, and a change made before it is skipped. The
+times come from the workers' clocks: hosts sharing a database need them
+in sync. They're kept for WRITEBUFFER_HISTORY seconds.
+
+Each process holds an flock on its journal, so a journal nobody holds is
+a dead process's: the next flush anywhere (or `flask writebuffer flush`)
+takes its changes over, skipping those already overtaken as above.
+
+The user's next request may go to another worker, so each toggle is
+also noted for WRITEBUFFER_READ_WINDOW seconds, in the session store
+under the user's id, and a cookie tells any worker to look there. The
+notes aren't in the session itself: workers cache sessions
+(SESSION_CACHE_TTL), and a stale copy would hide them, or, saved, drop
+them. Their like and follow buttons, home timeline and own likes and
+following pages read through the notes; counts catch up at the next
+flush.
+
+Likes of sharded messages (shards.py) aren't buffered.
+"""
+
+import atexit
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+import click
+from flask import (
+    after_this_request, current_app, g, has_request_context, request)
+from flask.cli import AppGroup
+
+import feedcache
+import graph
+from models import db, BufferedWrite, Follows, Likes, Message, User
+from sessions import get_session_store
+
+writebuffer_cli = AppGroup('writebuffer',
+                           help='Write buffered likes and follows.')
+
+# Cookie telling every worker the user has toggles that may be unwritten
+NOTES_COOKIE = 'pending_writes'
+
+# How often each worker forgets the times of old toggles, in seconds
+PRUNE_INTERVAL = 3600
+
+
+class WriteBuffer:
+    """Pending toggles of this process, journaled."""
+
+    def __init__(self, app, directory, window=0.5, max_pending=1000,
+                 fsync=False):
+        self.app = app
+        self.directory = directory
+        self.window = window
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.pending = {}
+        self._journal = None
+        self._serial = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def _forked(self):
+        # First use in this process (gunicorn forks after import): the
+        # parent's pending changes and journal are the parent's
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self.pending = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self._journal = self._open_journal()
+        atexit.register(self.close)
+
+        if self.window:
+            threading.Thread(target=self._run, name='write-buffer',
+                             daemon=True).start()
+
+    def _open_journal(self):
+        self._serial += 1
+        journal = open(os.path.join(
+            self.directory, f"{os.getpid()}-{self._serial:06d}.journal"), 'a')
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        return journal
+
+    def _record(self, changes):
+        """Journal `changes`, [((kind, user, target), (on, made at))], and
+        make them pending unless a later change of theirs already is."""
+
+        self._journal.write(''.join(
+            json.dumps([*key, *change]) + '\n' for key, change in changes))
+        self._journal.flush()
+
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+        for key, change in changes:
+            if key not in self.pending or self.pending[key][1] <= change[1]:
+                self.pending[key] = change
+
+    def toggle(self, kind, user_id, target_id, on):
+        """Journal that `user_id` does (or, `on` false, doesn't) like or
+        follow `target_id`."""
+
+        with self._lock:
+            self._forked()
+            self._record([((kind, user_id, target_id), (on, time.time()))])
+            full = len(self.pending) >= self.max_pending
+
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write the pending changes; returns how many there were."""
+
+        with self._flush_lock:
+            with self._lock:
+                self._forked()
+                changes, self.pending = self.pending, {}
+
+                if not changes:
+                    return 0
+
+                journal, self._journal = self._journal, self._open_journal()
+
+            try:
+                written = write_changes(changes)
+            except Exception:
+                # Back in line for the next flush (a unique violation
+                # from a flush elsewhere included: then they're found
+                # written), unless toggled again meanwhile
+                with self._lock:
+                    self._record(list(changes.items()))
+                raise
+            finally:
+                os.remove(journal.name)
+                journal.close()
+
+        after_write(*written)
+        return len(changes)
+
+    def recover(self):
+        """Take over the journals of processes that have died; returns
+        how many changes they held."""
+
+        with self._lock:
+            self._forked()
+            own = self._journal.name
+
+        taken = 0
+
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+
+            if not name.endswith('.journal') or path == own:
+                continue
+
+            try:
+                journal = open(path)
+            except FileNotFoundError:
+                continue
+
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                # Flushed and removed by its owner just before we got it
+                try:
+                    if os.stat(path).st_ino != os.fstat(
+                            journal.fileno()).st_ino:
+                        continue
+                except FileNotFoundError:
+                    continue
+
+                changes = []
+                for line in journal:
+                    try:
+                        kind, user_id, target_id, on, made_at = json.loads(
+                            line)
+                    except ValueError:
+                        # Torn by the crash
+                        continue
+                    changes.append(((kind, user_id, target_id),
+                                    (on, made_at)))
+
+                with self._lock:
+                    self._record(changes)
+
+                os.remove(path)
+                taken += len(changes)
+
+        return taken
+
+    def close(self):
+        """Flush, and remove this process's (then empty) journal."""
+
+        if self._pid != os.getpid():
+            return
+
+        atexit.unregister(self.close)
+
+        with self.app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+
+        with self._lock:
+            if not self.pending:
+                os.remove(self._journal.name)
+            self._journal.close()
+            self._pid = None
+
+    def _run(self):
+        with self.app.app_context():
+            pruned = time.monotonic()
+
+            while True:
+                self._wake.wait(self.window)
+                self._wake.clear()
+
+                try:
+                    self.recover()
+                    self.flush()
+
+                    if time.monotonic() - pruned >= PRUNE_INTERVAL:
+                        pruned = time.monotonic()
+                        forget_written(time.time() - self.app.config[
+                            'WRITEBUFFER_HISTORY'])
+                except Exception:
+                    self.app.logger.exception(
+                        "Writing buffered likes and follows failed")
+                finally:
+                    db.session.remove()
+
+
+def _write_likes(conn, likes):
+    message_ids = sorted({message_id for _, message_id in likes})
+
+    # Locked in id order, so flushes in other processes touching the
+    # same hot message take turns, each counting what the last committed
+    authors = dict(conn.execute(
+        db.select([Message.id, Message.user_id])
+        .where(Message.id.in_(message_ids))
+        .order_by(Message.id)
+        .with_for_update()).fetchall())
+
+    existing = set(map(tuple, conn.execute(
+        db.select([Likes.user_id, Likes.message_id])
+        .where(Likes.user_id.in_({user_id for user_id, _ in likes}))
+        .where(Likes.message_id.in_(message_ids)))))
+
+    # Likes of messages deleted since are dropped
+    added = [pair for pair, on in likes.items()
+             if on and pair not in existing and pair[1] in authors]
+    removed = [pair for pair, on in likes.items()
+               if not on and pair in existing]
+
+    if added:
+        conn.execute(Likes.__table__.insert(),
+                     [{'user_id': user_id, 'message_id': message_id}
+                      for user_id, message_id in added])
+    if removed:
+        conn.execute(Likes.__table__.delete().where(db.and_(
+            Likes.user_id == db.bindparam('u'),
+            Likes.message_id == db.bindparam('m'))),
+            [{'u': user_id, 'm': message_id}
+             for user_id, message_id in removed])
+
+    deltas = Counter(message_id for _, message_id in added)
+    deltas.subtract(message_id for _, message_id in removed)
+
+    if any(deltas.values()):
+        conn.execute(Message.__table__.update()
+                     .where(Message.id == db.bindparam('m'))
+                     .values(like_count=Message.like_count
+                             + db.bindparam('delta')),
+                     [{'m': message_id, 'delta': delta}
+                      for message_id, delta in deltas.items() if delta])
+
+    return [(user_id, message_id, on, authors[message_id])
+            for pairs, on in ((added, True), (removed, False))
+            for user_id, message_id in pairs]
+
+
+def _write_follows(conn, follows):
+    followed_ids = {followed_id for _, followed_id in follows}
+
+    users = {user_id for (user_id,) in conn.execute(
+        db.select([User.id]).where(User.id.in_(followed_ids)))}
+
+    existing = set(map(tuple, conn.execute(
+        db.select([Follows.user_following_id,
+                   Follows.user_being_followed_id])
+        .where(Follows.user_following_id.in_(
+            {follower_id for follower_id, _ in follows}))
+        .where(Follows.user_being_followed_id.in_(followed_ids)))))
+
+    added = [pair for pair, on in follows.items()
+             if on and pair not in existing and pair[1] in users]
+    removed = [pair for pair, on in follows.items()
+               if not on and pair in existing]
+
+    if added:
+        conn.execute(Follows.__table__.insert(),
+                     [{'user_following_id': follower_id,
+                       'user_being_followed_id': followed_id}
+                      for follower_id, followed_id in added])
+    if removed:
+        conn.execute(Follows.__table__.delete().where(db.and_(
+            Follows.user_following_id == db.bindparam('f'),
+            Follows.user_being_followed_id == db.bindparam('t'))),
+            [{'f': follower_id, 't': followed_id}
+             for follower_id, followed_id in removed])
+
+    return [(follower_id, followed_id, on)
+            for pairs, on in ((added, True), (removed, False))
+            for follower_id, followed_id in pairs]
+
+
+def _latest(conn, changes):
+    """Those of `changes` made after the last written change of their
+    (kind, user, target), recorded as now the last written."""
+
+    table = BufferedWrite.__table__
+    key = db.tuple_(table.c.kind, table.c.user_id, table.c.target_id)
+
+    # Locked in key order, so flushes in other processes writing the same
+    # toggles take turns, each seeing what the last committed
+    written = {(kind, user_id, target_id): toggled_at
+               for kind, user_id, target_id, toggled_at in conn.execute(
+                   db.select([table]).where(key.in_(sorted(changes)))
+                   .order_by(table.c.kind, table.c.user_id,
+                             table.c.target_id)
+                   .with_for_update())}
+
+    latest = {key: change for key, change in changes.items()
+              if key not in written or change[1] > written[key]}
+    params = [{'k': kind, 'u': user_id, 't': target_id, 'at': made_at}
+              for (kind, user_id, target_id), (_, made_at)
+              in latest.items()]
+
+    updated = [row for row in params
+               if (row['k'], row['u'], row['t']) in written]
+    if updated:
+        conn.execute(table.update().where(db.and_(
+            table.c.kind == db.bindparam('k'),
+            table.c.user_id == db.bindparam('u'),
+            table.c.target_id == db.bindparam('t')))
+            .values(toggled_at=db.bindparam('at')), updated)
+
+    added = [{'kind': row['k'], 'user_id': row['u'],
+              'target_id': row['t'], 'toggled_at': row['at']}
+             for row in params
+             if (row['k'], row['u'], row['t']) not in written]
+    if added:
+        conn.execute(table.insert(), added)
+
+    return latest
+
+
+def write_changes(changes):
+    """Write `changes` ({(kind, user id, target id): (on, made at)}) in
+    one transaction, less those overtaken by a change written before;
+    returns the likes and follows that changed."""
+
+    try:
+        conn = db.session.connection()
+
+        likes, follows = {}, {}
+        for (kind, user_id, target_id), (on, _) in _latest(
+                conn, changes).items():
+            (likes if kind == 'like' else follows)[user_id, target_id] = on
+
+        liked = _write_likes(conn, likes) if likes else []
+        followed = _write_follows(conn, follows) if follows else []
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return liked, followed
+
+
+def forget_written(before):
+    """Forget the times of toggles made before `before` (seconds since
+    the epoch); returns how many there were."""
+
+    try:
+        forgotten = BufferedWrite.query.filter(
+            BufferedWrite.toggled_at < before).delete(
+                synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return forgotten
+
+
+def after_write(liked, followed):
+    """Update the follow graph and drop the cached pages that changed."""
+
+    for follower_id, followed_id, on in followed:
+        graph.record_follow(follower_id, followed_id, follow=on)
+
+    users = ({user_id for user_id, *_ in liked}
+             | {follower_id for follower_id, *_ in followed})
+
+    for user_id in users:
+        feedcache.invalidate_feed(user_id)
+
+    feedcache.invalidate_profile(
+        *users, *{author_id for *_, author_id in liked},
+        *{followed_id for _, followed_id, _ in followed})
+
+
+def get_write_buffer():
+    return current_app.extensions.get('write_buffer')
+
+
+def enabled():
+    return get_write_buffer() is not None
+
+
+def fresh_notes(notes, window):
+    now = time.time()
+    return [note for note in notes or () if now - note[3] < window]
+
+
+def notes_key(user_id):
+    """Session store key of `user_id`'s notes. The colons keep it from
+    ever passing for a session id (sessions.SID_PATTERN)."""
+
+    return f"pending:writes:{user_id}"
+
+
+def load_notes():
+    """The logged-in user's fresh notes, read once per request."""
+
+    if 'pending_notes' not in g:
+        notes = None
+
+        if NOTES_COOKIE in request.cookies and g.get('user'):
+            record = get_session_store().load(notes_key(g.user.id))
+            notes = record and json.loads(record[0])
+
+        g.pending_notes = fresh_notes(
+            notes, current_app.config['WRITEBUFFER_READ_WINDOW'])
+
+    return g.pending_notes
+
+
+def note(kind, target_id, on):
+    """Note an unflushed toggle for the logged-in user's next requests,
+    on any worker."""
+
+    app = current_app
+    window = app.config['WRITEBUFFER_READ_WINDOW']
+    now = time.time()
+
+    notes = g.pending_notes = [note for note in load_notes()
+                               if note[:2] != [kind, target_id]]
+    notes.append([kind, target_id, on, now])
+    get_session_store().save(notes_key(g.user.id), json.dumps(notes),
+                             now + window)
+
+    @after_this_request
+    def flag(response):
+        interface = app.session_interface
+        response.set_cookie(
+            NOTES_COOKIE, '1', max_age=math.ceil(window),
+            httponly=True,
+            domain=interface.get_cookie_domain(app),
+            path=interface.get_cookie_path(app),
+            secure=interface.get_cookie_secure(app),
+            samesite=interface.get_cookie_samesite(app))
+        return response
+
+
+def pending(kind):
+    """{target id: on} of the logged-in user's recent `kind` toggles."""
+
+    return {target_id: on for note_kind, target_id, on, _ in load_notes()
+            if note_kind == kind}
+
+
+def has_pending(request):
+    """May the user making `request` have toggles not written yet?"""
+
+    return NOTES_COOKIE in request.cookies
+
+
+def like(user_id, message_id, on=True):
+    get_write_buffer().toggle('like', user_id, message_id, on)
+    note('like', message_id, on)
+
+
+def follow(follower_id, followed_id, on=True):
+    get_write_buffer().toggle('follow', follower_id, followed_id, on)
+    note('follow', followed_id, on)
+
+
+def with_pending(kind, ids, user_id):
+    """`ids`, of what `user_id` likes or follows, as the logged-in user's
+    pending toggles will leave them."""
+
+    if not (enabled() and has_request_context() and g.get('user')
+            and g.user.id == user_id):
+        return ids
+
+    changes = pending(kind)
+    if not changes:
+        return ids
+
+    return ((set(ids) - {target_id for target_id, on in changes.items()
+                         if not on})
+            | {target_id for target_id, on in changes.items() if on})
+
+
+def with_pending_rows(kind, rows, model):
+    """`rows` (the logged-in user's liked Messages) as their pending
+    toggles will leave them."""
+
+    changes = pending(kind) if enabled() else {}
+    if not changes:
+        return rows
+
+    have = {row.id for row in rows}
+    new = [target_id for target_id, on in changes.items()
+           if on and target_id not in have]
+
+    return ([row for row in rows if changes.get(row.id, True)]
+            + (model.query.filter(model.id.in_(new)).all() if new else []))
+
+
+@writebuffer_cli.command('flush')
+def flush_command():
+    """Write what's left in the journals of stopped processes."""
+
+    config = current_app.config
+    buffer = WriteBuffer(current_app._get_current_object(),
+                         config['WRITEBUFFER_DIRECTORY'], window=0)
+
+    taken = buffer.recover()
+    buffer.close()
+    forget_written(time.time() - config['WRITEBUFFER_HISTORY'])
+
+    click.echo(f"Wrote {taken} changes from stopped processes' journals")
+
+
+def init_app(app):
+    """Buffer `app`'s likes and follows, when enabled."""
+
+    app.config.setdefault('WRITEBUFFER_ENABLED',
+                          os.environ.get('WRITEBUFFER_ENABLED') == '1')
+    app.config.setdefault('WRITEBUFFER_DIRECTORY',
+                          os.path.join(app.instance_path, 'writebuffer'))
+    app.config.setdefault('WRITEBUFFER_WINDOW', 0.5)
+    app.config.setdefault('WRITEBUFFER_MAX_PENDING', 1000)
+    app.config.setdefault('WRITEBUFFER_FSYNC', False)
+    app.config.setdefault('WRITEBUFFER_READ_WINDOW', 30)
+    app.config.setdefault('WRITEBUFFER_HISTORY', 24 * 3600)
+
+    if app.config['WRITEBUFFER_ENABLED']:
+        app.extensions['write_buffer'] = WriteBuffer(
+            app, app.config['WRITEBUFFER_DIRECTORY'],
+            app.config['WRITEBUFFER_WINDOW'],
+            app.config['WRITEBUFFER_MAX_PENDING'],
+            app.config['WRITEBUFFER_FSYNC'])
+
+    app.cli.add_command(writebuffer_cli)
@@ -0,0 +1,29 @@
+"""Production entry point for Warbler.
+
+Serve with gunicorn, using the settings in gunicorn.conf.py:
+
+    gunicorn wsgi:app
+
+The app is built once in the gunicorn master (`preload_app`) and forked
+into the workers. Connections opened while preloading must not be shared
+across processes, so each worker disposes of the inherited engine pool
+right after the fork (see `dispose_engine()`). Templates are loaded
+before the fork too, so workers start with them compiled.
+"""
+
+from app import create_app
+from models import db
+from templating import warm_up
+
+app = create_app({'DEBUG': False})
+
+# Compile (or load from bytecode) every template before forking, so no
+# worker compiles one on a live request
+warm_up(app.jinja_env)
+
+
+def dispose_engine():
+    """Drop pooled DB connections inherited from the parent process."""
+
+    with app.app_context():
+        db.engine.dispose()